@@ -0,0 +1,188 @@
+from django.conf import settings
+import numpy as np
+import pandas as pd
+from .table import coerce_column
+from .caching import cached
+
+
+TIME_BUCKETS = {
+    'minute': 'm',
+    'hour': 'h',
+    'day': 'D',
+    'week': 'W',
+    'month': 'M',
+    'year': 'Y',
+}  # Bucket name to numpy datetime64 unit
+BUCKET_SPANS = {
+    'minute': pd.Timedelta(minutes=1),
+    'hour': pd.Timedelta(hours=1),
+    'day': pd.Timedelta(days=1),
+    'week': pd.Timedelta(weeks=1),
+    'month': pd.Timedelta(days=31),
+    'year': pd.Timedelta(days=366),
+}
+CHART_KINDS = ('series', 'categories', 'timeseries', 'scatter')
+
+
+class AggregationError(ValueError):
+    """
+    Raised for chart requests that do not fit the dataset schema.
+    """
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+    Returns the positions of at most threshold points of the (x, y) series, x sorted ascending,
+    that keep its visual shape.
+    """
+    length = len(x)
+    if threshold >= length or threshold < 3:
+        return np.arange(length)
+
+    edges = np.linspace(1, length - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, length - 1
+    anchor = 0
+
+    for bucket in range(threshold - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        next_stop = edges[bucket + 2] if bucket + 2 < len(edges) else length
+        average_x = x[stop:next_stop].mean()
+        average_y = y[stop:next_stop].mean()
+
+        areas = np.abs(
+            (x[anchor] - average_x) * (y[start:stop] - y[anchor])
+            - (x[anchor] - x[start:stop]) * (average_y - y[anchor])
+        )
+        anchor = start + int(areas.argmax()) if stop > start else start
+        selected[bucket + 1] = anchor
+
+    return np.unique(selected)
+
+
+def bucket_start(times, bucket):
+    """
+    The start of the time bucket of each datetime, truncating the datetime64 values directly,
+    which is faster than going through pandas periods. Weeks start on Monday.
+    """
+    values = times.to_numpy(dtype='datetime64[us]')
+    if bucket == 'week':
+        # numpy weeks start on Thursday like the epoch, step back to the Monday of each date
+        days = values.astype('datetime64[D]')
+        starts = days - ((days.view('int64') + 3) % 7).astype('timedelta64[D]')
+    else:
+        starts = values.astype(f'datetime64[{TIME_BUCKETS[bucket]}]')
+    return pd.Series(starts.astype('datetime64[us]'), index=times.index, name=times.name)
+
+
+def pick_bucket(times, budget):
+    """
+    Smallest time bucket that keeps the number of buckets over the time range within budget.
+    """
+    span = times.max() - times.min()
+    for name, width in BUCKET_SPANS.items():
+        if span / width <= budget:
+            return name
+    return 'year'
+
+
+def series_chart(df, column, budget):
+    """
+    A numeric column against its row index, LTTB-downsampled to the point budget.
+    """
+    values = df[column].dropna()
+    x = values.index.to_numpy(dtype='float64')
+    keep = lttb(x, values.to_numpy(dtype='float64'), budget)
+    return {'labels': values.index[keep].tolist(), 'values': values.iloc[keep].tolist()}
+
+
+def scatter_chart(df, x_column, column, budget):
+    """
+    A numeric column against another numeric column, sorted on x and LTTB-downsampled.
+    """
+    pairs = df[[x_column, column]].dropna().sort_values(x_column, kind='stable')
+    x = pairs[x_column].to_numpy(dtype='float64')
+    keep = lttb(x, pairs[column].to_numpy(dtype='float64'), budget)
+    return {'labels': pairs[x_column].iloc[keep].tolist(), 'values': pairs[column].iloc[keep].tolist()}
+
+
+def timeseries_chart(df, x_column, column, bucket, budget):
+    """
+    Mean, min, max and count of a column per time bucket of a datetime or date column.
+    A column of the time type itself is charted as row counts per bucket.
+    """
+    times = df[x_column]
+    if times.notna().sum() == 0:
+        return {'bucket': bucket, 'labels': [], 'mean': [], 'min': [], 'max': [], 'count': []}
+    bucket = pick_bucket(times, budget) if bucket == 'auto' else bucket
+
+    values = df[column] if column != x_column else pd.Series(1.0, index=df.index)
+    grouped = values.groupby(bucket_start(times, bucket))
+    result = grouped.agg(['mean', 'min', 'max', 'count'])
+    result = result[result['count'] > 0]
+    result = result.astype(object).where(result.notna(), None)
+
+    return {
+        'bucket': bucket,
+        'labels': [label.isoformat(sep=' ') for label in result.index],
+        'mean': result['mean'].tolist(),
+        'min': result['min'].tolist(),
+        'max': result['max'].tolist(),
+        'count': result['count'].tolist(),
+    }
+
+
+def categories_chart(series, top_k):
+    """
+    Counts of the top_k most frequent values of a column, with the remainder as 'Others'.
+    """
+    counts = series.dropna().astype(str).value_counts()
+    top = counts.iloc[:top_k]
+    labels, values = top.index.tolist(), top.tolist()
+    others = int(counts.iloc[top_k:].sum())
+    if others:
+        labels.append('Others')
+        values.append(others)
+    return {'labels': labels, 'values': values}
+
+
+def chart_data(rows, schema, kind, column, x_column=None, bucket='auto'):
+    """
+    Aggregate the full dataset for one chart, cached per dataset version, kind, columns and bucket.
+    """
+    budget = settings.CSV_CHART_POINTS
+    if kind not in CHART_KINDS:
+        raise AggregationError(f"Unknown chart kind '{kind}'.")
+    if column not in schema or (x_column is not None and x_column not in schema):
+        raise AggregationError("Unknown column.")
+    if bucket != 'auto' and bucket not in TIME_BUCKETS:
+        raise AggregationError(f"Unknown time bucket '{bucket}'.")
+    numeric = ('integer', 'float')
+    if kind == 'series' and schema[column] not in numeric:
+        raise AggregationError(f"'{column}' is not numeric.")
+    if kind == 'scatter' and (schema[column] not in numeric or schema.get(x_column) not in numeric):
+        raise AggregationError("Scatter charts need two numeric columns.")
+    if kind == 'timeseries' and (schema.get(x_column) not in ('datetime', 'date')
+                                 or (schema[column] not in numeric and column != x_column)):
+        raise AggregationError("Time series need a datetime or date x column and a numeric column.")
+
+    def aggregate():
+        columns = [column] if x_column in (None, column) else [x_column, column]
+        df = rows.to_frame(columns)
+        for name in columns:
+            df[name] = coerce_column(df[name], schema[name])
+
+        if kind == 'series':
+            data = series_chart(df, column, budget)
+        elif kind == 'scatter':
+            data = scatter_chart(df, x_column, column, budget)
+        elif kind == 'timeseries':
+            data = timeseries_chart(df, x_column, column, bucket, budget)
+        else:
+            data = categories_chart(df[column], settings.CSV_CHART_TOP_K)
+
+        data['rows'] = len(rows)
+        return data
+
+    return cached('chart', rows.dataset, [kind, column, x_column, bucket], aggregate)
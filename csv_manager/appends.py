@@ -0,0 +1,149 @@
+import codecs
+import pandas as pd
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from .models import CSVChanges
+from .schema import DATETIME_OUTPUT_FORMAT, DATE_OUTPUT_FORMAT, coerce_series, normalize_header
+from .storage import frame_to_rows
+
+
+# Content types of the request bodies bulk appends accept
+APPEND_FORMATS = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'application/jsonlines': 'ndjson',
+}
+MAX_REPORTED_ERRORS = 1000  # Invalid values listed in the response, the rest are only counted
+
+
+class AppendError(Exception):
+    """
+    Raised for a body that cannot be read as rows of the CSV at all.
+    """
+
+
+def append_format(content_type):
+    """
+    The format ('csv' or 'ndjson') of a request body from its content type.
+    """
+    if content_type not in APPEND_FORMATS:
+        raise AppendError(f"Unsupported content type '{content_type}', send one of: {', '.join(APPEND_FORMATS)}.")
+    return APPEND_FORMATS[content_type]
+
+
+def read_batches(stream, fmt, batch_rows):
+    """
+    Read a CSV or NDJSON body from a file-like object as DataFrames of at most batch_rows raw rows,
+    so only one batch of a large body is held in memory.
+    CSV values are read as text, with empty cells as missing; NDJSON values keep their JSON types.
+    """
+    try:
+        if fmt == 'csv':
+            reader = pd.read_csv(stream, dtype=str, keep_default_na=False, na_values=[''], chunksize=batch_rows)
+        else:
+            # The JSON reader combines lines as text, decode the body as it is read
+            text = codecs.getreader('utf-8')(stream)
+            reader = pd.read_json(text, lines=True, dtype=False, convert_dates=False, chunksize=batch_rows)
+        for df in reader:
+            if fmt == 'csv':
+                df.columns = [normalize_header(col) for col in df.columns]
+            yield df.reset_index(drop=True)
+    except pd.errors.EmptyDataError:
+        return
+    except (ValueError, UnicodeDecodeError) as e:
+        raise AppendError(f"Could not read the body as {fmt.upper()}: {e}")
+
+
+def parse_datetimes(values, formats):
+    """
+    Parse text as datetimes, trying each format on the values no earlier format could parse.
+    """
+    parsed = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    for fmt in formats:
+        pending = parsed.isna() & values.notna()
+        if not pending.any():
+            break
+        parsed[pending] = pd.to_datetime(values[pending], format=fmt, errors='coerce')
+    return parsed
+
+
+def coerce_values(values, col_type):
+    """
+    Convert raw values to a schema type in one vectorized pass, normalized the way processing stores
+    them (see schema.normalize_frame). Values that do not fit become missing.
+    """
+    if col_type in ('datetime', 'date'):
+        text = values.astype('string').str.strip()
+        if col_type == 'datetime':
+            return parse_datetimes(text, settings.CSV_DATETIME_FORMATS).dt.strftime(DATETIME_OUTPUT_FORMAT)
+        return parse_datetimes(text, settings.CSV_DATE_FORMATS).dt.strftime(DATE_OUTPUT_FORMAT)
+    if col_type == 'string':
+        return values.astype(object).where(values.isna(), values.astype(str))
+    if col_type == 'boolean' and pd.api.types.is_object_dtype(values):
+        # Numbers are not booleans, even if their text would be
+        values = values.where(values.map(lambda value: isinstance(value, (str, bool))))
+    return coerce_series(values, col_type)
+
+
+def validate_batch(df, schema, first_row):
+    """
+    Validate a batch of raw rows against a schema.
+
+    Returns the rows whose values all fit their column types, normalized and ready to store, and
+    one error per value that does not fit, numbered from first_row. Missing values are allowed.
+    Raises AppendError for columns that are not in the schema.
+    """
+    unknown = [column for column in df.columns if column not in schema]
+    if unknown:
+        raise AppendError(f"Unknown columns: {', '.join(map(str, unknown))}. Expected: {', '.join(schema)}.")
+
+    valid = pd.Series(True, index=df.index)
+    errors = []
+    normalized = {}
+    for column, col_type in schema.items():
+        values = df[column] if column in df.columns else pd.Series(None, index=df.index, dtype=object)
+        series = coerce_values(values, col_type)
+        invalid = values.notna() & series.isna()
+        if invalid.any():
+            valid &= ~invalid
+            errors += [
+                {'row': first_row + position, 'column': column, 'value': str(value), 'message': f"Not a valid {col_type}."}
+                for position, value in values[invalid].items()
+            ]
+        normalized[column] = series
+
+    rows = frame_to_rows(pd.DataFrame(normalized, index=df.index)[valid])
+    return rows, sorted(errors, key=lambda error: error['row'])
+
+
+def append_rows(stream, fmt, csv_entry, schema):
+    """
+    Record the valid rows of a CSV or NDJSON body as pending changes of an UploadedCSV or DerivedCSV,
+    one CSVChanges per batch of CSV_APPEND_BATCH_ROWS rows. Rows with invalid values are skipped.
+
+    Returns a report with the created changes, the number of appended and rejected rows, and the
+    first MAX_REPORTED_ERRORS errors. Rows are numbered from 1, not counting a CSV header.
+    Run it in a transaction, so a body that turns out unreadable halfway adds no changes.
+    """
+    content_type = ContentType.objects.get_for_model(csv_entry)
+    changes, appended, rejected, errors, error_count = [], 0, 0, [], 0
+    first_row = 1
+
+    for df in read_batches(stream, fmt, settings.CSV_APPEND_BATCH_ROWS):
+        rows, batch_errors = validate_batch(df, schema, first_row)
+        first_row += len(df)
+        if rows:
+            changes.append(CSVChanges.objects.create(content_type=content_type, object_id=csv_entry.id, data=rows))
+        appended += len(rows)
+        rejected += len(df) - len(rows)
+        error_count += len(batch_errors)
+        errors += batch_errors[:MAX_REPORTED_ERRORS - len(errors)]
+
+    return {
+        'changes': changes,
+        'rows_appended': appended,
+        'rows_rejected': rejected,
+        'errors': errors,
+        'error_count': error_count,
+    }
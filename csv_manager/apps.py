@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class CsvManagerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'csv_manager'
+
+    def ready(self):
+        from . import signals  # noqa: F401
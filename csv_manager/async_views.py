@@ -0,0 +1,148 @@
+from asgiref.sync import sync_to_async
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404, render
+from django.views.decorators.csrf import csrf_exempt
+from django.utils.cache import patch_vary_headers
+from .models import UploadedCSV, DerivedCSV
+from .aggregation import chart_data, AggregationError
+from .table import parse_table_query, table_page, TableQueryError
+from .query import load_spec, parse_query, query_hash, run_query, QueryError
+from .exports import aiter_chunks, ExportError
+from .views import csv_download, query_response
+from .instrumentation import timed_view
+from .caching import cached_page, conditional_response, is_cacheable
+
+
+async def get_csv_entry(csv_id, is_derived, defer=()):
+    """
+    The UploadedCSV or DerivedCSV with the given id, with the parent of a DerivedCSV, and its schema.
+    """
+    if is_derived:
+        csv_entry = await aget_object_or_404(DerivedCSV.objects.select_related('parent').defer(*defer), id=csv_id)
+        return csv_entry, csv_entry.parent.schema
+    csv_entry = await aget_object_or_404(UploadedCSV.objects.defer(*defer), id=csv_id)
+    return csv_entry, csv_entry.schema
+
+
+@timed_view
+async def download_csv(request, csv_id, is_derived=False):
+    """
+    Async variant of views.download_csv, streaming the export through an async iterator.
+    """
+    try:
+        csv_entry, _ = await get_csv_entry(csv_id, is_derived)
+    except Http404:
+        return HttpResponse("CSV not found.", status=404)
+
+    # Byte ranges measure the whole CSV before the response starts
+    try:
+        chunks, status, headers = await sync_to_async(csv_download)(request, csv_entry, is_derived)
+    except (TableQueryError, ExportError) as e:
+        return HttpResponse(str(e), status=400)
+    if chunks is None:
+        return HttpResponse(status=status, headers=headers)
+
+    response = StreamingHttpResponse(aiter_chunks(chunks), status=status, headers=headers)
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+
+@timed_view
+async def view_csv(request, csv_id, is_derived=False):
+    """
+    Async variant of views.view_csv.
+    """
+    csv_entry, schema = await get_csv_entry(csv_id, is_derived, defer=['column_sketches'])
+    content = await sync_to_async(cached_page)('csv_manager/view_csv_content.html', csv_entry, {
+        'csv_entry': csv_entry,
+        'schema': schema or {},
+        'columns': list(schema or {}),
+        'is_derived': is_derived,
+    })
+    return render(request, 'csv_manager/view_csv.html', {'content': content})
+
+
+@timed_view
+async def view_csv_rows(request, csv_id, is_derived=False):
+    """
+    Async variant of views.view_csv_rows, reading the page in the request's sync thread.
+    """
+    csv_entry, schema = await get_csv_entry(csv_id, is_derived, defer=['column_sketches'])
+    try:
+        query = parse_table_query(request.GET, schema or {})
+    except TableQueryError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    page = await sync_to_async(table_page)(csv_entry.rows, schema or {}, query)
+    return JsonResponse(page)
+
+
+@timed_view
+async def visualize_csv(request, csv_id):
+    """
+    Async variant of views.visualize_csv.
+    """
+    is_derived = request.GET.get('is_derived', '0') == '1'
+    csv_entry, schema = await get_csv_entry(csv_id, is_derived, defer=['column_sketches'])
+    allowed_columns = {col: col_type for col, col_type in schema.items() if col_type != 'string'}
+
+    content = await sync_to_async(cached_page)('csv_manager/visualize_csv_content.html', csv_entry, {
+        'csv_entry': csv_entry,
+        'schema': schema,
+        'allowed_columns': allowed_columns,
+        'column_stats': csv_entry.column_stats or {},
+        'is_derived': is_derived
+    })
+    return render(request, 'csv_manager/visualize_csv.html', {'content': content})
+
+
+@timed_view
+async def visualize_csv_data(request, csv_id):
+    """
+    Async variant of views.visualize_csv_data, aggregating in the request's sync thread.
+    """
+    is_derived = request.GET.get('is_derived', '0') == '1'
+    csv_entry, schema = await get_csv_entry(csv_id, is_derived, defer=['column_sketches'])
+
+    headers = {}
+    if is_cacheable(csv_entry):
+        headers, not_modified = conditional_response(request, csv_entry)
+        if not_modified is not None:
+            return HttpResponse(status=not_modified.status_code, headers=headers)
+
+    try:
+        data = await sync_to_async(chart_data)(
+            csv_entry.rows,
+            schema or {},
+            kind=request.GET.get('kind', 'series'),
+            column=request.GET.get('column'),
+            x_column=request.GET.get('x') or None,
+            bucket=request.GET.get('bucket', 'auto'),
+        )
+    except AggregationError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    return JsonResponse(data, headers=headers)
+
+
+@csrf_exempt
+@timed_view
+async def query_csv(request, csv_id, is_derived=False):
+    """
+    Async variant of views.query_csv, running the query in the request's sync thread.
+    """
+    csv_entry, schema = await get_csv_entry(csv_id, is_derived, defer=['column_sketches'])
+    try:
+        query = parse_query(load_spec(request.body if request.method == 'POST' else request.GET.get('q')), schema)
+    except QueryError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    fmt = 'csv' if request.GET.get('format') == 'csv' else 'json'
+    headers = {}
+    if is_cacheable(csv_entry):
+        headers, not_modified = conditional_response(request, csv_entry, variant=f'{query_hash(query)}-{fmt}')
+        if not_modified is not None:
+            return HttpResponse(status=not_modified.status_code, headers=headers)
+
+    result = await sync_to_async(run_query)(csv_entry.rows, schema, query)
+    return query_response(result, fmt, headers)
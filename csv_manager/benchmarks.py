@@ -0,0 +1,407 @@
+import json
+import os
+import platform
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from unittest import mock
+import django
+import numpy as np
+import pandas as pd
+from celery import current_app
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from .caching import dataset_cache
+from .instrumentation import reset_peak_memory, peak_memory
+from .models import UploadedCSV, CSVChanges
+from .tasks import process_csv, apply_csv_changes
+
+
+DATASETS = ('tall', 'wide', 'strings', 'datetimes', 'air_quality')
+MODES = ('memory', 'eager')  # Celery tasks run by a worker thread through an in-memory broker, or inline
+SCENARIOS = (
+    'upload', 'process_csv', 'apply_csv_changes',
+    'view_csv', 'view_csv_rows', 'download_csv', 'visualize_csv', 'visualize_csv_data',
+)
+CONCURRENT_SCENARIO = 'process_csv_concurrent'  # Recorded with concurrency > 1, see bench_concurrent_processing
+APPEND_ROWS = 100  # Rows added per apply_csv_changes run
+FIXTURE = 'air-quality-india.csv'
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def generate_csv(kind, rows, path, seed=0):
+    """
+    Write a synthetic CSV of the given kind and number of rows, the same for the same seed:
+    'tall' has a few narrow columns, 'wide' 60 numeric columns, 'strings' mostly free text
+    with some empty cells, and 'datetimes' timestamps and dates in several formats.
+    """
+    rng = np.random.default_rng(seed)
+    if kind == 'tall':
+        df = pd.DataFrame({
+            'id': np.arange(rows),
+            'value': rng.normal(100, 15, rows).round(3),
+            'category': rng.choice(list('ABCDEFGH'), rows),
+        })
+    elif kind == 'wide':
+        df = pd.DataFrame(
+            {f'count_{i}': rng.integers(0, 10000, rows) for i in range(30)}
+            | {f'ratio_{i}': rng.random(rows).round(4) for i in range(30)}
+        )
+    elif kind == 'strings':
+        letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+        words = [''.join(rng.choice(letters, length)) for length in rng.integers(2, 10, 2000)]
+        def sentences(min_words, max_words):
+            return [' '.join(rng.choice(words, count)) for count in rng.integers(min_words, max_words, rows)]
+        df = pd.DataFrame({
+            'name': sentences(1, 3),
+            'city': rng.choice(words[:200], rows),
+            'title': sentences(3, 8),
+            'comment': sentences(5, 30),
+            'tag': rng.choice(words[:20], rows),
+            'score': rng.integers(0, 100, rows),
+        })
+        df.loc[rng.random(rows) < 0.1, 'comment'] = None
+    elif kind == 'datetimes':
+        stamps = pd.to_datetime('2015-01-01') + pd.to_timedelta(rng.integers(0, 10 * 365 * 86400, rows), unit='s')
+        df = pd.DataFrame({
+            'created': stamps.strftime('%Y-%m-%d %H:%M:%S'),
+            'day': stamps.strftime('%Y-%m-%d'),
+            'updated': (stamps + pd.Timedelta(hours=1)).strftime('%d/%m/%Y %H:%M:%S'),
+            'reading': rng.normal(50, 10, rows).round(2),
+        })
+    else:
+        raise BenchmarkError(f"Unknown dataset kind '{kind}'.")
+    df.to_csv(path, index=False)
+
+
+def dataset_path(kind, rows, directory, seed=0):
+    """
+    Path of the CSV of a dataset: the air quality fixture of the repository, or a generated file.
+    """
+    if kind == 'air_quality':
+        return os.path.join(settings.BASE_DIR, FIXTURE)
+    path = os.path.join(directory, f'{kind}-{rows}.csv' if seed == 0 else f'{kind}-{rows}-{seed}.csv')
+    if not os.path.exists(path):
+        generate_csv(kind, rows, path, seed)
+    return path
+
+
+@contextmanager
+def benchmark_environment(directory, storage=None):
+    """
+    A throwaway test database (a file under directory for SQLite, so worker threads share it),
+    media files under directory and the test client environment.
+    """
+    if connection.vendor == 'sqlite':
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    overrides = {'MEDIA_ROOT': os.path.join(directory, 'media')}
+    if storage:
+        overrides['CSV_STORAGE_BACKEND'] = storage
+    try:
+        with override_settings(**overrides):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+@contextmanager
+def celery_mode(mode):
+    """
+    Run Celery tasks inline ('eager'), or through an in-memory broker consumed by a worker thread ('memory').
+    """
+    from celery.contrib.testing.worker import start_worker
+
+    app = current_app
+    # Settings read from Django with a namespace are looked up under the prefixed name first
+    prefix = f'{app.namespace}_' if app.namespace else ''
+    def setting(name):
+        return f'{prefix}{name}'.upper() if prefix else name
+
+    names = [setting(name) for name in ('task_always_eager', 'broker_url', 'result_backend', 'broker_transport_options')]
+    saved = {name: app.conf.get(name) for name in names}
+    try:
+        if mode == 'eager':
+            app.conf.update({setting('task_always_eager'): True})
+            yield
+        elif mode == 'memory':
+            app.conf.update({
+                setting('task_always_eager'): False,
+                setting('broker_url'): 'memory://',
+                setting('result_backend'): 'cache+memory://',
+                setting('broker_transport_options'): {'polling_interval': 0.01},
+            })
+            with start_worker(app, pool='solo', perform_ping_check=False):
+                yield
+        else:
+            raise BenchmarkError(f"Unknown Celery mode '{mode}'.")
+    finally:
+        # Drop the overrides, so settings that were not set go back to their defaults rather than to None
+        for name in names:
+            app.conf.pop(name, None)
+        app.conf.update({name: value for name, value in saved.items() if app.conf.get(name) != value})
+
+
+def wait_for(condition, timeout=600):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise BenchmarkError("Timed out waiting for a background task.")
+        time.sleep(0.005)
+
+
+class Recorder:
+    """
+    Latencies, peak memory and sizes of the runs of each scenario.
+    """
+    def __init__(self):
+        self.runs = {}
+
+    @contextmanager
+    def measure(self, scenario, rows=0, size_bytes=0):
+        reset_peak_memory()
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        runs = self.runs.setdefault(scenario, {
+            'latencies': [], 'peak_memory_bytes': 0, 'rows': rows, 'size_bytes': size_bytes, 'failed': 0,
+        })
+        runs['latencies'].append(elapsed)
+        runs['peak_memory_bytes'] = max(runs['peak_memory_bytes'], peak_memory() or 0)
+
+    def summary(self):
+        """
+        Per scenario: latency percentiles and mean in seconds, throughput at the median latency, peak memory
+        and the number of tasks that failed.
+        """
+        results = {}
+        for scenario, runs in self.runs.items():
+            latencies = np.array(runs['latencies'])
+            p50 = float(np.percentile(latencies, 50))
+            results[scenario] = {
+                'runs': len(latencies),
+                'p50': p50,
+                'p95': float(np.percentile(latencies, 95)),
+                'p99': float(np.percentile(latencies, 99)),
+                'mean': float(latencies.mean()),
+                'rows_per_second': runs['rows'] / p50 if runs['rows'] and p50 else None,
+                'bytes_per_second': runs['size_bytes'] / p50 if runs['size_bytes'] and p50 else None,
+                'peak_memory_bytes': runs['peak_memory_bytes'],
+                'failed': runs['failed'],
+            }
+        return results
+
+
+def chart_query(schema):
+    """
+    Query string of the chart visualize_csv_data draws first for a schema.
+    """
+    numeric = [column for column, col_type in schema.items() if col_type in ('integer', 'float')]
+    if numeric:
+        return f'kind=series&column={numeric[0]}'
+    return f'kind=categories&column={next(iter(schema))}'
+
+
+def bench_dataset(path, mode, repeat, scenarios, warmup=1):
+    """
+    Upload, process, append to and read one CSV repeat times after warmup untimed repetitions,
+    returning the summary of each scenario.
+    Every repetition starts from an empty database, so identical uploads are not deduplicated.
+    """
+    client = Client()
+    file_size = os.path.getsize(path)
+
+    for repetition in range(warmup + repeat):
+        if repetition in (0, warmup):
+            recorder = Recorder()  # Starts over once the warm-up runs are done
+        uploaded_csv = None
+        try:
+            # Eager uploads would process the file within the request, it is timed on its own below
+            with recorder.measure('upload', size_bytes=file_size), open(path, 'rb') as file:
+                if mode == 'eager':
+                    with mock.patch.object(process_csv, 'delay'):
+                        client.post('/upload_csv/', {'file': file})
+                else:
+                    client.post('/upload_csv/', {'file': file})
+            uploaded_csv = UploadedCSV.objects.latest('id')
+
+            # With a broker, from the end of the upload until processed, so including the queue wait
+            with recorder.measure('process_csv', size_bytes=file_size):
+                if mode == 'eager':
+                    process_csv(uploaded_csv.id)
+                else:
+                    wait_for(lambda: UploadedCSV.objects.filter(
+                        id=uploaded_csv.id, status__in=['processed', 'failed_processing'],
+                    ).exists())
+            uploaded_csv.refresh_from_db()
+            if uploaded_csv.status != 'processed':
+                raise BenchmarkError(f"Processing {path} failed: {uploaded_csv.failure_reason}")
+            recorder.runs['upload']['rows'] = recorder.runs['process_csv']['rows'] = uploaded_csv.row_count
+
+            derived_csv = uploaded_csv.derived_csvs.get()
+            schema = uploaded_csv.schema
+            if 'apply_csv_changes' in scenarios:
+                csv_changes = CSVChanges.objects.create(
+                    content_type=ContentType.objects.get_for_model(uploaded_csv),
+                    object_id=uploaded_csv.id,
+                    data=uploaded_csv.rows[:APPEND_ROWS],
+                )
+                with recorder.measure('apply_csv_changes', rows=len(csv_changes.data)):
+                    apply_csv_changes.delay(csv_changes.id)
+                    wait_for(lambda: CSVChanges.objects.filter(id=csv_changes.id, status='processed').exists())
+
+            # Reads are measured uncached, the dataset cache is cleared before each one
+            reads = {
+                'view_csv': (f'/view_csv/{derived_csv.id}/derived/', 0),
+                'view_csv_rows': (f'/view_csv/{derived_csv.id}/derived/rows/?limit=100&sort={next(iter(schema))}&order=desc', derived_csv.row_count),
+                'download_csv': (f'/download_csv/{derived_csv.id}/derived/', derived_csv.row_count),
+                'visualize_csv': (f'/visualize_csv/{derived_csv.id}/?is_derived=1', 0),
+                'visualize_csv_data': (f'/visualize_csv/{derived_csv.id}/data/?is_derived=1&{chart_query(schema)}', derived_csv.row_count),
+            }
+            for scenario, (url, rows) in reads.items():
+                if scenario not in scenarios:
+                    continue
+                dataset_cache().clear()
+                with recorder.measure(scenario, rows=rows):
+                    response = client.get(url)
+                    size = len(b''.join(response.streaming_content)) if response.streaming else len(response.content)
+                if response.status_code != 200:
+                    raise BenchmarkError(f"{url} returned {response.status_code}.")
+                recorder.runs[scenario]['size_bytes'] = size
+        finally:
+            if uploaded_csv is not None:
+                CSVChanges.objects.filter(
+                    content_type=ContentType.objects.get_for_model(uploaded_csv), object_id=uploaded_csv.id,
+                ).delete()
+                uploaded_csv.delete()
+
+    return {scenario: summary for scenario, summary in recorder.summary().items() if scenario in scenarios}
+
+
+def process_in_thread(uploaded_csv_id):
+    try:
+        process_csv(uploaded_csv_id)
+    finally:
+        connection.close()  # Every thread opened its own
+
+
+def bench_concurrent_processing(paths, repeat, warmup=1):
+    """
+    Upload different CSVs, then run process_csv on all of them at the same time, one thread each,
+    repeat times after warmup untimed repetitions. The latency is the time until the last one is done
+    and the throughput counts the rows of all of them. Uploads whose processing failed, e.g. on a
+    locked SQLite database, are counted as failed.
+    """
+    client = Client()
+    size_bytes = sum(os.path.getsize(path) for path in paths)
+
+    for repetition in range(warmup + repeat):
+        if repetition in (0, warmup):
+            recorder = Recorder()
+        uploaded_csvs = []
+        try:
+            for path in paths:
+                with open(path, 'rb') as file, mock.patch.object(process_csv, 'delay'):
+                    client.post('/upload_csv/', {'file': file})
+                uploaded_csvs.append(UploadedCSV.objects.latest('id'))
+
+            with recorder.measure(CONCURRENT_SCENARIO, size_bytes=size_bytes):
+                with ThreadPoolExecutor(len(paths)) as executor:
+                    list(executor.map(process_in_thread, [uploaded_csv.id for uploaded_csv in uploaded_csvs]))
+
+            processed = UploadedCSV.objects.filter(id__in=[uploaded_csv.id for uploaded_csv in uploaded_csvs], status='processed')
+            runs = recorder.runs[CONCURRENT_SCENARIO]
+            runs['rows'] = sum(processed.values_list('row_count', flat=True))
+            runs['failed'] += len(uploaded_csvs) - processed.count()
+        finally:
+            for uploaded_csv in uploaded_csvs:
+                uploaded_csv.delete()
+
+    return recorder.summary()
+
+
+def environment_info(storage):
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'database': connection.vendor,
+        'storage': storage or settings.CSV_STORAGE_BACKEND,
+    }
+
+
+def run_benchmarks(directory, datasets=DATASETS, modes=MODES, scenarios=SCENARIOS, rows=10000, repeat=3, warmup=1,
+                   storage=None, concurrency=1, progress=None):
+    """
+    Run the scenarios on each dataset in each Celery mode, with generated CSVs of the given number
+    of rows kept in directory. Returns the results, keyed "<mode>/<dataset>/<scenario>".
+    With concurrency > 1, concurrency CSVs of each generated dataset are also processed at the same time.
+    """
+    results = {}
+    with benchmark_environment(directory, storage):
+        # Celery keeps the result backend it first connects to, the broker mode has to run first
+        for mode in sorted(modes, key=MODES.index):
+            with celery_mode(mode):
+                for dataset in datasets:
+                    path = dataset_path(dataset, rows, directory)
+                    if progress:
+                        progress(f"{mode}/{dataset}")
+                    for scenario, summary in bench_dataset(path, mode, repeat, scenarios, warmup).items():
+                        results[f'{mode}/{dataset}/{scenario}'] = summary
+                    # The fixture cannot be varied, identical uploads would reuse the first one's rows
+                    if concurrency > 1 and dataset != 'air_quality':
+                        paths = [dataset_path(dataset, rows, directory, seed) for seed in range(concurrency)]
+                        for scenario, summary in bench_concurrent_processing(paths, repeat, warmup).items():
+                            results[f'{mode}/{dataset}/{scenario}'] = summary
+
+    return {
+        'environment': environment_info(storage),
+        'parameters': {'rows': rows, 'repeat': repeat, 'warmup': warmup, 'append_rows': APPEND_ROWS, 'concurrency': concurrency},
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare the median latency of each scenario with a baseline run.
+    Returns (key, baseline p50, p50, ratio, regressed) for the scenarios in both, where regressed
+    means slower than the baseline by more than threshold (0.2 is 20%).
+    """
+    rows = []
+    for key, summary in results['results'].items():
+        base = baseline['results'].get(key)
+        if base is None or not base['p50']:
+            continue
+        ratio = summary['p50'] / base['p50']
+        rows.append((key, base['p50'], summary['p50'], ratio, ratio > 1 + threshold))
+    return rows
+
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_results(results, path):
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2)
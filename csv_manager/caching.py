@@ -0,0 +1,192 @@
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+
+CACHE_KINDS = ('page', 'export', 'chart', 'query', 'order')  # What is cached: rendered page fragments, CSV export bodies, chart aggregates, query results, table orderings
+PAGE_TEMPLATES = ('csv_manager/view_csv_content.html', 'csv_manager/visualize_csv_content.html')
+
+
+def dataset_cache():
+    """
+    The cache of dataset responses, the CSV_CACHE_ALIAS entry of CACHES.
+    """
+    return caches[settings.CSV_CACHE_ALIAS]
+
+
+def is_cacheable(csv_entry):
+    """
+    Whether the rows of a dataset are complete, so responses built from them can be cached.
+    """
+    uploaded_csv = getattr(csv_entry, 'parent', csv_entry)
+    return uploaded_csv.status == 'processed'
+
+
+def dataset_version(csv_entry):
+    """
+    Version of everything shown for a dataset, and the time it was last modified.
+    A DerivedCSV is shown with the name and schema of its UploadedCSV, so the version covers both:
+    reprocessing the UploadedCSV gives its derived CSVs new versions too.
+    """
+    stamps = [csv_entry.updated_at]
+    if hasattr(csv_entry, 'parent'):
+        stamps.append(csv_entry.parent.updated_at)
+    version = '-'.join([csv_entry._meta.model_name, str(csv_entry.pk)] + [str(int(stamp.timestamp() * 1e6)) for stamp in stamps])
+    return version, max(stamps)
+
+
+def cache_key(kind, csv_entry, *parts):
+    version, _ = dataset_version(csv_entry)
+    return ':'.join(['csv_cache', kind, version] + [str(part) for part in parts])
+
+
+def conditional_response(request, csv_entry, variant=''):
+    """
+    The ETag and Last-Modified headers of a response built from a dataset, and a 304 Not Modified
+    response when the request's If-None-Match or If-Modified-Since already match them, else None.
+    """
+    version, last_modified = dataset_version(csv_entry)
+    etag = f'"{version}-{variant}"' if variant else f'"{version}"'
+    headers = {'ETag': etag, 'Last-Modified': http_date(last_modified.timestamp())}
+    not_modified = get_conditional_response(request, etag=etag, last_modified=int(last_modified.timestamp()))
+    return headers, not_modified
+
+
+def record(kind, hit, seconds):
+    """
+    Count a cache hit or miss of the given kind and the time it took to answer.
+    """
+    cache = dataset_cache()
+    outcome = 'hit' if hit else 'miss'
+    for name, amount in (('count', 1), ('micros', int(seconds * 1e6))):
+        key = f'csv_cache_stats:{kind}:{outcome}:{name}'
+        cache.add(key, 0, None)
+        try:
+            cache.incr(key, amount)
+        except ValueError:
+            cache.set(key, amount, None)  # Evicted between add and incr
+
+
+def cache_stats():
+    """
+    Hits, misses, hit ratio and mean latency in milliseconds of hits and misses, per kind.
+    """
+    cache = dataset_cache()
+    keys = [
+        f'csv_cache_stats:{kind}:{outcome}:{name}'
+        for kind in CACHE_KINDS for outcome in ('hit', 'miss') for name in ('count', 'micros')
+    ]
+    values = cache.get_many(keys)
+    stats = {}
+    for kind in CACHE_KINDS:
+        counts = {outcome: values.get(f'csv_cache_stats:{kind}:{outcome}:count', 0) for outcome in ('hit', 'miss')}
+        micros = {outcome: values.get(f'csv_cache_stats:{kind}:{outcome}:micros', 0) for outcome in ('hit', 'miss')}
+        total = counts['hit'] + counts['miss']
+        stats[kind] = {
+            'hits': counts['hit'],
+            'misses': counts['miss'],
+            'hit_ratio': counts['hit'] / total if total else None,
+            'hit_ms': micros['hit'] / counts['hit'] / 1000 if counts['hit'] else None,
+            'miss_ms': micros['miss'] / counts['miss'] / 1000 if counts['miss'] else None,
+        }
+    return stats
+
+
+def cached(kind, csv_entry, key_parts, compute):
+    """
+    The value of compute() for a dataset, cached under its version and key_parts.
+    Datasets still being processed are computed every time.
+    """
+    if not is_cacheable(csv_entry):
+        return compute()
+
+    start = time.perf_counter()
+    cache = dataset_cache()
+    key = cache_key(kind, csv_entry, *key_parts)
+    value = cache.get(key)
+    hit = value is not None
+    if not hit:
+        value = compute()
+        cache.set(key, value)
+    record(kind, hit, time.perf_counter() - start)
+    return value
+
+
+def cached_page(template_name, csv_entry, context):
+    """
+    The rendered content of a dataset page. The page around it comes from base.html, with the
+    messages of the current user, and is rendered for every request.
+    """
+    return cached('page', csv_entry, [template_name], lambda: render_to_string(template_name, context))
+
+
+def cached_export(csv_entry, variant):
+    """
+    The cached body of a CSV export variant of a dataset, or None.
+    """
+    if not is_cacheable(csv_entry):
+        return None
+    start = time.perf_counter()
+    body = dataset_cache().get(cache_key('export', csv_entry, variant))
+    if body is not None:
+        record('export', True, time.perf_counter() - start)
+    return body
+
+
+def cached_export_length(csv_entry, variant):
+    """
+    The length in bytes of an export variant of a dataset, once it was streamed in full, or None.
+    """
+    if not is_cacheable(csv_entry):
+        return None
+    return dataset_cache().get(cache_key('export_length', csv_entry, variant))
+
+
+def cache_export(chunks, csv_entry, variant, keep_body=True):
+    """
+    Pass the byte chunks of an export through, caching its length once the stream completes, and
+    with keep_body the whole body when it is at most CSV_CACHE_MAX_EXPORT_BYTES long.
+    """
+    if not is_cacheable(csv_entry):
+        yield from chunks
+        return
+
+    start = time.perf_counter()
+    parts, size = [] if keep_body else None, 0
+    for chunk in chunks:
+        size += len(chunk)
+        if parts is not None:
+            if size <= settings.CSV_CACHE_MAX_EXPORT_BYTES:
+                parts.append(chunk)
+            else:
+                parts = None
+        yield chunk
+
+    cache = dataset_cache()
+    cache.set(cache_key('export_length', csv_entry, variant), size)
+    if parts is not None:
+        cache.set(cache_key('export', csv_entry, variant), b''.join(parts))
+    if keep_body:
+        record('export', False, time.perf_counter() - start)
+
+
+def invalidate(csv_entry):
+    """
+    Drop the cached pages and full exports, in every format, of the current version of a dataset,
+    and of the derived CSVs shown with an UploadedCSV. Chart aggregates and exports of selected rows
+    or columns, cached per request, are unreachable once the version changes and age out of the cache.
+    """
+    from .exports import EXPORT_VARIANTS  # Imported here, exports imports this module through table
+
+    datasets = [csv_entry]
+    if not hasattr(csv_entry, 'parent'):
+        datasets += list(csv_entry.derived_csvs.select_related('parent'))
+
+    keys = []
+    for dataset in datasets:
+        keys += [cache_key('page', dataset, template_name) for template_name in PAGE_TEMPLATES]
+        keys += [cache_key(kind, dataset, variant) for kind in ('export', 'export_length') for variant in EXPORT_VARIANTS]
+    dataset_cache().delete_many(keys)
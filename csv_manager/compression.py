@@ -0,0 +1,65 @@
+import gzip
+import json
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import zstandard
+except ImportError:  # Optional, only needed for the 'zstd' codec
+    zstandard = None
+
+
+CODECS = ('zstd', 'gzip', 'none')
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 6
+
+
+def check_codec(codec):
+    """
+    Raise ImproperlyConfigured for a codec that is unknown or whose library is not installed.
+    """
+    if codec not in CODECS:
+        raise ImproperlyConfigured(f"Unknown compression codec '{codec}', expected one of: {', '.join(CODECS)}.")
+    if codec == 'zstd' and zstandard is None:
+        raise ImproperlyConfigured("The 'zstd' compression codec needs zstandard to be installed.")
+
+
+def compress(data, codec):
+    check_codec(codec)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if codec == 'gzip':
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    return data
+
+
+def decompress(data, codec):
+    check_codec(codec)
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'gzip':
+        return gzip.decompress(data)
+    return bytes(data)
+
+
+def encode_block(columns, values, codec, key_dictionary):
+    """
+    Encode rows given as lists of values in column order as compressed JSON.
+    With key_dictionary the column names are stored once, as {"columns": [...], "rows": [[...], ...]};
+    without, every row is a JSON object, as in the CSVRow table.
+    """
+    if key_dictionary:
+        payload = {'columns': columns, 'rows': values}
+    else:
+        payload = [dict(zip(columns, row)) for row in values]
+    return compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'), codec)
+
+
+def decode_block(data, codec):
+    """
+    Decode a block written by encode_block, as (columns, rows): rows are lists of values in column
+    order for key-dictionary blocks, with columns listing their names, else row dicts with columns None.
+    """
+    payload = json.loads(decompress(data, codec))
+    if isinstance(payload, dict):
+        return payload['columns'], payload['rows']
+    return None, payload
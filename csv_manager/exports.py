@@ -0,0 +1,398 @@
+from asgiref.sync import sync_to_async
+from datetime import datetime
+from xml.sax.saxutils import escape
+import csv
+import io
+import json
+import math
+import re
+import zipfile
+import zlib
+import pandas as pd
+from .table import coerce_column, filter_mask
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Optional, only needed for Parquet exports
+    pa = None
+
+
+# Format parameter to (content type, file extension)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'csv.gz': ('application/gzip', 'csv.gz'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+}
+EXPORT_PARAMS = ('format', 'columns', 'start', 'stop')  # Not read as column filters
+CONTENT_ENCODED_FORMATS = ('csv', 'ndjson')  # Sent gzip encoded to clients that accept it, the others are compressed already
+XLSX_MAX_ROWS = 1048575  # Rows of a worksheet after the header
+
+
+class ExportError(ValueError):
+    """
+    Raised for export parameters that do not fit the dataset.
+    """
+
+
+def export_variant(export_format, gzip_encoded):
+    """
+    Name of the cached variant of a full export, also part of its ETag.
+    """
+    encoding = 'gzip' if gzip_encoded else 'identity'
+    return encoding if export_format == 'csv' else f'{export_format}-{encoding}'
+
+
+# Every cached variant of a full export of a dataset, see caching.invalidate
+EXPORT_VARIANTS = tuple(
+    export_variant(export_format, gzip_encoded)
+    for export_format in EXPORT_FORMATS
+    for gzip_encoded in ((False, True) if export_format in CONTENT_ENCODED_FORMATS else (False,))
+)
+
+
+def parse_export_query(params, schema, row_count):
+    """
+    Read the format, the columns (comma-separated, all by default) and the row index range
+    [start, stop) of an export from request parameters.
+    """
+    export_format = params.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        raise ExportError(f"Unknown format '{export_format}', expected one of: {', '.join(EXPORT_FORMATS)}.")
+    if export_format == 'parquet' and pa is None:
+        raise ExportError("Parquet exports need pyarrow to be installed.")
+
+    columns = None
+    if params.get('columns'):
+        columns = list(dict.fromkeys(column.strip() for column in params['columns'].split(',') if column.strip()))
+        unknown = [column for column in columns if column not in schema]
+        if unknown:
+            raise ExportError(f"Unknown columns: {', '.join(unknown)}.")
+
+    try:
+        start = int(params.get('start', 0))
+        stop = int(params['stop']) if params.get('stop') else row_count
+    except ValueError:
+        raise ExportError("start and stop must be integers.")
+    if start < 0 or stop < start:
+        raise ExportError("start must not be negative nor after stop.")
+    stop = min(stop, row_count)
+
+    if export_format == 'xlsx' and stop - start > XLSX_MAX_ROWS:
+        raise ExportError(f"A worksheet holds at most {XLSX_MAX_ROWS} rows, narrow the export with start and stop.")
+    return {'format': export_format, 'columns': columns, 'start': start, 'stop': stop}
+
+
+def iter_export(rows, schema, filters=(), columns=None, start=0, stop=None, export_format='csv'):
+    """
+    Yield an export of a dataset in one of EXPORT_FORMATS as byte chunks, see the iter_<format> functions.
+    """
+    if export_format == 'parquet':
+        return iter_parquet(rows, schema, filters, columns, start, stop)
+    if export_format == 'ndjson':
+        return iter_ndjson(rows, filters, schema, columns, start, stop)
+    if export_format == 'xlsx':
+        return iter_xlsx(rows, schema, filters, columns, start, stop)
+    chunks = iter_csv(rows, filters, schema, columns, start, stop)
+    return gzip_chunks(chunks) if export_format == 'csv.gz' else chunks
+
+
+def iter_selected(rows, filters=(), schema=None, start=0, stop=None):
+    """
+    Yield the rows in [start, stop) that pass the filters, as lists of row dicts per batch read from
+    the row store. Only the blocks whose zone maps allow a match are read.
+    """
+    filter_columns = list(dict.fromkeys(column for column, _, _ in filters))
+    for batch in rows.iter_batches(start, stop, where=filters):
+        if filters:
+            mask = filter_mask(pd.DataFrame.from_records(batch, columns=filter_columns), schema, filters)
+            batch = [row for row, passes in zip(batch, mask) if passes]
+        yield batch
+
+
+def iter_csv(rows, filters=(), schema=None, columns=None, start=0, stop=None):
+    """
+    Yield a dataset as UTF-8 encoded CSV, one chunk per batch of rows read from the row store.
+    With filters, as table.parse_filters gives them, only the rows that pass are written, and only
+    the blocks whose zone maps allow a match are read. columns and [start, stop) narrow the export.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    if not rows:
+        return
+    writer.writerow(columns or rows.columns)
+
+    for batch in iter_selected(rows, filters, schema, start, stop):
+        if columns is None:
+            writer.writerows(row.values() for row in batch)
+        else:
+            writer.writerows([row.get(column) for column in columns] for row in batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def iter_ndjson(rows, filters=(), schema=None, columns=None, start=0, stop=None):
+    """
+    Yield a dataset as newline-delimited JSON, one object per row with the values as stored.
+    """
+    for batch in iter_selected(rows, filters, schema, start, stop):
+        if columns is not None:
+            batch = [{column: row.get(column) for column in columns} for row in batch]
+        lines = [json.dumps(row, separators=(',', ':')) for row in batch]
+        if lines:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class ChunkSink(io.RawIOBase):
+    """
+    Write-only file that keeps what is written until it is drained, so that writers which
+    expect a file can be streamed.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def parquet_schema(schema, columns):
+    types = {
+        'integer': pa.int64(), 'float': pa.float64(), 'boolean': pa.bool_(),
+        'datetime': pa.timestamp('us'), 'date': pa.date32(),
+    }
+    return pa.schema([(column, types.get(schema[column], pa.string())) for column in columns])
+
+
+def iter_parquet(rows, schema, filters=(), columns=None, start=0, stop=None):
+    """
+    Yield a dataset as Parquet with column types from the schema, one row group per batch of
+    CSV_FRAME_BATCH_SIZE rows, each written out as soon as it is encoded.
+    """
+    columns = columns or list(schema)
+    read_columns = list(dict.fromkeys(columns + [column for column, _, _ in filters]))
+    arrow_schema = parquet_schema(schema, columns)
+    sink = ChunkSink()
+
+    writer = pq.ParquetWriter(sink, arrow_schema)
+    for df in rows.iter_frames(read_columns, start, stop, where=filters):
+        if filters:
+            df = df[filter_mask(df, schema, filters)]
+        arrays = []
+        for column, field in zip(columns, arrow_schema):
+            series = coerce_column(df[column], schema[column])
+            if pa.types.is_date32(field.type):
+                arrays.append(pa.array(series, type=pa.timestamp('us'), from_pandas=True).cast(field.type))
+            else:
+                arrays.append(pa.array(series, type=field.type, from_pandas=True))
+        writer.write_table(pa.Table.from_arrays(arrays, schema=arrow_schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '</Relationships>'
+    ),
+    # Cell styles 1 and 2 show datetimes and dates, which are stored as day numbers
+    'xl/styles.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<numFmts count="2"><numFmt numFmtId="164" formatCode="yyyy-mm-dd hh:mm:ss"/><numFmt numFmtId="165" formatCode="yyyy-mm-dd"/></numFmts>'
+        '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="3"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'
+    ),
+}
+XLSX_SHEET_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+)
+XLSX_SHEET_END = '</sheetData></worksheet>'
+XLSX_EPOCH = datetime(1899, 12, 30)
+XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def xlsx_text(value):
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{escape(XML_ILLEGAL.sub("", str(value)))}</t></is></c>'
+
+
+def xlsx_number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        return xlsx_text(value)
+    return f'<c><v>{value!r}</v></c>'
+
+
+def xlsx_boolean(value):
+    if not isinstance(value, bool):
+        return xlsx_text(value)
+    return f'<c t="b"><v>{int(value)}</v></c>'
+
+
+def xlsx_time(style):
+    """
+    Cell writer for datetimes or dates stored as ISO text, as day numbers shown with the given style.
+    """
+    def cell(value):
+        try:
+            days = (datetime.fromisoformat(value) - XLSX_EPOCH).total_seconds() / 86400
+        except (TypeError, ValueError):
+            return xlsx_text(value)
+        return f'<c s="{style}"><v>{days!r}</v></c>'
+    return cell
+
+
+XLSX_CELLS = {'integer': xlsx_number, 'float': xlsx_number, 'boolean': xlsx_boolean, 'datetime': xlsx_time(1), 'date': xlsx_time(2)}
+
+
+def iter_xlsx(rows, schema, filters=(), columns=None, start=0, stop=None):
+    """
+    Yield a dataset as an XLSX workbook of one worksheet, with numbers, booleans, datetimes and dates
+    as typed cells and the rest as inline strings. The package is zipped as it is written, the
+    worksheet one batch of rows at a time.
+    """
+    columns = columns or list(schema)
+    cells = [XLSX_CELLS.get(schema[column], xlsx_text) for column in columns]
+    sink = ChunkSink()
+
+    # A fixed timestamp makes the same export the same bytes, for byte ranges and caching
+    def entry(name):
+        info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+        info.compress_type = zipfile.ZIP_DEFLATED
+        return info
+
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as package:
+        for name, content in XLSX_PARTS.items():
+            package.writestr(entry(name), content)
+
+        with package.open(entry('xl/worksheets/sheet1.xml'), 'w') as sheet:
+            header = ''.join(xlsx_text(column) for column in columns)
+            sheet.write(f'{XLSX_SHEET_START}<row>{header}</row>'.encode('utf-8'))
+            for batch in iter_selected(rows, filters, schema, start, stop):
+                lines = []
+                for row in batch:
+                    values = [row.get(column) for column in columns]
+                    lines.append('<row>' + ''.join(
+                        '<c/>' if value is None or value == '' else cell(value) for cell, value in zip(cells, values)
+                    ) + '</row>')
+                sheet.write(''.join(lines).encode('utf-8'))
+                yield sink.drain()
+            sheet.write(XLSX_SHEET_END.encode('utf-8'))
+    yield sink.drain()
+
+
+def gzip_chunks(chunks):
+    """
+    Compress a stream of byte chunks into a single gzip member, chunk by chunk.
+    """
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def slice_chunks(chunks, start, stop):
+    """
+    Yield only the bytes in [start, stop) of a stream of byte chunks.
+    """
+    position = 0
+    for chunk in chunks:
+        chunk_start, position = position, position + len(chunk)
+        if position <= start:
+            continue
+        if chunk_start >= stop:
+            break
+        yield chunk[max(start - chunk_start, 0):stop - chunk_start]
+
+
+def parse_range(header, length):
+    """
+    Parse a single-range "bytes=start-end" Range header against a body of the given length.
+    Returns the (start, stop) byte slice, or None when the range cannot be satisfied.
+    Raises ValueError for headers that are not a single byte range, which are then ignored.
+    """
+    match = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*', header)
+    if not match or match.groups() == ('', ''):
+        raise ValueError(f"Unsupported Range header: {header}")
+
+    first, last = match.groups()
+    if first == '':
+        # Suffix range, the last N bytes
+        start, stop = max(length - int(last), 0), length
+    else:
+        start = int(first)
+        stop = min(int(last) + 1, length) if last else length
+
+    if start >= stop:
+        return None
+    return start, stop
+
+
+async def aiter_chunks(chunks):
+    """
+    Iterate a blocking stream of byte chunks from async code.
+    Each chunk is produced off the event loop in the request's sync thread (thread_sensitive), the one
+    thread that holds the request's database connection and server-side cursor, and closes the
+    connection when the request finishes. The stream is closed when iteration stops early.
+    """
+    chunks = iter(chunks)
+    next_chunk = sync_to_async(next)
+    try:
+        while (chunk := await next_chunk(chunks, None)) is not None:
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            await sync_to_async(chunks.close)()
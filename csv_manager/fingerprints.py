@@ -0,0 +1,43 @@
+import hashlib
+import json
+
+
+def file_hash(file):
+    """
+    SHA-256 hex digest of the bytes of a Django File, read chunk by chunk.
+    """
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def derivation_hash(*parts):
+    """
+    SHA-256 hex digest of the JSON-serializable parts a derived body is made from.
+
+    Datasets are immutable once written and transforms are deterministic, so derived bodies made
+    the same way from the same inputs are identical: the digest of the inputs fingerprints the body
+    without reading it.
+    """
+    payload = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def transformed_hash(source_hash, transform):
+    """
+    Fingerprint of the body a TransformPipeline derives from the dataset with the source_hash fingerprint.
+    Datasets written before fingerprinting have none, and neither do their derived bodies.
+    """
+    if not source_hash:
+        return ''
+    return derivation_hash('transform', source_hash, transform.steps)
+
+
+def appended_hash(source_hash, rows):
+    """
+    Fingerprint of the body made of the dataset with the source_hash fingerprint followed by rows.
+    """
+    if not source_hash:
+        return ''
+    return derivation_hash('append', source_hash, rows)
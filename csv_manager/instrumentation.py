@@ -0,0 +1,297 @@
+import asyncio
+import functools
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from django.utils import timezone
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, peak memory is then not recorded
+    resource = None
+
+
+logger = logging.getLogger('csv_manager.runs')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)  # Seconds
+
+_current_run = ContextVar('csv_manager_run', default=None)
+
+# Whether the process runs one task at a time, so that its peak memory is the peak of the current run.
+# Set in the child processes of the prefork pool, see signals.py
+_exclusive_process = False
+
+
+class Run:
+    """
+    Timings and counts of one run of a background task.
+
+    Stages nest: the time of a stage excludes the stages entered inside it, so the stage times of
+    a run add up to at most its duration and each second is attributed once.
+    """
+    def __init__(self, task):
+        self.task = task
+        self.dataset = None
+        self.error = None
+        self.stages = {}
+        self.row_count = 0
+        self.size_bytes = 0
+        self.queue_wait = None
+        self.peak_memory_bytes = None
+        self._stack = []  # [name, start, time spent in nested stages] of the open stages
+        self.started_at = timezone.now()
+        self._start = time.perf_counter()
+        self.duration = None
+
+    def enter(self, name):
+        self._stack.append([name, time.perf_counter(), 0.0])
+
+    def exit(self):
+        name, start, nested = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self.stages[name] = self.stages.get(name, 0.0) + elapsed - nested
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+        self.peak_memory_bytes = peak_memory()
+
+    def as_dict(self):
+        return {
+            'task': self.task,
+            'dataset': f'{self.dataset._meta.model_name}:{self.dataset.pk}' if self.dataset is not None else None,
+            'status': 'failed' if self.error else 'succeeded',
+            'error': self.error,
+            'started_at': self.started_at.isoformat(),
+            'duration': round(self.duration, 6),
+            'queue_wait': round(self.queue_wait, 6) if self.queue_wait is not None else None,
+            'row_count': self.row_count,
+            'size_bytes': self.size_bytes,
+            'peak_memory_bytes': self.peak_memory_bytes,
+            'stages': {name: round(seconds, 6) for name, seconds in self.stages.items()},
+        }
+
+    def save(self):
+        """
+        Record the run as a ProcessingRun and log it as one JSON line.
+        """
+        from .models import ProcessingRun
+
+        record = self.as_dict()
+        logger.info(json.dumps(record))
+        try:
+            ProcessingRun.objects.create(
+                task=self.task,
+                dataset=self.dataset,
+                status=record['status'],
+                error=self.error,
+                started_at=self.started_at,
+                duration=self.duration,
+                queue_wait=self.queue_wait,
+                row_count=self.row_count,
+                size_bytes=self.size_bytes,
+                peak_memory_bytes=self.peak_memory_bytes,
+                stages=record['stages'],
+            )
+        except Exception:
+            logger.exception("Could not record the %s run", self.task)
+
+
+@contextmanager
+def stage(name):
+    """
+    Attribute the time spent in the block to a stage of the current run. Does nothing outside a run.
+    """
+    run = _current_run.get()
+    if run is None:
+        yield
+        return
+    run.enter(name)
+    try:
+        yield
+    finally:
+        run.exit()
+
+
+def timed_iter(name, iterable):
+    """
+    Iterate, attributing the time spent producing each item to a stage of the current run.
+    """
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+
+def record_dataset(dataset):
+    """
+    Set the dataset the current run works on.
+    """
+    run = _current_run.get()
+    if run is not None:
+        run.dataset = dataset
+
+
+def count(row_count=0, size_bytes=0):
+    """
+    Add to the rows and bytes handled by the current run.
+    """
+    run = _current_run.get()
+    if run is not None:
+        run.row_count += row_count
+        run.size_bytes += size_bytes
+
+
+def record_failure(error):
+    """
+    Mark the current run as failed, for tasks that handle their errors instead of raising them.
+    """
+    run = _current_run.get()
+    if run is not None:
+        run.error = str(error)
+
+
+def run_exclusively():
+    """
+    Mark the process as running one task at a time, instrumented runs then reset its peak memory.
+    """
+    global _exclusive_process
+    _exclusive_process = True
+
+
+def reset_peak_memory():
+    """
+    Reset the resident memory high-water mark of the process, where the kernel allows it.
+
+    The mark belongs to the whole process, so a reset in one thread would hide the memory of every
+    other task running in it. Instrumented runs only reset it under the prefork pool: under the
+    thread, gevent, eventlet and solo pools, runs report the peak of the worker since it started.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def peak_memory():
+    """
+    High-water mark of the resident memory of the process in bytes, since the last reset_peak_memory
+    on Linux and since the process started elsewhere. None when it cannot be read.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Kilobytes on Linux, bytes on macOS
+
+
+def queue_wait(started):
+    """
+    Seconds the current Celery task waited between being published and starting, not counting a
+    countdown or ETA it was scheduled with. None for tasks called directly or eagerly.
+    """
+    from celery import current_task
+
+    request = getattr(current_task, 'request', None)
+    enqueued_at = getattr(request, 'enqueued_at', None) or (getattr(request, 'headers', None) or {}).get('enqueued_at')
+    if request is None or request.called_directly or enqueued_at is None:
+        return None
+    ready_at = enqueued_at
+    if request.eta:
+        ready_at = max(ready_at, datetime.fromisoformat(request.eta).timestamp())
+    return max(started - ready_at, 0.0)
+
+
+def instrumented(task):
+    """
+    Decorator recording every call of a background task as a run, see Run.
+    The run is saved as a ProcessingRun whether the task succeeds or raises.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            run = Run(task)
+            run.queue_wait = queue_wait(time.time())
+            if _exclusive_process:
+                reset_peak_memory()
+            token = _current_run.set(run)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                run.error = str(e)
+                raise
+            finally:
+                _current_run.reset(token)
+                run.finish()
+                run.save()
+        return wrapper
+    return decorator
+
+
+class Histogram:
+    """
+    In-process Prometheus histogram with one label.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}  # Label value: [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, label, value):
+        with self._lock:
+            counts, total, observations = self.series.get(label) or ([0] * len(self.buckets), 0.0, 0)
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+            self.series[label] = (counts, total + value, observations + 1)
+
+    def snapshot(self):
+        with self._lock:
+            return {label: (list(counts), total, observations) for label, (counts, total, observations) in self.series.items()}
+
+
+view_durations = Histogram(DURATION_BUCKETS)
+
+
+def timed_view(view):
+    """
+    Decorator recording the duration of a view, sync or async, in view_durations.
+    Streaming responses are timed until the response starts.
+    """
+    def observe(start):
+        elapsed = time.perf_counter() - start
+        view_durations.observe(view.__name__, elapsed)
+        logger.debug(json.dumps({'view': view.__name__, 'duration': round(elapsed, 6)}))
+
+    if asyncio.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await view(*args, **kwargs)
+            finally:
+                observe(start)
+        return async_wrapper
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            observe(start)
+    return wrapper
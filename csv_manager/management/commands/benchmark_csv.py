@@ -0,0 +1,76 @@
+import os
+import tempfile
+from django.core.management.base import BaseCommand, CommandError
+from csv_manager import benchmarks
+
+
+def choices(value, allowed):
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = set(names) - set(allowed)
+    if unknown:
+        raise CommandError(f"Unknown {', '.join(sorted(unknown))}, choose from {', '.join(allowed)}.")
+    return names
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark uploading, processing, appending to and reading CSVs on a throwaway database, "
+        "save the results as JSON and compare them with a baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--datasets', default=','.join(benchmarks.DATASETS), help="Comma-separated datasets to run.")
+        parser.add_argument('--modes', default=','.join(benchmarks.MODES), help="Comma-separated Celery modes: memory, eager.")
+        parser.add_argument('--scenarios', default=','.join(benchmarks.SCENARIOS), help="Comma-separated scenarios to record.")
+        parser.add_argument('--rows', type=int, default=10000, help="Rows of the generated datasets.")
+        parser.add_argument('--repeat', type=int, default=3, help="Runs of each scenario.")
+        parser.add_argument('--warmup', type=int, default=1, help="Untimed runs of each dataset before the timed ones.")
+        parser.add_argument('--storage', choices=['rows', 'arrow', 'compressed'], help="Storage backend, CSV_STORAGE_BACKEND by default.")
+        parser.add_argument(
+            '--concurrency', type=int, default=1,
+            help="Also process this many different CSVs of each generated dataset at the same time, one thread each.",
+        )
+        parser.add_argument('--data-dir', help="Directory for the generated CSVs, kept between runs. A temporary one by default.")
+        parser.add_argument('--output', default='benchmark-results.json', help="File to save the results to.")
+        parser.add_argument('--baseline', help="Results file to compare with.")
+        parser.add_argument('--threshold', type=float, default=0.2, help="Slowdown of the median latency reported as a regression, 0.2 is 20%%.")
+
+    def handle(self, *args, **options):
+        datasets = choices(options['datasets'], benchmarks.DATASETS)
+        modes = choices(options['modes'], benchmarks.MODES)
+        scenarios = choices(options['scenarios'], benchmarks.SCENARIOS)
+        baseline = benchmarks.load_results(options['baseline']) if options['baseline'] else None
+
+        with tempfile.TemporaryDirectory() as directory:
+            data_dir = options['data_dir'] or directory
+            os.makedirs(data_dir, exist_ok=True)
+            results = benchmarks.run_benchmarks(
+                data_dir, datasets, modes, scenarios, rows=options['rows'], repeat=options['repeat'],
+                warmup=options['warmup'],
+                storage=options['storage'], concurrency=options['concurrency'], progress=lambda name: self.stderr.write(f"Running {name}..."),
+            )
+        benchmarks.save_results(results, options['output'])
+
+        self.stdout.write(f"{'scenario':48} {'p50 ms':>10} {'p95 ms':>10} {'rows/s':>12} {'peak MB':>9}")
+        for key, summary in results['results'].items():
+            rows_per_second = f"{summary['rows_per_second']:.0f}" if summary['rows_per_second'] else '-'
+            self.stdout.write(
+                f"{key:48} {summary['p50'] * 1000:10.1f} {summary['p95'] * 1000:10.1f} "
+                f"{rows_per_second:>12} {summary['peak_memory_bytes'] / 2**20:9.0f}"
+            )
+        for key, summary in results['results'].items():
+            if summary['failed']:
+                self.stdout.write(self.style.WARNING(f"{key}: {summary['failed']} tasks failed."))
+        self.stdout.write(f"Results saved to {options['output']}.")
+
+        if baseline is None:
+            return
+        regressions = 0
+        self.stdout.write(f"\n{'scenario':48} {'base ms':>10} {'p50 ms':>10} {'change':>8}")
+        for key, base_p50, p50, ratio, regressed in benchmarks.compare(results, baseline, options['threshold']):
+            line = f"{key:48} {base_p50 * 1000:10.1f} {p50 * 1000:10.1f} {ratio - 1:+8.0%}"
+            self.stdout.write(self.style.ERROR(line) if regressed else line)
+            regressions += regressed
+        if regressions:
+            raise CommandError(f"{regressions} scenarios are more than {options['threshold']:.0%} slower than the baseline.")
+        self.stdout.write(self.style.SUCCESS(f"No scenario is more than {options['threshold']:.0%} slower than the baseline."))
@@ -0,0 +1,116 @@
+from django.db.models import Count, F, FloatField, Max, Q, Sum
+from django.db.models.functions import Cast
+from .models import ProcessingRun
+from .instrumentation import DURATION_BUCKETS, view_durations
+
+
+THROUGHPUT_BUCKETS = (100, 1000, 10000, 50000, 100000, 250000, 500000, 1000000, 2500000)  # Rows per second
+
+
+def format_labels(labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+def format_histogram(name, help_text, series, buckets):
+    """
+    Lines of a Prometheus histogram, from (labels, cumulative bucket counts, sum, count) per series.
+    """
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+    for labels, counts, total, observations in series:
+        for bound, bucket_count in zip(buckets, counts):
+            lines.append(f'{name}_bucket{format_labels(dict(labels, le=bound))} {bucket_count}')
+        lines.append(f'{name}_bucket{format_labels(dict(labels, le="+Inf"))} {observations}')
+        lines.append(f'{name}_sum{format_labels(labels)} {total}')
+        lines.append(f'{name}_count{format_labels(labels)} {observations}')
+    return lines
+
+
+def run_histogram(queryset, value, labels, buckets):
+    """
+    Histogram series of a value over ProcessingRuns, grouped by the label fields, counted by the database.
+    """
+    buckets_counts = {f'le_{position}': Count('id', filter=Q(value__lte=bound)) for position, bound in enumerate(buckets)}
+    rows = (
+        queryset.annotate(value=value).filter(value__isnull=False)
+        .values(*labels).annotate(observations=Count('id'), total=Sum('value'), **buckets_counts)
+        .order_by(*labels)
+    )
+    return [
+        (
+            {label: row[label] for label in labels},
+            [row[f'le_{position}'] for position in range(len(buckets))],
+            row['total'],
+            row['observations'],
+        )
+        for row in rows
+    ]
+
+
+def task_metrics():
+    """
+    Metrics of the background tasks, from the ProcessingRuns recorded by all workers over the last
+    CSV_RUN_RETENTION_DAYS days. Totals drop when older runs are purged, which Prometheus takes as
+    a counter reset.
+    """
+    runs = ProcessingRun.objects.all()
+    lines = format_histogram(
+        'csv_task_duration_seconds', 'Duration of background CSV tasks.',
+        run_histogram(runs, F('duration'), ['task', 'status'], DURATION_BUCKETS), DURATION_BUCKETS,
+    )
+    lines += format_histogram(
+        'csv_task_queue_wait_seconds', 'Time background CSV tasks waited in the queue before starting.',
+        run_histogram(runs, F('queue_wait'), ['task'], DURATION_BUCKETS), DURATION_BUCKETS,
+    )
+    lines += format_histogram(
+        'csv_task_throughput_rows_per_second', 'Rows processed per second by background CSV tasks.',
+        run_histogram(
+            runs.filter(row_count__gt=0, duration__gt=0),
+            Cast('row_count', FloatField()) / F('duration'), ['task'], THROUGHPUT_BUCKETS,
+        ),
+        THROUGHPUT_BUCKETS,
+    )
+
+    totals = runs.values('task').annotate(
+        row_count=Sum('row_count'), size_bytes=Sum('size_bytes'), peak_memory_bytes=Max('peak_memory_bytes'),
+    ).order_by('task')
+    for name, field, kind, help_text in [
+        ('csv_task_rows_total', 'row_count', 'counter', 'Rows processed by background CSV tasks.'),
+        ('csv_task_bytes_total', 'size_bytes', 'counter', 'Bytes read or stored by background CSV tasks.'),
+        ('csv_task_peak_memory_bytes', 'peak_memory_bytes', 'gauge', 'Highest resident memory reached during a run of a task.'),
+    ]:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        lines += [f'{name}{format_labels({"task": row["task"]})} {row[field] or 0}' for row in totals]
+
+    # Stage times are JSON per run, added up here
+    stage_seconds = {}
+    for task, stages in runs.values_list('task', 'stages').iterator():
+        for stage_name, seconds in (stages or {}).items():
+            stage_seconds[task, stage_name] = stage_seconds.get((task, stage_name), 0.0) + seconds
+    lines += ['# HELP csv_task_stage_seconds_total Time background CSV tasks spent in each stage.',
+              '# TYPE csv_task_stage_seconds_total counter']
+    lines += [
+        f'csv_task_stage_seconds_total{format_labels({"task": task, "stage": stage_name})} {seconds}'
+        for (task, stage_name), seconds in sorted(stage_seconds.items())
+    ]
+    return lines
+
+
+def view_metrics():
+    """
+    Metrics of the read views served by this process.
+    """
+    series = [
+        ({'view': view}, counts, total, observations)
+        for view, (counts, total, observations) in sorted(view_durations.snapshot().items())
+    ]
+    return format_histogram(
+        'csv_view_duration_seconds', 'Duration of the dataset read views, until the response starts.',
+        series, DURATION_BUCKETS,
+    )
+
+
+def render_metrics():
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    return '\n'.join(task_metrics() + view_metrics()) + '\n'
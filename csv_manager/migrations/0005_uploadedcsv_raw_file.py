@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csv_manager', '0004_uploadedcsv_failure_reason_alter_uploadedcsv_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedcsv',
+            name='raw_file',
+            field=models.FileField(blank=True, null=True, upload_to='uploads/'),
+        ),
+        migrations.AlterField(
+            model_name='uploadedcsv',
+            name='content',
+            field=models.JSONField(default=list),
+        ),
+    ]
@@ -0,0 +1,103 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:55
+
+import json
+
+import django.db.models.deletion
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+
+
+BATCH_SIZE = 2000
+
+
+def move_content_to_rows(apps, schema_editor):
+    """
+    Copy the JSON content of every dataset into CSVRow, and spool raw CSVs of
+    uploads that were never processed to storage so process_csv can read them.
+    """
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    CSVRow = apps.get_model('csv_manager', 'CSVRow')
+
+    for model_name in ('uploadedcsv', 'derivedcsv'):
+        model = apps.get_model('csv_manager', model_name)
+        content_type, _ = ContentType.objects.get_or_create(app_label='csv_manager', model=model_name)
+
+        for dataset in model.objects.iterator():
+            content = dataset.content
+            if isinstance(content, str):
+                # Unprocessed upload, content is the raw CSV string stored as JSON
+                raw_csv = json.loads(content)
+                dataset.raw_file = default_storage.save(f'uploads/{dataset.name}', ContentFile(raw_csv.encode('utf-8')))
+                dataset.save()
+                continue
+
+            rows = [
+                CSVRow(content_type=content_type, object_id=dataset.pk, row_index=index, data=row)
+                for index, row in enumerate(content or [])
+            ]
+            CSVRow.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+            dataset.row_count = len(rows)
+            dataset.save()
+
+
+def move_rows_to_content(apps, schema_editor):
+    CSVRow = apps.get_model('csv_manager', 'CSVRow')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+
+    for model_name in ('uploadedcsv', 'derivedcsv'):
+        model = apps.get_model('csv_manager', model_name)
+        content_type, _ = ContentType.objects.get_or_create(app_label='csv_manager', model=model_name)
+
+        for dataset in model.objects.iterator():
+            rows = CSVRow.objects.filter(content_type=content_type, object_id=dataset.pk).order_by('row_index')
+            dataset.content = list(rows.values_list('data', flat=True))
+            dataset.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('csv_manager', '0005_uploadedcsv_raw_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='derivedcsv',
+            name='row_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='uploadedcsv',
+            name='row_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='CSVRow',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('row_index', models.PositiveIntegerField()),
+                ('data', models.JSONField()),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('content_type', 'object_id', 'row_index'), name='unique_csv_row')],
+            },
+        ),
+        migrations.RunPython(move_content_to_rows, move_rows_to_content),
+        migrations.AlterField(
+            model_name='derivedcsv',
+            name='content',
+            field=models.JSONField(default=list),
+        ),
+        migrations.RemoveField(
+            model_name='derivedcsv',
+            name='content',
+        ),
+        migrations.RemoveField(
+            model_name='uploadedcsv',
+            name='content',
+        ),
+    ]
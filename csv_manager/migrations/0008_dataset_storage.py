@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:27
+
+import csv_manager.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csv_manager', '0007_dataset_base'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='derivedcsv',
+            name='data_path',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        # Existing datasets keep their rows in the CSVRow table whatever the setting says
+        migrations.AddField(
+            model_name='derivedcsv',
+            name='storage',
+            field=models.CharField(choices=[('rows', 'CSVRow table'), ('arrow', 'Arrow IPC files')], default='rows', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='derivedcsv',
+            name='storage',
+            field=models.CharField(choices=[('rows', 'CSVRow table'), ('arrow', 'Arrow IPC files')], default=csv_manager.storage.default_backend, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='uploadedcsv',
+            name='data_path',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        # Existing datasets keep their rows in the CSVRow table whatever the setting says
+        migrations.AddField(
+            model_name='uploadedcsv',
+            name='storage',
+            field=models.CharField(choices=[('rows', 'CSVRow table'), ('arrow', 'Arrow IPC files')], default='rows', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='uploadedcsv',
+            name='storage',
+            field=models.CharField(choices=[('rows', 'CSVRow table'), ('arrow', 'Arrow IPC files')], default=csv_manager.storage.default_backend, max_length=10),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:47
+
+import glob
+import os
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+from django.db.models import Sum, TextField
+from django.db.models.functions import Cast, Length
+
+
+def fill_size_bytes(apps, schema_editor):
+    """
+    Record the size of the rows every existing dataset stores: JSON text in CSVRow, or Arrow files.
+    """
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    CSVRow = apps.get_model('csv_manager', 'CSVRow')
+
+    for model_name in ('uploadedcsv', 'derivedcsv'):
+        model = apps.get_model('csv_manager', model_name)
+        content_type, _ = ContentType.objects.get_or_create(app_label='csv_manager', model=model_name)
+
+        sizes = dict(
+            CSVRow.objects.filter(content_type=content_type)
+            .values('object_id')
+            .annotate(size=Sum(Length(Cast('data', TextField()))))
+            .values_list('object_id', 'size')
+        )
+        for dataset in model.objects.iterator():
+            if dataset.storage == 'arrow' and dataset.data_path:
+                paths = glob.glob(os.path.join(default_storage.path(dataset.data_path), 'part-*.arrow'))
+                dataset.size_bytes = sum(os.path.getsize(path) for path in paths)
+            else:
+                dataset.size_bytes = sizes.get(dataset.pk) or 0
+            dataset.save(update_fields=['size_bytes'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('csv_manager', '0008_dataset_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='derivedcsv',
+            name='size_bytes',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='uploadedcsv',
+            name='size_bytes',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_size_bytes, migrations.RunPython.noop),
+    ]
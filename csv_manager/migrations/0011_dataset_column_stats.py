@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csv_manager', '0010_dataset_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='derivedcsv',
+            name='column_sketches',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='derivedcsv',
+            name='column_stats',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadedcsv',
+            name='column_sketches',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadedcsv',
+            name='column_stats',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
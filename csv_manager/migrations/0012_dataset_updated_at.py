@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csv_manager', '0011_dataset_column_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='derivedcsv',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='uploadedcsv',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
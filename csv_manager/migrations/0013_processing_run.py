@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('csv_manager', '0012_dataset_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessingRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(db_index=True, max_length=50)),
+                ('object_id', models.PositiveIntegerField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('succeeded', 'Succeeded'), ('failed', 'Failed')], default='succeeded', max_length=20)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('started_at', models.DateTimeField()),
+                ('duration', models.FloatField()),
+                ('queue_wait', models.FloatField(blank=True, null=True)),
+                ('row_count', models.PositiveBigIntegerField(default=0)),
+                ('size_bytes', models.PositiveBigIntegerField(default=0)),
+                ('peak_memory_bytes', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('stages', models.JSONField(default=dict)),
+                ('content_type', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='contenttypes.contenttype')),
+            ],
+        ),
+    ]
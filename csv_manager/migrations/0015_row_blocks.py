@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('csv_manager', '0014_processing_checkpoints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RowBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('start', models.PositiveIntegerField()),
+                ('stop', models.PositiveIntegerField()),
+                ('bounds', models.JSONField()),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('content_type', 'object_id', 'start'), name='unique_row_block')],
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:23
+
+import csv_manager.storage
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('csv_manager', '0015_row_blocks'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='derivedcsv',
+            name='storage',
+            field=models.CharField(choices=[('rows', 'CSVRow table'), ('arrow', 'Arrow IPC files'), ('compressed', 'Compressed JSON blocks')], default=csv_manager.storage.default_backend, max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='uploadedcsv',
+            name='storage',
+            field=models.CharField(choices=[('rows', 'CSVRow table'), ('arrow', 'Arrow IPC files'), ('compressed', 'Compressed JSON blocks')], default=csv_manager.storage.default_backend, max_length=10),
+        ),
+        migrations.CreateModel(
+            name='CompressedRows',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('start', models.PositiveIntegerField()),
+                ('stop', models.PositiveIntegerField()),
+                ('codec', models.CharField(max_length=10)),
+                ('data', models.BinaryField()),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('content_type', 'object_id', 'start'), name='unique_compressed_rows')],
+            },
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:36
+
+import csv_manager.models
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csv_manager', '0016_compressed_rows'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='csvchanges',
+            name='data',
+            field=csv_manager.models.OrderedJSONField(),
+        ),
+        migrations.AlterField(
+            model_name='csvrow',
+            name='data',
+            field=csv_manager.models.OrderedJSONField(),
+        ),
+        migrations.AlterField(
+            model_name='derivedcsv',
+            name='column_stats',
+            field=csv_manager.models.OrderedJSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='uploadedcsv',
+            name='checkpoint',
+            field=csv_manager.models.OrderedJSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='uploadedcsv',
+            name='column_stats',
+            field=csv_manager.models.OrderedJSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='uploadedcsv',
+            name='schema',
+            field=csv_manager.models.OrderedJSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csv_manager', '0018_changes_scheduled_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='processingrun',
+            name='started_at',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
@@ -1,8 +1,106 @@
+import json
 from django.db import models
-from django.contrib.contenttypes.fields import GenericForeignKey
+from django.utils import timezone
+from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
+from .storage import RowSet, STORAGE_BACKENDS, default_backend
 
-class UploadedCSV(models.Model):
+
+class OrderedJSONField(models.JSONField):
+    """
+    JSONField that keeps the order of object keys, the column order of rows and schemas.
+    PostgreSQL's jsonb sorts keys, so there the column is json, which keeps the text as written;
+    SQLite stores JSON as text anyway.
+    """
+
+    def db_type(self, connection):
+        if connection.vendor == 'postgresql':
+            return 'json'
+        return super().db_type(connection)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if connection.vendor != 'postgresql':
+            return super().get_db_prep_value(value, connection, prepared)
+        if not prepared:
+            value = self.get_prep_value(value)
+        # Passed as text, a jsonb parameter would sort the keys on its way into the column
+        return None if value is None else json.dumps(value, cls=self.encoder)
+
+    def from_db_value(self, value, expression, connection):
+        if value is not None and not isinstance(value, str):
+            return value  # json columns come back decoded by psycopg
+        return super().from_db_value(value, expression, connection)
+
+
+class CSVDataset(models.Model):
+    """
+    Abstract base for datasets whose rows are stored in the CSVRow table, in Arrow files
+    under data_path with the 'arrow' storage backend, or as CompressedRows blocks with the 'compressed' one.
+
+    A dataset can be stored copy-on-write on top of a base dataset: its first base_row_count
+    rows are read from the base, and only the rows after them are stored for the dataset itself.
+    """
+    row_count = models.PositiveIntegerField(default=0)
+    size_bytes = models.PositiveBigIntegerField(default=0)  # Size of the rows stored for the dataset itself
+    stored_rows = GenericRelation('CSVRow')  # Deletes the rows together with the dataset
+    row_blocks = GenericRelation('RowBlock')  # Zone maps of the stored rows, see zonemaps.py
+    compressed_rows = GenericRelation('CompressedRows')  # Rows of the 'compressed' storage backend
+    storage = models.CharField(max_length=10, choices=STORAGE_BACKENDS, default=default_backend)
+    data_path = models.CharField(max_length=255, blank=True)  # Directory of the Arrow files, relative to MEDIA_ROOT
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)  # Fingerprint of the rows, see fingerprints.py
+    column_stats = OrderedJSONField(null=True, blank=True)  # Statistics of each column over all rows, see stats.py
+    column_sketches = models.JSONField(null=True, blank=True)  # HyperLogLog registers behind the distinct counts
+    updated_at = models.DateTimeField(auto_now=True)  # Versions the cached responses of the dataset, see caching.py
+    # Start of the batch window of the apply_pending_changes run scheduled for the dataset, see tasks.schedule_csv_changes
+    changes_scheduled_at = models.DateTimeField(null=True, blank=True)
+
+    # Generic relation to the UploadedCSV or DerivedCSV this dataset extends, if any
+    base_content_type = models.ForeignKey(ContentType, on_delete=models.PROTECT, null=True, blank=True, related_name='+')
+    base_object_id = models.PositiveIntegerField(null=True, blank=True)
+    base = GenericForeignKey('base_content_type', 'base_object_id')
+    base_row_count = models.PositiveIntegerField(default=0)
+    chain_depth = models.PositiveIntegerField(default=0)  # Number of bases below this dataset
+
+    class Meta:
+        abstract = True
+
+    @property
+    def rows(self):
+        """
+        Lazy accessor over the rows of this dataset, supporting len(), slicing and iteration.
+        """
+        return RowSet(self)
+
+    def share_rows(self, dataset):
+        """
+        Read all the rows of this dataset from an identical dataset instead of storing a copy of them.
+        """
+        self.extend(dataset)
+        self.content_hash = dataset.content_hash
+
+    def extend(self, dataset):
+        """
+        Start this dataset with all the rows of another one, read from it as its base.
+        Rows appended afterwards are stored for this dataset itself.
+        """
+        self.base = dataset
+        self.base_row_count = self.row_count = dataset.row_count
+        self.chain_depth = dataset.chain_depth + 1
+        self.column_stats, self.column_sketches = dataset.column_stats, dataset.column_sketches
+
+    def dependents(self):
+        """
+        Datasets that read some of their rows from this dataset.
+        """
+        content_type = ContentType.objects.get_for_model(self)
+        return [
+            dataset
+            for model in (UploadedCSV, DerivedCSV)
+            for dataset in model.objects.filter(base_content_type=content_type, base_object_id=self.pk)
+        ]
+
+
+class UploadedCSV(CSVDataset):
     """
     Model to represent the original uploaded CSV file.
     """
@@ -14,8 +112,8 @@ class UploadedCSV(models.Model):
     ]
 
     name = models.CharField(max_length=255)
-    content = models.JSONField() # Parsed CSV content stored as JSON
-    schema = models.JSONField(null=True, blank=True)  # Schema extracted from the CSV
+    raw_file = models.FileField(upload_to='uploads/', null=True, blank=True)  # Spooled upload, read in chunks
+    schema = OrderedJSONField(null=True, blank=True)  # Schema extracted from the CSV
     status = models.CharField(
         max_length=20,
         choices=STATUS_CHOICES,
@@ -24,16 +122,49 @@ class UploadedCSV(models.Model):
     failure_reason = models.TextField(null=True, blank=True) 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # Progress of processing, see process_csv
+    processing_token = models.CharField(max_length=32, blank=True)  # Claim of the run processing the upload
+    processing_attempts = models.PositiveIntegerField(default=0)
+    processing_started_at = models.DateTimeField(null=True, blank=True)  # Start of the current run
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # Last progress of the current run
+    rows_done = models.PositiveBigIntegerField(default=0)  # Rows committed so far
+    rows_total = models.PositiveBigIntegerField(null=True, blank=True)  # Known once the schema pass has read the file
+    checkpoint = OrderedJSONField(null=True, blank=True)  # Column types and DerivedCSV a restarted run resumes with
+
     def __str__(self):
         return f"UploadedCSV: {self.name} (Status: {self.get_status_display()})"
 
+    def progress(self):
+        """
+        Processing progress for polling: rows done out of the total, and the seconds left at the
+        rate of the current run, None while unknown.
+        """
+        percent = eta = None
+        if self.status == 'processed':
+            percent = 100
+        elif self.status == 'processing' and self.rows_total:
+            percent = min(round(100 * self.rows_done / self.rows_total, 1), 100)
+            resumed_at = (self.checkpoint or {}).get('resumed_at_row', 0)
+            if self.processing_started_at and self.rows_done > resumed_at:
+                elapsed = (timezone.now() - self.processing_started_at).total_seconds()
+                eta = round(elapsed / (self.rows_done - resumed_at) * (self.rows_total - self.rows_done), 1)
+        return {
+            'id': self.id,
+            'status': self.status,
+            'status_display': self.get_status_display(),
+            'rows_done': self.rows_done,
+            'rows_total': self.rows_total,
+            'percent': percent,
+            'eta_seconds': eta,
+            'failure_reason': self.failure_reason,
+        }
 
-class DerivedCSV(models.Model):
+
+class DerivedCSV(CSVDataset):
     """
     Model to represent a processed version of an uploaded CSV.
     """
     parent = models.ForeignKey(UploadedCSV, on_delete=models.CASCADE, related_name='derived_csvs')
-    content = models.JSONField()
     created_at = models.DateTimeField(auto_now_add=True)
 
     @property
@@ -57,7 +188,7 @@ class CSVChanges(models.Model):
     csv_entry = GenericForeignKey('content_type', 'object_id')
 
     # Data fields
-    data = models.JSONField()
+    data = OrderedJSONField()
     status = models.CharField(
         max_length=20,
         choices=[('pending', 'Pending'), ('processed', 'Processed')],
@@ -66,4 +197,102 @@ class CSVChanges(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
-        return f"CSVChanges (ID: {self.id}) - Status: {self.get_status_display()}"
\ No newline at end of file
+        return f"CSVChanges (ID: {self.id}) - Status: {self.get_status_display()}"
+
+
+class CSVRow(models.Model):
+    """
+    Model to represent a single row of an UploadedCSV or DerivedCSV.
+    """
+    # Generic relation to either UploadedCSV or DerivedCSV
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    dataset = GenericForeignKey('content_type', 'object_id')
+
+    row_index = models.PositiveIntegerField()
+    data = OrderedJSONField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['content_type', 'object_id', 'row_index'], name='unique_csv_row'),
+        ]
+
+    def __str__(self):
+        return f"CSVRow {self.row_index} of {self.content_type.model} {self.object_id}"
+
+
+class CompressedRows(models.Model):
+    """
+    Model to represent a block of rows [start, stop) of an UploadedCSV or DerivedCSV stored with the
+    'compressed' backend, as JSON compressed with codec. See CompressedStore and compression.py.
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    dataset = GenericForeignKey('content_type', 'object_id')
+
+    start = models.PositiveIntegerField()
+    stop = models.PositiveIntegerField()
+    codec = models.CharField(max_length=10)
+    data = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['content_type', 'object_id', 'start'], name='unique_compressed_rows'),
+        ]
+
+    def __str__(self):
+        return f"CompressedRows {self.start}-{self.stop} of {self.content_type.model} {self.object_id}"
+
+
+class RowBlock(models.Model):
+    """
+    Zone map of one block of rows an UploadedCSV or DerivedCSV stores itself: the minimum and
+    maximum of each datetime, date, integer and float column over rows [start, stop).
+    Range reads skip the blocks whose bounds rule out a match, see RowSet.iter_frames.
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    dataset = GenericForeignKey('content_type', 'object_id')
+
+    start = models.PositiveIntegerField()
+    stop = models.PositiveIntegerField()
+    bounds = models.JSONField()  # Column to [min, max], None when the block has no values in it
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['content_type', 'object_id', 'start'], name='unique_row_block'),
+        ]
+
+    def __str__(self):
+        return f"RowBlock {self.start}-{self.stop} of {self.content_type.model} {self.object_id}"
+
+
+class ProcessingRun(models.Model):
+    """
+    Model to record one run of a background CSV task: how long it waited and took, the time spent
+    in each stage, and the rows, bytes and peak memory it handled. See instrumentation.py.
+    """
+    STATUS_CHOICES = [
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    ]
+
+    task = models.CharField(max_length=50, db_index=True)
+
+    # Generic relation to the UploadedCSV or DerivedCSV the task worked on, kept after it is deleted
+    content_type = models.ForeignKey(ContentType, on_delete=models.SET_NULL, null=True, blank=True)
+    object_id = models.PositiveIntegerField(null=True, blank=True)
+    dataset = GenericForeignKey('content_type', 'object_id')
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='succeeded')
+    error = models.TextField(null=True, blank=True)
+    started_at = models.DateTimeField(db_index=True)  # Runs older than CSV_RUN_RETENTION_DAYS are purged
+    duration = models.FloatField()  # Seconds
+    queue_wait = models.FloatField(null=True, blank=True)  # Seconds between publishing and starting, None when run eagerly
+    row_count = models.PositiveBigIntegerField(default=0)  # Rows processed
+    size_bytes = models.PositiveBigIntegerField(default=0)  # Raw bytes read, or bytes stored for appended rows
+    peak_memory_bytes = models.PositiveBigIntegerField(null=True, blank=True)  # Resident memory high-water mark of the worker
+    stages = models.JSONField(default=dict)  # Seconds per stage, each excluding the stages nested in it
+
+    def __str__(self):
+        return f"ProcessingRun {self.task} ({self.get_status_display()}, {self.duration:.3f}s)"
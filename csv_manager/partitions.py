@@ -0,0 +1,71 @@
+import io
+
+
+BLOCK_SIZE = 4 * 1024 * 1024  # Bytes read at a time while looking for row boundaries
+
+
+class ByteRange(io.RawIOBase):
+    """
+    Read-only file over the bytes [start, stop) of another binary file.
+    """
+
+    def __init__(self, source, start, stop):
+        self.source = source
+        self.source.seek(start)
+        self.remaining = stop - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.source.read(min(len(buffer), self.remaining))
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+def row_boundaries(source, targets):
+    """
+    For each of the ascending byte offsets in targets, the offset of the first CSV row starting
+    at or after it, or the file size when no row starts after it.
+
+    A row starts after a newline that is not inside a quoted field, which is told by the parity
+    of the double quotes before it (escaped quotes come in pairs and keep the parity).
+    """
+    boundaries, pending = [], list(targets)
+    position, parity = 0, 0
+    source.seek(0)
+
+    while pending:
+        block = source.read(BLOCK_SIZE)
+        if not block:
+            break
+        quotes, counted, search_from = parity, 0, 0
+
+        while pending:
+            newline = block.find(b'\n', max(pending[0] - 1 - position, search_from))
+            if newline == -1:
+                break
+            quotes += block.count(b'"', counted, newline)
+            counted = search_from = newline
+            if quotes % 2 == 0:
+                boundaries.append(position + newline + 1)
+                pending.pop(0)
+            else:
+                search_from += 1
+
+        parity = (parity + block.count(b'"')) % 2
+        position += len(block)
+
+    return boundaries + [position] * len(pending)
+
+
+def split_byte_ranges(source, parts):
+    """
+    Split a CSV file into at most parts (start, stop) byte ranges of whole rows, about equal in size,
+    leaving out the header row.
+    """
+    size = source.seek(0, io.SEEK_END)
+    targets = [1] + [size * part // parts for part in range(1, parts)]
+    boundaries = sorted(set(row_boundaries(source, targets) + [size]))
+    return [(start, stop) for start, stop in zip(boundaries, boundaries[1:]) if start < stop]
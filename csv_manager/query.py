@@ -0,0 +1,391 @@
+import csv
+import hashlib
+import io
+import json
+from django.conf import settings
+import pandas as pd
+from .aggregation import TIME_BUCKETS, bucket_start
+from .caching import cached
+from .schema import DATETIME_OUTPUT_FORMAT, DATE_OUTPUT_FORMAT
+from .table import COMPARISONS, TableQueryError, apply_filter, coerce_column, coerce_value
+
+
+SPEC_KEYS = ('select', 'where', 'group_by', 'aggregates', 'order_by', 'limit')
+OPERATORS = tuple(COMPARISONS) + ('contains', 'in', 'between', 'isnull', 'notnull')
+AGGREGATES = ('count', 'sum', 'mean', 'min', 'max')
+NUMERIC_TYPES = ('integer', 'float')
+ORDERED_TYPES = ('integer', 'float', 'datetime', 'date')  # Types with an order for ranges, min and max
+DEFAULT_LIMIT = 1000
+
+
+class QueryError(ValueError):
+    """
+    Raised for query specs that do not fit the dataset schema.
+    """
+
+
+def load_spec(text):
+    """
+    Read a query spec from JSON text.
+    """
+    if not text:
+        raise QueryError("Send the query spec as JSON, in the q parameter or as the request body.")
+    try:
+        spec = json.loads(text)
+    except ValueError as e:
+        raise QueryError(f"The query spec is not valid JSON: {e}")
+    if not isinstance(spec, dict):
+        raise QueryError("The query spec must be a JSON object.")
+    return spec
+
+
+def parse_query(spec, schema):
+    """
+    Validate a query spec against a dataset schema and normalize it:
+
+        {"select": ["timestamp", "pm25"],
+         "where": [{"column": "pm25", "op": "gte", "value": 50}],
+         "group_by": ["year", {"column": "timestamp", "bucket": "month"}],
+         "aggregates": [{"op": "mean", "column": "pm25", "as": "pm25_mean"}, {"op": "count"}],
+         "order_by": [{"column": "pm25_mean", "desc": true}],
+         "limit": 100}
+
+    where predicates are combined with AND and their values typed by the schema. A query with
+    group_by or aggregates returns one row per group, else the selected columns of the matching rows.
+    """
+    if not schema:
+        raise QueryError("The CSV has no schema yet.")
+    unknown = [key for key in spec if key not in SPEC_KEYS]
+    if unknown:
+        raise QueryError(f"Unknown query keys: {', '.join(unknown)}. Expected: {', '.join(SPEC_KEYS)}.")
+
+    where = [parse_predicate(predicate, schema) for predicate in as_list(spec, 'where')]
+    group_by = [parse_group(group, schema) for group in as_list(spec, 'group_by')]
+    aggregates = [parse_aggregate(aggregate, schema) for aggregate in as_list(spec, 'aggregates')]
+
+    if group_by or aggregates:
+        if 'select' in spec:
+            raise QueryError("select does not apply to grouped queries, their columns are the groups and aggregates.")
+        select = None
+        columns = [column for column, _ in group_by] + [name for _, _, name in aggregates]
+    else:
+        select = as_list(spec, 'select') or list(schema)
+        check_columns(select, schema, 'select')
+        columns = select
+    if len(set(columns)) != len(columns):
+        raise QueryError("Result columns must have distinct names, name aggregates with 'as'.")
+
+    order_by = []
+    for order in as_list(spec, 'order_by'):
+        if not isinstance(order, (str, dict)):
+            raise QueryError("order_by entries must be column names or objects with column and desc.")
+        column, descending = (order, False) if isinstance(order, str) else (order.get('column'), bool(order.get('desc')))
+        # Rows can be ordered on any column, groups on the result columns
+        if not isinstance(column, str) or column not in (schema if select is not None else columns):
+            raise QueryError(f"Unknown order_by column '{column}'.")
+        order_by.append([column, descending])
+
+    # bool is an int subclass, true is not a limit
+    limit = spec.get('limit', DEFAULT_LIMIT)
+    if type(limit) is not int or not 0 < limit <= settings.CSV_QUERY_MAX_ROWS:
+        raise QueryError(f"limit must be an integer between 1 and {settings.CSV_QUERY_MAX_ROWS}.")
+
+    return {
+        'select': select,
+        'where': where,
+        'group_by': group_by,
+        'aggregates': aggregates,
+        'order_by': order_by,
+        'limit': limit,
+    }
+
+
+def as_list(spec, key):
+    value = spec.get(key) or []
+    if not isinstance(value, list):
+        raise QueryError(f"'{key}' must be a list.")
+    return value
+
+
+def check_columns(columns, schema, key):
+    unknown = [str(column) for column in columns if not isinstance(column, str) or column not in schema]
+    if unknown:
+        raise QueryError(f"Unknown {key} columns: {', '.join(unknown)}.")
+
+
+def parse_predicate(predicate, schema):
+    """
+    [column, operator, typed value] of a where predicate.
+    """
+    if not isinstance(predicate, dict):
+        raise QueryError("where predicates must be objects with column, op and value.")
+    column, operator, value = predicate.get('column'), predicate.get('op', 'eq'), predicate.get('value')
+    check_columns([column], schema, 'where')
+    col_type = schema[column]
+    if not isinstance(operator, str) or operator not in OPERATORS:
+        raise QueryError(f"Unknown operator '{operator}', expected one of: {', '.join(OPERATORS)}.")
+    if operator == 'contains' and col_type != 'string':
+        raise QueryError(f"'contains' only applies to string columns, '{column}' is {col_type}.")
+    if operator in ('gt', 'gte', 'lt', 'lte', 'between') and col_type not in ORDERED_TYPES:
+        raise QueryError(f"'{operator}' does not apply to {col_type} column '{column}'.")
+
+    try:
+        if operator in ('isnull', 'notnull'):
+            value = None
+        elif operator in ('in', 'between'):
+            if not isinstance(value, list) or (operator == 'between' and len(value) != 2):
+                raise QueryError(f"'{operator}' takes a list of values" + (" [low, high]." if operator == 'between' else "."))
+            value = [coerce_value(str(item), col_type, column) for item in value]
+        else:
+            value = coerce_value(str(value), col_type, column)
+    except TableQueryError as e:
+        raise QueryError(str(e))
+    return [column, operator, value]
+
+
+def parse_group(group, schema):
+    """
+    [column, time bucket or None] of a group_by entry.
+    """
+    if not isinstance(group, (str, dict)):
+        raise QueryError("group_by entries must be column names or objects with column and bucket.")
+    column, bucket = (group, None) if isinstance(group, str) else (group.get('column'), group.get('bucket'))
+    check_columns([column], schema, 'group_by')
+    if bucket is not None:
+        if schema[column] not in ('datetime', 'date'):
+            raise QueryError(f"Time buckets only apply to datetime and date columns, '{column}' is {schema[column]}.")
+        if not isinstance(bucket, str) or bucket not in TIME_BUCKETS:
+            raise QueryError(f"Unknown time bucket '{bucket}', expected one of: {', '.join(TIME_BUCKETS)}.")
+    return [column, bucket]
+
+
+def parse_aggregate(aggregate, schema):
+    """
+    [operator, column or None, result name] of an aggregate; count without a column counts rows.
+    """
+    if not isinstance(aggregate, dict):
+        raise QueryError("aggregates must be objects with op, column and optionally as.")
+    operator, column = aggregate.get('op'), aggregate.get('column')
+    if not isinstance(operator, str) or operator not in AGGREGATES:
+        raise QueryError(f"Unknown aggregate '{operator}', expected one of: {', '.join(AGGREGATES)}.")
+    if column is None and operator != 'count':
+        raise QueryError(f"'{operator}' needs a column.")
+    if column is not None:
+        check_columns([column], schema, 'aggregate')
+        if operator in ('sum', 'mean') and schema[column] not in NUMERIC_TYPES:
+            raise QueryError(f"'{operator}' needs a numeric column, '{column}' is {schema[column]}.")
+        if operator in ('min', 'max') and schema[column] not in ORDERED_TYPES:
+            raise QueryError(f"'{operator}' does not apply to {schema[column]} column '{column}'.")
+    name = aggregate.get('as') or (f'{operator}_{column}' if column else operator)
+    if not isinstance(name, str):
+        raise QueryError("An aggregate's 'as' must be a string.")
+    return [operator, column, name]
+
+
+def query_hash(query):
+    """
+    Fingerprint of a normalized query, the same for specs that only differ in formatting.
+    """
+    return hashlib.sha1(json.dumps(query, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def run_query(rows, schema, query):
+    """
+    Run a normalized query over all rows of a dataset, memoized per dataset version and query
+    in the dataset cache, which evicts the least recently used results.
+    Returns {'columns', 'rows', 'truncated', 'rows_scanned'}.
+    """
+    def execute():
+        if query['group_by'] or query['aggregates']:
+            return grouped_query(rows, schema, query)
+        return row_query(rows, schema, query)
+
+    return cached('query', rows.dataset, [query_hash(query)], execute)
+
+
+def scan(rows, schema, query, columns, typed_columns):
+    """
+    Yield the number of rows read, then the rows matching the where predicates as stored and with
+    the typed_columns typed by the schema, batch by batch. Only the given columns are read, and
+    only from the blocks whose zone maps allow a match.
+    """
+    typed_columns = set(typed_columns) | {column for column, _, _ in query['where']}
+    for df in rows.iter_frames(sorted(set(columns) | typed_columns), where=query['where']):
+        typed = pd.DataFrame({column: coerce_column(df[column], schema[column]) for column in typed_columns}, index=df.index)
+        mask = pd.Series(True, index=df.index)
+        for column, operator, value in query['where']:
+            mask &= matches(typed[column], operator, value)
+        yield len(df), df[mask], typed[mask]
+
+
+def matches(series, operator, value):
+    """
+    Boolean mask of the values in a typed column that pass one predicate.
+    """
+    if operator == 'isnull':
+        return series.isna()
+    if operator == 'notnull':
+        return series.notna()
+    if operator == 'in':
+        return series.isin(value).fillna(False).astype(bool)
+    if operator == 'between':
+        return (series.ge(value[0]) & series.le(value[1])).fillna(False).astype(bool)
+    return apply_filter(series, operator, value)
+
+
+def group_keys(df, group_by):
+    """
+    The group key columns of a batch, with datetimes truncated to the start of their time bucket.
+    """
+    keys = {}
+    for column, bucket in group_by:
+        series = df[column]
+        if bucket is not None:
+            series = bucket_start(series, bucket)
+        keys[column] = series
+    return keys
+
+
+def grouped_query(rows, schema, query):
+    """
+    Aggregate the matching rows per group in one pass. Each batch is reduced to partial counts,
+    sums, minimums and maximums per group, which are combined once all batches are read, so memory
+    grows with the number of groups rather than rows.
+    """
+    group_by, aggregates = query['group_by'], query['aggregates']
+    names = [column for column, _ in group_by] or ['__all']
+    columns = {column for column, _ in group_by} | {column for _, column, _ in aggregates if column is not None}
+
+    # Partial aggregates per result column: count and sum combine by adding, min and max by themselves.
+    # Rows per group are always counted, so a query without aggregates returns its distinct groups
+    partial_ops = {'__rows': 'sum'}
+    for position, (operator, column, _) in enumerate(aggregates):
+        if operator in ('count', 'mean'):
+            partial_ops[f'count_{position}'] = 'sum'
+        if operator in ('sum', 'mean'):
+            partial_ops[f'sum_{position}'] = 'sum'
+        if operator in ('min', 'max'):
+            partial_ops[f'{operator}_{position}'] = operator
+
+    partials, rows_scanned = [], 0
+    for batch_rows, _, df in scan(rows, schema, query, [], columns):
+        rows_scanned += batch_rows
+        if df.empty:
+            continue
+        frame = pd.DataFrame(group_keys(df, group_by) or {'__all': pd.Series(0, index=df.index)})
+        frame['__rows'] = 1
+        for position, (operator, column, _) in enumerate(aggregates):
+            values = df[column] if column is not None else None
+            if operator in ('count', 'mean'):
+                frame[f'count_{position}'] = values.notna().astype('int64') if values is not None else 1
+            if operator in ('sum', 'mean'):
+                frame[f'sum_{position}'] = values.astype('float64')
+            if operator in ('min', 'max'):
+                frame[f'{operator}_{position}'] = values
+        partials.append(frame.groupby(names, dropna=False, sort=False).agg(partial_ops))
+
+    if not partials:
+        result = pd.DataFrame(columns=[column for column, _ in group_by] + [name for _, _, name in aggregates])
+    else:
+        combined = pd.concat(partials)
+        if len(partials) > 1:
+            combined = combined.groupby(level=names, dropna=False, sort=False).agg(partial_ops)
+        result = combined.reset_index()
+        for position, (operator, column, name) in enumerate(aggregates):
+            if operator == 'mean':
+                result[name] = result[f'sum_{position}'] / result[f'count_{position}'].where(result[f'count_{position}'] > 0)
+            elif operator == 'sum' and schema[column] == 'integer':
+                # Summed as floats so missing values add nothing, integers sum to integers
+                result[name] = result[f'sum_{position}'].round().astype('Int64')
+            else:
+                result[name] = result[f'{operator}_{position}']
+        result = result[[column for column, _ in group_by] + [name for _, _, name in aggregates]]
+
+    # Groups are ordered by their keys unless asked otherwise
+    order_by = query['order_by'] or [[column, False] for column, _ in group_by]
+    output_types = {column: schema[column] for column, _ in group_by}
+    output_types.update({name: schema[column] for operator, column, name in aggregates if operator in ('min', 'max')})
+    return result_rows(result, order_by, query['limit'], output_types, rows_scanned)
+
+
+def row_query(rows, schema, query):
+    """
+    The selected columns of the matching rows. Without an order, the scan stops once limit rows
+    matched; with one, only the first limit rows in order are kept from batch to batch.
+    """
+    select, order_by, limit = query['select'], query['order_by'], query['limit']
+    order_columns = [column for column, _ in order_by]
+
+    kept, kept_rows, rows_scanned = [], 0, 0
+    for batch_rows, df, typed in scan(rows, schema, query, select, order_columns):
+        rows_scanned += batch_rows
+        if df.empty:
+            continue
+        frame = df[select].copy()
+        for position, column in enumerate(order_columns):
+            frame[f'__order_{position}'] = typed[column]
+        kept.append(frame)
+        kept_rows += len(frame)
+
+        if order_by:
+            # Keep one row more than the limit to tell whether the result was truncated
+            top = order_rows(pd.concat(kept), order_by).iloc[:limit + 1]
+            kept, kept_rows = [top], len(top)
+        elif kept_rows > limit:
+            break
+
+    result = order_rows(pd.concat(kept), order_by) if kept else pd.DataFrame(columns=select)
+    return result_rows(result[select], [], limit, {}, rows_scanned)
+
+
+def order_rows(df, order_by):
+    """
+    Rows sorted on the typed order columns of a row query, stable and with missing values last.
+    """
+    if not order_by:
+        return df
+    return df.sort_values(
+        [f'__order_{position}' for position in range(len(order_by))],
+        ascending=[not descending for _, descending in order_by],
+        kind='stable', na_position='last',
+    )
+
+
+def result_rows(df, order_by, limit, output_types, rows_scanned):
+    """
+    The first limit rows of a result frame as JSON-ready lists, datetimes formatted as stored.
+    """
+    if order_by:
+        df = df.sort_values(
+            [column for column, _ in order_by], ascending=[not descending for _, descending in order_by],
+            kind='stable', na_position='last',
+        )
+    truncated = len(df) > limit
+    df = df.iloc[:limit]
+
+    values = []
+    for column in df.columns:
+        series = df[column]
+        if output_types.get(column) == 'datetime':
+            series = series.dt.strftime(DATETIME_OUTPUT_FORMAT)
+        elif output_types.get(column) == 'date':
+            series = series.dt.strftime(DATE_OUTPUT_FORMAT)
+        values.append(series.astype(object).where(series.notna(), None).tolist())
+
+    return {
+        'columns': list(df.columns),
+        'rows': [list(row) for row in zip(*values)] if values else [],
+        'truncated': truncated,
+        'rows_scanned': rows_scanned,
+    }
+
+
+def result_csv(result):
+    """
+    A query result as CSV text with a header row.
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(result['columns'])
+    writer.writerows(result['rows'])
+    return output.getvalue()
@@ -0,0 +1,190 @@
+import re
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+
+DATETIME_OUTPUT_FORMAT = "%Y-%m-%d %H:%M:%S"
+DATE_OUTPUT_FORMAT = "%Y-%m-%d"
+BOOLEAN_VALUES = {
+    'true': True, 'false': False,
+    'yes': True, 'no': False,
+}
+PROBE_ROWS = 20
+
+
+def normalize_header(name):
+    """
+    Column name as stored in schemas: punctuation dropped, spaces as underscores, lower case.
+    """
+    return re.sub(r'[^\w\s]', '', name).strip().replace(' ', '_').lower()
+
+
+def is_string_column(series):
+    """
+    Whether pandas read a column as text (object dtype, or the string dtype of newer pandas).
+    """
+    return pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)
+
+
+def sample_index(df, sample_rows):
+    """
+    Index labels of up to sample_rows rows: a third from the head, a third from the tail
+    and the rest picked at random in between.
+    """
+    if len(df) <= sample_rows:
+        return df.index
+
+    third = sample_rows // 3
+    head, tail = np.arange(third), np.arange(len(df) - third, len(df))
+    middle = np.random.default_rng(0).choice(np.arange(third, len(df) - third), sample_rows - 2 * third, replace=False)
+    return df.index[np.sort(np.concatenate([head, middle, tail]))]
+
+
+def parses_as(values, fmt):
+    """
+    Whether every value parses as a datetime in the given format.
+    """
+    return bool(pd.to_datetime(values, format=fmt, errors='coerce').notna().all())
+
+
+def candidate_types(sample):
+    """
+    (type, format) pairs a column could have judging by a sample of its values, most specific first.
+    The last candidate always fits.
+    """
+    if pd.api.types.is_bool_dtype(sample):
+        return [('boolean', None)]
+    # Chunks are read with nullable dtypes, so integer text with missing values is already
+    # an integer column and a float column holds text written with a decimal point
+    if pd.api.types.is_integer_dtype(sample):
+        return [('integer', None)]
+    if pd.api.types.is_float_dtype(sample):
+        return [('float', None)]
+
+    values = sample.dropna().astype(str).str.strip()
+    candidates = []
+    if values.str.lower().isin(BOOLEAN_VALUES).all():
+        candidates.append(('boolean', None))
+
+    numbers = pd.to_numeric(values, errors='coerce')
+    if numbers.notna().all():
+        # 1.0 is a float written as such, only plain digits make an integer
+        if values.str.fullmatch(r'[+-]?\d+').all():
+            candidates.append(('integer', None))
+        candidates.append(('float', None))
+    else:
+        for col_type, formats in (('datetime', settings.CSV_DATETIME_FORMATS), ('date', settings.CSV_DATE_FORMATS)):
+            for fmt in formats:
+                # Most formats are ruled out by the first few values already
+                if parses_as(values.iloc[:PROBE_ROWS], fmt) and parses_as(values, fmt):
+                    candidates.append((col_type, fmt))
+
+    candidates.append(('string', None))
+    return candidates
+
+
+def coerce_series(series, col_type, fmt=None):
+    """
+    Convert a column to the pandas dtype of a schema type in one vectorized pass.
+    Values that do not fit become missing.
+    """
+    if col_type == 'boolean':
+        if pd.api.types.is_bool_dtype(series):
+            return series.astype('boolean')
+        return series.astype(str).str.strip().str.lower().map(BOOLEAN_VALUES).where(series.notna()).astype('boolean')
+    if col_type == 'integer' or col_type == 'float':
+        numbers = pd.to_numeric(series, errors='coerce')
+        if col_type == 'integer':
+            return numbers.where(numbers % 1 == 0).astype('Int64')
+        # Whole numbers parse as integers, a float column stores them as floats whatever the batch holds
+        return numbers.astype('float64')
+    if col_type == 'datetime' or col_type == 'date':
+        return pd.to_datetime(series, format=fmt, errors='coerce')
+    return series
+
+
+def infer_column_types(df, sample_rows=None):
+    """
+    Infer the (type, format) of every column of a DataFrame.
+
+    A sample of rows proposes candidate types, then the whole column is coerced once to the
+    first candidate that loses no values. Returns the column types and the coerced columns,
+    which normalize_frame reuses instead of converting again.
+    Columns without any value get the type None.
+    """
+    sample_rows = sample_rows or settings.CSV_SCHEMA_SAMPLE_ROWS
+    sampled = sample_index(df, sample_rows)
+    column_types, coerced = {}, {}
+
+    for column in df.columns:
+        series = df[column]
+        present = series.notna().sum()
+        if present == 0:
+            column_types[column] = (None, None)
+            continue
+
+        sample = series.loc[sampled].dropna()
+        if sample.empty:
+            sample = series.dropna().iloc[:sample_rows]
+
+        for col_type, fmt in candidate_types(sample):
+            converted = coerce_series(series, col_type, fmt)
+            if col_type == 'string' or converted.notna().sum() == present:
+                column_types[column] = (col_type, fmt)
+                coerced[column] = converted
+                break
+
+    return column_types, coerced
+
+
+def merge_column_types(column_types, chunk_column_types):
+    """
+    Widen column types with the types inferred from another chunk of the same file.
+    Integers widen to floats, any other disagreement widens to string.
+    Columns without values so far (None) take the type of the next chunk that has some.
+    """
+    merged = dict(column_types)
+    for column, (col_type, fmt) in chunk_column_types.items():
+        current = merged.get(column, (None, None))
+        if col_type is None:
+            merged[column] = current
+        elif current[0] is None or current == (col_type, fmt):
+            merged[column] = (col_type, fmt)
+        elif {current[0], col_type} == {'integer', 'float'}:
+            merged[column] = ('float', None)
+        else:
+            merged[column] = ('string', None)
+    return merged
+
+
+def schema_of(column_types):
+    """
+    The schema stored on an UploadedCSV: column name to type, empty columns as string.
+    """
+    return {column: col_type or 'string' for column, (col_type, _) in column_types.items()}
+
+
+def normalize_frame(df, column_types, coerced=None):
+    """
+    Normalize a chunk of data to the column types inferred over the whole file, ready for JSON:
+    datetimes and dates become ISO strings, integers Python ints and booleans Python bools.
+    coerced columns are reused as they are, so they must come from inferring these same column types.
+    """
+    coerced = coerced or {}
+    normalized = {}
+
+    for column, (col_type, fmt) in column_types.items():
+        col_type = col_type or 'string'
+        series = coerced[column] if column in coerced else coerce_series(df[column], col_type, fmt)
+
+        if col_type == 'datetime':
+            series = series.dt.strftime(DATETIME_OUTPUT_FORMAT)
+        elif col_type == 'date':
+            series = series.dt.strftime(DATE_OUTPUT_FORMAT)
+        elif col_type == 'string' and not is_string_column(series):
+            # Another chunk widened this column to string, match what a whole-file read gives
+            series = series.astype(object).where(series.isna(), series.astype(str))
+        normalized[column] = series
+
+    return pd.DataFrame(normalized, index=df.index)
@@ -0,0 +1,77 @@
+import time
+from celery.signals import before_task_publish, worker_process_init
+from django.db import transaction
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
+from .models import UploadedCSV, DerivedCSV
+from .storage import ArrowStore
+from .caching import invalidate
+from .instrumentation import run_exclusively
+
+
+@receiver(pre_delete, sender=UploadedCSV)
+@receiver(pre_delete, sender=DerivedCSV)
+def materialize_dependents(sender, instance, origin=None, **kwargs):
+    """
+    Before a dataset is deleted, copy its rows into the datasets that read them as their base.
+    Derived CSVs deleted together with their UploadedCSV are skipped.
+    """
+    deleted_parent_id = origin.pk if isinstance(origin, UploadedCSV) else None
+
+    with transaction.atomic():
+        for dependent in instance.dependents():
+            if isinstance(dependent, DerivedCSV) and dependent.parent_id == deleted_parent_id:
+                continue
+            dependent.rows.materialize()
+            dependent.save()
+
+
+@receiver(post_delete, sender=UploadedCSV)
+@receiver(post_delete, sender=DerivedCSV)
+def delete_data_files(sender, instance, **kwargs):
+    """
+    Remove the Arrow files of a deleted dataset once the deletion is committed.
+    """
+    if instance.data_path:
+        transaction.on_commit(ArrowStore(instance).clear)
+
+
+@receiver(post_delete, sender=UploadedCSV)
+def delete_raw_file(sender, instance, **kwargs):
+    """
+    Remove the spooled upload of a deleted UploadedCSV once the deletion is committed, unless
+    another upload of the same content still shares it, see upload_csv.
+    """
+    name = instance.raw_file.name
+    if not name:
+        return
+
+    def delete():
+        if not UploadedCSV.objects.filter(raw_file=name).exists():
+            instance.raw_file.storage.delete(name)
+    transaction.on_commit(delete)
+
+
+@receiver(post_delete, sender=UploadedCSV)
+@receiver(post_delete, sender=DerivedCSV)
+def drop_cached_responses(sender, instance, **kwargs):
+    """
+    Drop the pages and exports cached for a deleted dataset.
+    """
+    invalidate(instance)
+
+
+@before_task_publish.connect
+def stamp_enqueued_at(headers=None, **kwargs):
+    """
+    Stamp published tasks with the time they were queued, for the queue wait of their runs.
+    """
+    headers['enqueued_at'] = time.time()
+
+
+@worker_process_init.connect
+def reset_peak_memory_per_run(**kwargs):
+    """
+    Prefork pool children run one task at a time, their runs can measure their own peak memory.
+    """
+    run_exclusively()
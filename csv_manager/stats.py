@@ -0,0 +1,140 @@
+import base64
+import numpy as np
+import pandas as pd
+
+
+HLL_PRECISION = 12  # 2**12 registers, about 1.6% standard error on distinct counts
+HLL_REGISTERS = 1 << HLL_PRECISION
+NUMERIC_TYPES = ('integer', 'float')
+RANGE_TYPES = ('integer', 'float', 'datetime', 'date')  # Datetimes and dates are ISO strings, ordered as text
+
+
+def hll_registers(values):
+    """
+    HyperLogLog registers of the non-null values of a column.
+    Numbers are hashed as floats and everything else as text, so 1 and 1.0 count as one value.
+    """
+    registers = np.zeros(HLL_REGISTERS, dtype=np.uint8)
+    if values.empty:
+        return registers
+
+    if pd.api.types.is_numeric_dtype(values):
+        values = values.astype('float64')
+    elif not pd.api.types.is_string_dtype(values):
+        values = values.astype(str)
+    # Most values of a column are distinct, hashing them directly beats factorizing them first
+    hashes = pd.util.hash_pandas_object(values, index=False, categorize=False).to_numpy()
+    index = (hashes >> np.uint64(64 - HLL_PRECISION)).astype(np.int64)
+    rest = hashes & np.uint64((1 << (64 - HLL_PRECISION)) - 1)
+    # rest has fewer than 53 bits, so it is exact as a float and frexp gives its bit length
+    _, bit_length = np.frexp(rest.astype('float64'))
+    np.maximum.at(registers, index, (64 - HLL_PRECISION + 1 - bit_length).astype(np.uint8))
+    return registers
+
+
+def hll_estimate(registers):
+    """
+    Approximate number of distinct values counted in HyperLogLog registers.
+    """
+    m = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.ldexp(1.0, -registers.astype(np.int64)).sum()
+    zeros = int((registers == 0).sum())
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * np.log(m / zeros)  # Linear counting for small cardinalities
+    return int(round(estimate))
+
+
+def encode_registers(registers):
+    return base64.b64encode(registers.tobytes()).decode('ascii')
+
+
+def decode_registers(text):
+    return np.frombuffer(base64.b64decode(text), dtype=np.uint8)
+
+
+def column_summary(values, nulls, col_type):
+    """
+    Statistics of the non-null values of one column of a chunk: their count, the null count, min/max
+    for ordered types, and mean, variance and the sum of squared deviations (m2) for numeric types.
+    """
+    summary = {'count': len(values), 'nulls': nulls}
+    if col_type in RANGE_TYPES:
+        summary['min'] = values.min() if len(values) else None
+        summary['max'] = values.max() if len(values) else None
+    if col_type in NUMERIC_TYPES:
+        numbers = values.to_numpy(dtype='float64')
+        summary['mean'] = float(numbers.mean()) if len(numbers) else 0.0
+        summary['m2'] = float(((numbers - summary['mean']) ** 2).sum()) if len(numbers) else 0.0
+        summary['variance'] = summary['m2'] / (len(numbers) - 1) if len(numbers) > 1 else 0.0
+    return {
+        key: value.item() if isinstance(value, np.generic) else value
+        for key, value in summary.items()
+    }
+
+
+def merge_summaries(a, b):
+    """
+    Combine the statistics of two disjoint sets of rows of a column.
+    Means and m2 are merged with the pairwise form of Welford's update (Chan et al.).
+    """
+    if a is None:
+        return b
+    merged = {'count': a['count'] + b['count'], 'nulls': a['nulls'] + b['nulls']}
+    if 'min' in a:
+        mins = [value for value in (a['min'], b['min']) if value is not None]
+        maxes = [value for value in (a['max'], b['max']) if value is not None]
+        merged['min'] = min(mins) if mins else None
+        merged['max'] = max(maxes) if maxes else None
+    if 'mean' in a:
+        count = merged['count']
+        delta = b['mean'] - a['mean']
+        merged['mean'] = a['mean'] + delta * b['count'] / count if count else 0.0
+        merged['m2'] = a['m2'] + b['m2'] + delta * delta * a['count'] * b['count'] / count if count else 0.0
+        merged['variance'] = merged['m2'] / (count - 1) if count > 1 else 0.0
+    return merged
+
+
+def chunk_stats(df, schema):
+    """
+    Column statistics and HyperLogLog sketches of the rows of one chunk, as (column_stats, column_sketches).
+    """
+    column_stats, column_sketches = {}, {}
+    for column, col_type in schema.items():
+        series = df[column] if column in df else pd.Series(None, index=df.index, dtype=object)
+        present = series.notna()
+        values = series if present.all() else series[present]
+
+        registers = hll_registers(values)
+        column_stats[column] = dict(
+            column_summary(values, len(series) - len(values), col_type), distinct=hll_estimate(registers),
+        )
+        column_sketches[column] = encode_registers(registers)
+    return column_stats, column_sketches
+
+
+def merge_stats(column_stats, column_sketches, other_stats, other_sketches):
+    """
+    Combine the column statistics and sketches of two disjoint sets of rows of a dataset.
+    Returns the new (column_stats, column_sketches).
+    """
+    column_stats, column_sketches = dict(column_stats or {}), dict(column_sketches or {})
+    for column, summary in other_stats.items():
+        registers = decode_registers(other_sketches[column])
+        if column in column_sketches:
+            registers = np.maximum(registers, decode_registers(column_sketches[column]))
+        column_stats[column] = dict(
+            merge_summaries(column_stats.get(column), summary), distinct=hll_estimate(registers),
+        )
+        column_sketches[column] = encode_registers(registers)
+    return column_stats, column_sketches
+
+
+def update_stats(column_stats, column_sketches, df, schema):
+    """
+    Fold the rows of a chunk into the column statistics and sketches of a dataset, in time
+    proportional to the chunk. Returns the new (column_stats, column_sketches).
+
+    Each column's statistics hold count, nulls, min and max, mean and variance for numeric
+    columns, and the approximate number of distinct values from its sketch.
+    """
+    return merge_stats(column_stats, column_sketches, *chunk_stats(df, schema))
@@ -0,0 +1,757 @@
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.db.models import F, Func, Sum, TextField
+from django.db.models.functions import Cast, Length
+import glob
+import itertools
+import json
+import os
+import shutil
+import pandas as pd
+from .stats import update_stats
+from .instrumentation import stage
+from .zonemaps import block_bounds, may_match, predicate_bounds
+from .compression import check_codec, decode_block, encode_block
+
+try:
+    import pyarrow as pa
+except ImportError:  # Optional, only needed for the 'arrow' storage backend
+    pa = None
+
+
+STORAGE_BACKENDS = [
+    ('rows', 'CSVRow table'),
+    ('arrow', 'Arrow IPC files'),
+    ('compressed', 'Compressed JSON blocks'),
+]
+
+
+def default_backend():
+    """
+    Storage backend of new datasets, from the CSV_STORAGE_BACKEND setting.
+    """
+    return settings.CSV_STORAGE_BACKEND
+
+
+def can_copy():
+    """
+    Whether rows can be bulk loaded with COPY, on PostgreSQL through psycopg 3.
+    """
+    if connection.vendor != 'postgresql':
+        return False
+    from django.db.backends.postgresql.psycopg_any import is_psycopg3
+    return is_psycopg3
+
+
+class JSONValue(Func):
+    """
+    Value of one key of a JSONField with its JSON type, numbers as numbers and strings as strings,
+    so that whole rows are not decoded as JSON in Python. JSON null comes back as None.
+    """
+    output_field = TextField()
+
+    def __init__(self, field, key):
+        super().__init__(F(field))
+        self.key = key
+
+    def as_sqlite(self, compiler, connection):
+        sql, params = compiler.compile(self.source_expressions[0])
+        return f'JSON_EXTRACT({sql}, %s)', (*params, '$.' + json.dumps(self.key))
+
+    def as_sql(self, compiler, connection):
+        sql, params = compiler.compile(self.source_expressions[0])
+        return f'({sql} ->> %s)', (*params, self.key)
+
+    def as_postgresql(self, compiler, connection):
+        # ->> would give every value as text, the json value of -> is decoded by psycopg
+        sql, params = compiler.compile(self.source_expressions[0])
+        return f'({sql} -> %s)', (*params, self.key)
+
+
+class RowStore:
+    """
+    Rows a dataset stores itself in the CSVRow table, one JSON object per row at its row index.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def _queryset(self):
+        from .models import CSVRow
+
+        content_type = ContentType.objects.get_for_model(self.dataset)
+        return CSVRow.objects.filter(content_type=content_type, object_id=self.dataset.pk).order_by('row_index')
+
+    def read(self, start, stop):
+        """
+        Row dicts with a row index in [start, stop).
+        """
+        return list(self._queryset().filter(row_index__gte=start, row_index__lt=stop).values_list('data', flat=True))
+
+    def iter_read(self, start, stop, batch_size):
+        """
+        Row dicts with a row index in [start, stop), in lists of at most batch_size, streamed from one
+        query: through a server-side cursor on PostgreSQL, fetched a batch at a time on SQLite.
+        """
+        if stop - start <= batch_size:
+            yield self.read(start, stop)
+            return
+        queryset = self._queryset().filter(row_index__gte=start, row_index__lt=stop).values_list('data', flat=True)
+        rows = queryset.iterator(chunk_size=batch_size)
+        while batch := list(itertools.islice(rows, batch_size)):
+            yield batch
+
+    def read_at(self, indices):
+        """
+        Row dicts by row index for the given row indices.
+        """
+        return dict(self._queryset().filter(row_index__in=indices).values_list('row_index', 'data'))
+
+    def read_frame(self, columns, start, stop):
+        """
+        Rows in [start, stop) as a DataFrame indexed by row index.
+        With columns, only those keys are extracted from the stored rows by the database.
+        """
+        queryset = self._queryset().filter(row_index__gte=start, row_index__lt=stop)
+        chunk_size = settings.CSV_ROW_BATCH_SIZE
+        if columns is None:
+            records = list(queryset.values_list('row_index', 'data').iterator(chunk_size=chunk_size))
+            return pd.DataFrame.from_records([record[1] for record in records], index=[record[0] for record in records])
+
+        fields = {f'column_{position}': JSONValue('data', column) for position, column in enumerate(columns)}
+        records = list(queryset.annotate(**fields).values_list('row_index', *fields).iterator(chunk_size=chunk_size))
+        return pd.DataFrame.from_records([record[1:] for record in records], index=[record[0] for record in records], columns=columns)
+
+    def append(self, rows):
+        """
+        Append row dicts after the current last row, bulk inserted in batches.
+        """
+        from .models import CSVRow
+
+        content_type = ContentType.objects.get_for_model(self.dataset)
+        batch_size = settings.CSV_ROW_BATCH_SIZE
+        batch = []
+
+        for row in rows:
+            batch.append(CSVRow(
+                content_type=content_type,
+                object_id=self.dataset.pk,
+                row_index=self.dataset.row_count + len(batch),
+                data=row,
+            ))
+            if len(batch) >= batch_size:
+                self._insert(batch)
+                batch = []
+
+        if batch:
+            self._insert(batch)
+
+    def _insert(self, batch):
+        from .models import CSVRow
+
+        with stage('db_insert'):
+            if can_copy():
+                size = self._copy(batch)
+            else:
+                CSVRow.objects.bulk_create(batch)
+                # One dumps per batch, about the JSON text the database stores for the rows
+                size = len(json.dumps([row.data for row in batch]))
+        self.dataset.row_count += len(batch)
+        self.dataset.size_bytes += size
+
+    def _copy(self, batch):
+        """
+        Load CSVRows with COPY FROM STDIN, which PostgreSQL parses as one stream instead of
+        planning an INSERT per batch. Returns the size of the JSON text written.
+        """
+        from .models import CSVRow
+
+        fields = [CSVRow._meta.get_field(name) for name in ('content_type', 'object_id', 'row_index', 'data')]
+        quote = connection.ops.quote_name
+        sql = 'COPY {} ({}) FROM STDIN'.format(quote(CSVRow._meta.db_table), ', '.join(quote(field.column) for field in fields))
+
+        size = 0
+        with connection.cursor() as cursor, cursor.copy(sql) as copy:
+            for row in batch:
+                data = json.dumps(row.data)
+                size += len(data)
+                copy.write_row((row.content_type_id, row.object_id, row.row_index, data))
+        return size
+
+    def append_frame(self, df):
+        with stage('to_dict'):
+            rows = frame_to_rows(df)
+        self.append(rows)
+
+    def stored_size(self):
+        """
+        Size of the JSON text of the stored rows, computed by the database.
+        """
+        size = self._queryset().order_by().aggregate(size=Sum(Length(Cast('data', TextField()))))['size']
+        return size or 0
+
+    def truncate(self, row_count):
+        """
+        Delete the rows at row_count and after.
+        """
+        self._queryset().filter(row_index__gte=row_count).delete()
+
+    def clear(self):
+        self.dataset.stored_rows.all().delete()
+
+
+class ArrowStore:
+    """
+    Rows a dataset stores itself as Arrow IPC files in a directory under MEDIA_ROOT, one file per
+    appended batch, named after the row index of its first row.
+
+    Files are memory-mapped when read, so typed columns are used without decoding and a read
+    only touches the columns it projects. Needs pyarrow and a storage with local paths.
+    """
+
+    def __init__(self, dataset):
+        if pa is None:
+            raise ImproperlyConfigured("The 'arrow' storage backend needs pyarrow to be installed.")
+        self.dataset = dataset
+        self._table = None
+        self.start = 0
+
+    @property
+    def directory(self):
+        if not self.dataset.data_path:
+            self.dataset.data_path = f'datasets/{self.dataset._meta.model_name}/{self.dataset.pk}'
+        return default_storage.path(self.dataset.data_path)
+
+    @property
+    def table(self):
+        """
+        All stored rows as one Arrow table backed by the memory-mapped files.
+        """
+        if self._table is None:
+            paths = sorted(glob.glob(os.path.join(self.directory, 'part-*.arrow')))
+            tables = [pa.ipc.open_file(pa.memory_map(path)).read_all() for path in paths]
+            self.start = int(os.path.basename(paths[0])[len('part-'):-len('.arrow')]) if paths else 0
+            self._table = pa.concat_tables(tables, promote_options='default') if tables else pa.table({})
+        return self._table
+
+    def arrow_schema(self):
+        """
+        Arrow schema of the dataset from its column types, or None to infer it from the data.
+        """
+        schema = getattr(self.dataset, 'parent', self.dataset).schema
+        if not schema:
+            return None
+        types = {'integer': pa.int64(), 'float': pa.float64(), 'boolean': pa.bool_()}
+        return pa.schema([(column, types.get(col_type, pa.string())) for column, col_type in schema.items()])
+
+    def read(self, start, stop):
+        return self.table.slice(start - self.start, stop - start).to_pylist()
+
+    def iter_read(self, start, stop, batch_size):
+        for batch_start in range(start, stop, batch_size):
+            yield self.read(batch_start, min(batch_start + batch_size, stop))
+
+    def read_at(self, indices):
+        rows = self.table.take(pa.array([index - self.start for index in indices], type=pa.int64())).to_pylist()
+        return dict(zip(indices, rows))
+
+    def read_frame(self, columns, start, stop):
+        table = self.table.slice(start - self.start, stop - start)
+        if columns is not None:
+            table = table.select(columns)
+        df = table.to_pandas()
+        df.index = pd.RangeIndex(start, start + len(df))
+        return df
+
+    def _write(self, table):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'part-{self.dataset.row_count:012d}.arrow')
+        options = pa.ipc.IpcWriteOptions(compression=settings.CSV_ARROW_COMPRESSION)
+
+        with stage('write_arrow'):
+            with pa.OSFile(path + '.tmp', 'wb') as sink, pa.ipc.new_file(sink, table.schema, options=options) as writer:
+                writer.write_table(table)
+            os.replace(path + '.tmp', path)
+
+        self.dataset.row_count += table.num_rows
+        self.dataset.size_bytes += os.path.getsize(path)
+        self._table = None
+
+    def append(self, rows):
+        rows = list(rows)
+        if rows:
+            self._write(pa.Table.from_pylist(rows, schema=self.arrow_schema()))
+
+    def append_frame(self, df):
+        if len(df):
+            with stage('to_arrow'):
+                table = pa.Table.from_pandas(df, schema=self.arrow_schema(), preserve_index=False)
+            self._write(table)
+
+    def stored_size(self):
+        """
+        Total size of the stored Arrow files.
+        """
+        if not self.dataset.data_path:
+            return 0
+        return sum(os.path.getsize(path) for path in glob.glob(os.path.join(self.directory, 'part-*.arrow')))
+
+    def truncate(self, row_count):
+        """
+        Delete the files of the rows at row_count and after, and unfinished writes.
+        row_count must be the end of an appended batch, as files hold whole batches.
+        """
+        if not self.dataset.data_path:
+            return
+        for path in glob.glob(os.path.join(self.directory, 'part-*.arrow*')):
+            name = os.path.basename(path)
+            if name.endswith('.tmp') or int(name[len('part-'):].split('.')[0]) >= row_count:
+                os.remove(path)
+        self._table = None
+
+    def clear(self):
+        if self.dataset.data_path:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        self._table = None
+
+
+class CompressedStore:
+    """
+    Rows a dataset stores itself as compressed JSON in the CompressedRows table, one entry per block of
+    CSV_BLOCK_ROWS rows, so blocks line up with the zone maps. Blocks are compressed with
+    CSV_COMPRESSION_CODEC and, with CSV_COMPRESSION_KEY_DICTIONARY, name the columns once rather
+    than in every row. Each block records its codec, so blocks written with another one stay readable.
+
+    Reads decode the whole blocks they overlap, columns are projected after decoding.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def _queryset(self):
+        from .models import CompressedRows
+
+        content_type = ContentType.objects.get_for_model(self.dataset)
+        return CompressedRows.objects.filter(content_type=content_type, object_id=self.dataset.pk).order_by('start')
+
+    def _blocks(self, start, stop):
+        """
+        (start, columns, rows) of the decoded blocks that overlap [start, stop), in row order.
+        """
+        blocks = self._queryset().filter(stop__gt=start, start__lt=stop).values_list('start', 'codec', 'data')
+        with stage('decompress'):
+            return [(block_start, *decode_block(data, codec)) for block_start, codec, data in blocks]
+
+    def read(self, start, stop):
+        rows = []
+        for block_start, columns, values in self._blocks(start, stop):
+            values = values[max(start - block_start, 0):stop - block_start]
+            rows.extend(values if columns is None else [dict(zip(columns, row)) for row in values])
+        return rows
+
+    def iter_read(self, start, stop, batch_size):
+        for batch_start in range(start, stop, batch_size):
+            yield self.read(batch_start, min(batch_start + batch_size, stop))
+
+    def read_at(self, indices):
+        wanted = sorted(set(indices))
+        if not wanted:
+            return {}
+        # Find the blocks holding the rows first, only those are fetched and decoded
+        spans = self._queryset().filter(stop__gt=wanted[0], start__lt=wanted[-1] + 1).values_list('id', 'start', 'stop')
+        ids = [block_id for block_id, start, stop in spans if any(start <= index < stop for index in wanted)]
+
+        rows = {}
+        for block_start, codec, data in self._queryset().filter(id__in=ids).values_list('start', 'codec', 'data'):
+            columns, values = decode_block(data, codec)
+            for index in wanted:
+                if block_start <= index < block_start + len(values):
+                    row = values[index - block_start]
+                    rows[index] = row if columns is None else dict(zip(columns, row))
+        return rows
+
+    def read_frame(self, columns, start, stop):
+        frames = []
+        for block_start, block_columns, values in self._blocks(start, stop):
+            values = values[max(start - block_start, 0):stop - block_start]
+            frames.append(pd.DataFrame(values, columns=block_columns) if block_columns is not None else pd.DataFrame.from_records(values))
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        if columns is not None:
+            df = df.reindex(columns=columns)
+        df.index = pd.RangeIndex(start, start + len(df))
+        return df
+
+    def append(self, rows):
+        rows = list(rows)
+        columns = list(dict.fromkeys(key for row in rows for key in row))
+        self._write(columns, [[row.get(column) for column in columns] for row in rows])
+
+    def append_frame(self, df):
+        with stage('to_dict'):
+            columns = [df[column].astype(object).where(df[column].notna(), None).tolist() for column in df.columns]
+        self._write(list(df.columns), list(zip(*columns)))
+
+    def _write(self, columns, values):
+        """
+        Store rows given as value lists after the current last row, cut into blocks at multiples
+        of CSV_BLOCK_ROWS.
+        """
+        from .models import CompressedRows
+
+        codec, block_rows = settings.CSV_COMPRESSION_CODEC, settings.CSV_BLOCK_ROWS
+        check_codec(codec)
+        content_type = ContentType.objects.get_for_model(self.dataset)
+        blocks, position, start = [], 0, self.dataset.row_count
+        with stage('compress'):
+            while position < len(values):
+                size = block_rows - (start + position) % block_rows
+                data = encode_block(columns, values[position:position + size], codec, settings.CSV_COMPRESSION_KEY_DICTIONARY)
+                stop = start + min(position + size, len(values))
+                blocks.append(CompressedRows(
+                    content_type=content_type, object_id=self.dataset.pk, start=start + position, stop=stop, codec=codec, data=data,
+                ))
+                position += size
+
+        with stage('db_insert'):
+            CompressedRows.objects.bulk_create(blocks)
+        self.dataset.row_count += len(values)
+        self.dataset.size_bytes += sum(len(block.data) for block in blocks)
+
+    def stored_size(self):
+        """
+        Size of the compressed blocks, computed by the database.
+        """
+        size = self._queryset().order_by().aggregate(size=Sum(Length('data')))['size']
+        return size or 0
+
+    def truncate(self, row_count):
+        """
+        Delete the rows at row_count and after, re-encoding the block that holds both kept and deleted rows.
+        """
+        self._queryset().filter(start__gte=row_count).delete()
+        for block in self._queryset().filter(stop__gt=row_count):
+            columns, values = decode_block(block.data, block.codec)
+            values = values[:row_count - block.start]
+            if columns is None:
+                columns = list(dict.fromkeys(key for row in values for key in row))
+                values = [[row.get(column) for column in columns] for row in values]
+            block.data = encode_block(columns, values, block.codec, settings.CSV_COMPRESSION_KEY_DICTIONARY)
+            block.stop = row_count
+            block.save(update_fields=['data', 'stop'])
+
+    def clear(self):
+        self.dataset.compressed_rows.all().delete()
+
+
+STORES = {
+    'rows': RowStore,
+    'arrow': ArrowStore,
+    'compressed': CompressedStore,
+}
+
+
+class RowSet:
+    """
+    Lazy sequence over the rows of an UploadedCSV or DerivedCSV.
+    Supports len(), indexing, slicing and iteration; rows are only fetched for the range
+    that is asked for, in batches of CSV_ROW_BATCH_SIZE.
+
+    Datasets stored on top of a base read their leading rows from the base chain, so the
+    rows of a dataset are the concatenation of its segments. Each dataset of the chain keeps
+    its own rows in the store of its storage backend, and the zone maps of their blocks as RowBlocks.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.store = STORES[dataset.storage](dataset)
+        self._segments = None
+
+    @property
+    def segments(self):
+        """
+        (store, start, stop) ranges of row index that make up the dataset, in row order,
+        each read from the store of the dataset that holds them.
+        """
+        if self._segments is None:
+            segments = []
+            dataset, stop = self.dataset, self.dataset.row_count
+            while dataset is not None and stop > 0:
+                start = min(dataset.base_row_count, stop) if dataset.base_object_id else 0
+                if start < stop:
+                    store = self.store if dataset is self.dataset else STORES[dataset.storage](dataset)
+                    segments.append((store, start, stop))
+                stop = start
+                dataset = dataset.base if dataset.base_object_id else None
+            self._segments = segments[::-1]
+        return self._segments
+
+    def _pieces(self, start, stop):
+        """
+        (store, start, stop) parts of the row index range [start, stop), one per segment it overlaps.
+        """
+        for store, segment_start, segment_stop in self.segments:
+            low, high = max(start, segment_start), min(stop, segment_stop)
+            if low < high:
+                yield store, low, high
+
+    def __len__(self):
+        return self.dataset.row_count
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        return self.iter_rows()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            rows = list(self.iter_rows(start, stop))
+            return rows[::step] if step != 1 else rows
+
+        index = key + len(self) if key < 0 else key
+        if not 0 <= index < len(self):
+            raise IndexError("row index out of range")
+        return next(store.read(low, high)[0] for store, low, high in self._pieces(index, index + 1))
+
+    @property
+    def columns(self):
+        """
+        Column names of the dataset, taken from its first row.
+        """
+        return list(self[0].keys()) if self else []
+
+    def iter_batches(self, start=0, stop=None, batch_size=None, where=None):
+        """
+        Yield the rows in [start, stop) as lists of at most batch_size row dicts.
+        Each store streams its part of a range from one query, see RowStore.iter_read.
+        With where, blocks that cannot hold rows passing it are skipped, see iter_frames.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        batch_size = batch_size or settings.CSV_ROW_BATCH_SIZE
+
+        for range_start, range_stop in self.candidate_ranges(start, stop, where):
+            batch = []
+            for store, low, high in self._pieces(range_start, range_stop):
+                for rows in store.iter_read(low, high, batch_size):
+                    batch.extend(rows)
+                    while len(batch) >= batch_size:
+                        yield batch[:batch_size]
+                        batch = batch[batch_size:]
+            if batch:
+                yield batch
+
+    def iter_rows(self, start=0, stop=None):
+        for batch in self.iter_batches(start, stop):
+            yield from batch
+
+    def rows_at(self, indices):
+        """
+        Rows at the given row indices, in the order of the indices.
+        """
+        indices = [int(index) for index in indices]
+        found = {}
+        for store, segment_start, segment_stop in self.segments:
+            wanted = [index for index in indices if segment_start <= index < segment_stop]
+            if wanted:
+                found.update(store.read_at(wanted))
+        return [found[index] for index in indices]
+
+    def iter_frames(self, columns=None, start=0, stop=None, batch_size=None, where=None):
+        """
+        Yield the rows in [start, stop) as DataFrames indexed by row index.
+        With columns, only those columns are read from the stores.
+
+        With where, a list of (column, operator, typed value) predicates, only the blocks whose zone
+        maps allow a match are read. The rows of those blocks are yielded unfiltered, the caller
+        still applies the predicates.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        batch_size = batch_size or settings.CSV_FRAME_BATCH_SIZE
+        columns = list(columns) if columns is not None else None
+
+        for range_start, range_stop in self.candidate_ranges(start, stop, where):
+            for batch_start in range(range_start, range_stop, batch_size):
+                frames = [
+                    store.read_frame(columns, low, high)
+                    for store, low, high in self._pieces(batch_start, min(batch_start + batch_size, range_stop))
+                ]
+                yield frames[0] if len(frames) == 1 else pd.concat(frames)
+
+    def to_frame(self, columns=None, where=None):
+        """
+        All rows as one DataFrame indexed by row index, optionally only some columns,
+        and only the blocks that can hold rows passing where.
+        """
+        frames = list(self.iter_frames(columns, where=where))
+        if not frames:
+            return pd.DataFrame(columns=columns if columns is not None else self.columns)
+        return pd.concat(frames)
+
+    def candidate_ranges(self, start, stop, where=None):
+        """
+        Row index ranges within [start, stop) that can hold rows passing the where predicates,
+        judging by the zone maps of their blocks. Rows without zone maps, e.g. stored before
+        they were kept, are always read.
+        """
+        bounds = predicate_bounds(where or [], self._schema or {})
+        if not bounds:
+            return [(start, stop)] if start < stop else []
+
+        ranges = []
+
+        def add(low, high):
+            if low >= high:
+                return
+            if ranges and ranges[-1][1] >= low:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], high))
+            else:
+                ranges.append((low, high))
+
+        for store, low, high in self._pieces(start, stop):
+            position = low
+            for block_start, block_stop, block in self.blocks(store.dataset, low, high):
+                add(position, block_start)
+                if may_match(block, bounds):
+                    add(max(block_start, low), min(block_stop, high))
+                position = max(position, block_stop)
+            add(position, high)
+        return ranges
+
+    @staticmethod
+    def blocks(dataset, start, stop):
+        """
+        (start, stop, bounds) of the blocks of a dataset's own rows that overlap [start, stop), in row order.
+        """
+        from .models import RowBlock
+
+        content_type = ContentType.objects.get_for_model(dataset)
+        return RowBlock.objects.filter(
+            content_type=content_type, object_id=dataset.pk, stop__gt=start, start__lt=stop,
+        ).order_by('start').values_list('start', 'stop', 'bounds')
+
+    def append(self, rows):
+        """
+        Append row dicts after the current last row.
+        Updates dataset.row_count, dataset.size_bytes and the column statistics in memory;
+        the caller saves the dataset.
+        """
+        rows = list(rows)
+        first_row = self.dataset.row_count
+        self.store.append(rows)
+        df = pd.DataFrame.from_records(rows, columns=list(self._schema or {}))
+        self._update_stats(df)
+        self._write_blocks(df, first_row)
+        self._segments = None
+
+    def append_frame(self, df):
+        """
+        Append the rows of a DataFrame after the current last row, in the dataset column types.
+        Updates dataset.row_count, dataset.size_bytes and the column statistics in memory;
+        the caller saves the dataset.
+        """
+        first_row = self.dataset.row_count
+        self.store.append_frame(df)
+        self._update_stats(df)
+        self._write_blocks(df, first_row)
+        self._segments = None
+
+    @property
+    def _schema(self):
+        return getattr(self.dataset, 'parent', self.dataset).schema
+
+    def _update_stats(self, df):
+        """
+        Fold appended rows into the column statistics of the dataset, which cover all its rows.
+        """
+        if self._schema and len(df):
+            with stage('column_stats'):
+                self.dataset.column_stats, self.dataset.column_sketches = update_stats(
+                    self.dataset.column_stats, self.dataset.column_sketches, df, self._schema,
+                )
+
+    def _write_blocks(self, df, first_row):
+        """
+        Record the zone maps of the blocks of rows appended at row index first_row.
+        """
+        if self._schema and len(df):
+            with stage('zone_maps'):
+                self._create_blocks(block_bounds(df, self._schema, first_row, settings.CSV_BLOCK_ROWS))
+
+    def _create_blocks(self, blocks):
+        from .models import RowBlock
+
+        content_type = ContentType.objects.get_for_model(self.dataset)
+        RowBlock.objects.bulk_create([
+            RowBlock(content_type=content_type, object_id=self.dataset.pk, start=start, stop=stop, bounds=bounds)
+            for start, stop, bounds in blocks
+        ])
+
+    def materialize(self):
+        """
+        Copy the rows read from the base chain into the dataset itself and detach it from its base.
+        Updates the dataset in memory; the caller saves it.
+        """
+        dataset = self.dataset
+        if not dataset.base_object_id:
+            return
+
+        base_rows = RowSet(dataset.base)
+        base_batches = base_rows.iter_batches(0, dataset.base_row_count, settings.CSV_FRAME_BATCH_SIZE)
+        # The zone maps of the base rows hold for their copies, clipped to the rows taken from each base
+        base_blocks = [
+            (max(block_start, low), min(block_stop, high), bounds)
+            for store, low, high in base_rows._pieces(0, dataset.base_row_count)
+            for block_start, block_stop, bounds in self.blocks(store.dataset, low, high)
+        ]
+        total_rows = dataset.row_count
+
+        dataset.base_content_type = None
+        dataset.base_object_id = None
+        dataset.base_row_count = 0
+        dataset.chain_depth = 0
+
+        # Own rows already sit at their final row index, only the base rows are copied in front
+        dataset.row_count = 0
+        for batch in base_batches:
+            self.store.append(batch)
+        dataset.row_count = total_rows
+        self._create_blocks(base_blocks)
+        self._segments = None
+
+    def truncate(self):
+        """
+        Delete rows stored past dataset.row_count, left by a write that was never committed with
+        the dataset, e.g. by a worker that died halfway through processing.
+        """
+        self.store.truncate(self.dataset.row_count)
+        self.dataset.row_blocks.filter(stop__gt=self.dataset.row_count).delete()
+        self._segments = None
+
+    def clear(self):
+        """
+        Delete the rows stored for the dataset itself; rows read from a base are kept.
+        """
+        dataset = self.dataset
+        self.store.clear()
+        dataset.row_blocks.all().delete()
+        dataset.row_count = dataset.base_row_count if dataset.base_object_id else 0
+        dataset.size_bytes = 0
+        if dataset.base_object_id and dataset.base_row_count == dataset.base.row_count:
+            dataset.column_stats, dataset.column_sketches = dataset.base.column_stats, dataset.base.column_sketches
+        else:
+            dataset.column_stats = dataset.column_sketches = None
+        self._segments = None
+
+
+def frame_to_rows(df):
+    """
+    Convert a DataFrame to a list of row dicts, with missing values as None so they store as JSON null.
+    Columns are converted to Python lists first, which is much faster than DataFrame.to_dict.
+    """
+    names = list(df.columns)
+    columns = [df[column].astype(object).where(df[column].notna(), None).tolist() for column in names]
+    return [dict(zip(names, values)) for values in zip(*columns)]
@@ -0,0 +1,218 @@
+import hashlib
+import json
+import time
+from django.conf import settings
+import numpy as np
+import pandas as pd
+from .caching import cache_key, dataset_cache, is_cacheable, record
+from .schema import BOOLEAN_VALUES, DATETIME_OUTPUT_FORMAT, DATE_OUTPUT_FORMAT
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:  # Optional, parses stored datetimes faster when installed
+    pa = None
+
+
+COMPARISONS = {'eq': 'eq', 'ne': 'ne', 'gt': 'gt', 'gte': 'ge', 'lt': 'lt', 'lte': 'le'}  # Filter operator to Series method
+MAX_PAGE_SIZE = 1000
+
+
+class TableQueryError(ValueError):
+    """
+    Raised for table page parameters that do not match the dataset schema.
+    """
+
+
+def parse_table_query(params, schema):
+    """
+    Read offset/limit (or cursor), sort/order and column filters from request parameters.
+    Filters are given as <column>__<operator>=<value>, or <column>=<value> for equality,
+    and their values are typed by the schema.
+    """
+    try:
+        offset = int(params.get('cursor', params.get('offset', 0)))
+        limit = int(params.get('limit', 100))
+    except ValueError:
+        raise TableQueryError("offset, cursor and limit must be integers.")
+    if offset < 0 or not 0 < limit <= MAX_PAGE_SIZE:
+        raise TableQueryError(f"offset must not be negative and limit between 1 and {MAX_PAGE_SIZE}.")
+
+    sort = params.get('sort') or None
+    if sort is not None and sort not in schema:
+        raise TableQueryError(f"Unknown sort column '{sort}'.")
+    descending = params.get('order', 'asc') == 'desc'
+
+    return {'offset': offset, 'limit': limit, 'sort': sort, 'descending': descending, 'filters': parse_filters(params, schema)}
+
+
+def parse_filters(params, schema):
+    """
+    Column filters from request parameters, as (column, operator, typed value):
+    <column>__<operator>=<value>, or <column>=<value> for equality. Other parameters are ignored.
+    """
+    filters = []
+    for key, value in params.items():
+        column, _, operator = key.partition('__')
+        if column not in schema or value == '':
+            continue
+        operator = operator or 'eq'
+        if operator not in COMPARISONS and operator != 'contains':
+            raise TableQueryError(f"Unknown filter operator '{operator}' for column '{column}'.")
+        if operator == 'contains' and schema[column] != 'string':
+            raise TableQueryError(f"'contains' only applies to string columns, '{column}' is {schema[column]}.")
+        filters.append((column, operator, coerce_value(value, schema[column], column)))
+    return filters
+
+
+def coerce_value(value, col_type, column):
+    """
+    Convert a filter value from the query string to the type of its column.
+    """
+    try:
+        if col_type == 'integer' or col_type == 'float':
+            return float(value)
+        if col_type == 'datetime' or col_type == 'date':
+            return pd.Timestamp(value.replace('T', ' '))
+        if col_type == 'boolean':
+            return BOOLEAN_VALUES[value.strip().lower()]
+    except (ValueError, KeyError):
+        raise TableQueryError(f"Invalid {col_type} value '{value}' for column '{column}'.")
+    return str(value)
+
+
+def coerce_column(series, col_type):
+    """
+    Convert a column read from the row store to a typed pandas Series for comparisons and sorting.
+    """
+    if col_type == 'integer' or col_type == 'float':
+        return pd.to_numeric(series, errors='coerce')
+    if col_type == 'datetime':
+        return parse_stored_datetimes(series, DATETIME_OUTPUT_FORMAT)
+    if col_type == 'date':
+        return parse_stored_datetimes(series, DATE_OUTPUT_FORMAT)
+    if col_type == 'boolean':
+        # Databases return JSON booleans as 1/0 or as 'true'/'false'
+        return series.map({True: True, False: False, 'true': True, 'false': False}).astype('boolean')
+    return series.astype('string')
+
+
+def parse_stored_datetimes(series, fmt):
+    """
+    Parse datetimes stored as text in one format, with pyarrow's strptime when it is installed,
+    which is about three times faster than pandas'. Values that do not parse become missing.
+    """
+    if pa is not None:
+        try:
+            parsed = pc.strptime(pa.array(series, type=pa.string(), from_pandas=True), format=fmt, unit='us', error_is_null=True)
+            return pd.Series(parsed.to_numpy(zero_copy_only=False), index=series.index, name=series.name)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass  # Not all text, e.g. a column widened to datetime
+    return pd.to_datetime(series, format=fmt, errors='coerce')
+
+
+def apply_filter(series, operator, value):
+    """
+    Boolean mask of the values in a typed column that pass one filter.
+    """
+    if operator == 'contains':
+        return series.str.contains(value, case=False, regex=False, na=False)
+    return getattr(series, COMPARISONS[operator])(value).fillna(False).astype(bool)
+
+
+def filter_mask(df, schema, filters):
+    """
+    Boolean mask of the rows of a DataFrame that pass all filters.
+    """
+    mask = pd.Series(True, index=df.index)
+    for column, operator, value in filters:
+        mask &= apply_filter(coerce_column(df[column], schema[column]), operator, value)
+    return mask
+
+
+def ordered_indices(rows, schema, sort, descending, filters):
+    """
+    Row indices of the dataset that pass the filters, in sort order, computed with pandas
+    over the needed columns.
+    """
+    columns = sorted({column for column, _, _ in filters} | ({sort} if sort else set()))
+    df = rows.to_frame(columns, where=filters)
+    mask = filter_mask(df, schema, filters)
+
+    if sort:
+        ordered = coerce_column(df.loc[mask, sort], schema[sort])
+        ordered = ordered.sort_values(ascending=not descending, kind='stable', na_position='last')
+        return ordered.index.to_numpy(dtype='int64')
+    return df.index[mask].to_numpy(dtype='int64')
+
+
+def ordered_page(rows, schema, query):
+    """
+    The row indices of one page of a sorted or filtered table, and the number of matching rows.
+
+    The ordering is computed once per dataset version and query, and cached in the dataset cache
+    in chunks of CSV_ORDER_CHUNK_ROWS indices, so a page only loads the one or two chunks it falls in
+    rather than an index per row of the dataset. Datasets still being processed are ordered every time.
+    """
+    offset, limit = query['offset'], query['limit']
+    dataset = rows.dataset
+    arguments = (rows, schema, query['sort'], query['descending'], query['filters'])
+    if not is_cacheable(dataset):
+        indices = ordered_indices(*arguments)
+        return indices[offset:offset + limit], len(indices)
+
+    start = time.perf_counter()
+    cache = dataset_cache()
+    chunk_rows = settings.CSV_ORDER_CHUNK_ROWS
+    query_key = hashlib.sha1(json.dumps([query['sort'], query['descending'], query['filters']], default=str).encode()).hexdigest()
+    total_key = cache_key('order', dataset, query_key)
+
+    total = cache.get(total_key)
+    if total is not None:
+        stop = min(offset + limit, total)
+        numbers = range(offset // chunk_rows, (stop - 1) // chunk_rows + 1) if offset < stop else range(0)
+        keys = [cache_key('order', dataset, query_key, number) for number in numbers]
+        chunks = cache.get_many(keys)
+        if len(chunks) == len(keys):
+            record('order', True, time.perf_counter() - start)
+            if not keys:
+                return np.empty(0, dtype='int64'), total
+            indices = np.concatenate([chunks[key] for key in keys])
+            first = numbers[0] * chunk_rows
+            return indices[offset - first:stop - first], total
+
+    # Not cached, or some chunks were evicted: order again and cache every chunk
+    indices = ordered_indices(*arguments)
+    values = {
+        cache_key('order', dataset, query_key, position // chunk_rows): indices[position:position + chunk_rows]
+        for position in range(0, len(indices), chunk_rows)
+    }
+    values[total_key] = len(indices)
+    cache.set_many(values)
+    record('order', False, time.perf_counter() - start)
+    return indices[offset:offset + limit], len(indices)
+
+
+def table_page(rows, schema, query):
+    """
+    One page of a dataset as {'columns', 'rows', 'total', 'offset', 'limit', 'next_cursor'}.
+    Without sorting and filtering the page is a row_index range read straight from the row store.
+    """
+    offset, limit = query['offset'], query['limit']
+    columns = list(schema)
+
+    if query['sort'] or query['filters']:
+        indices, total = ordered_page(rows, schema, query)
+        page = rows.rows_at(indices)
+    else:
+        total = len(rows)
+        page = list(rows.iter_rows(offset, offset + limit))
+
+    return {
+        'columns': columns,
+        'rows': [[row.get(column) for column in columns] for row in page],
+        'total': total,
+        'offset': offset,
+        'limit': limit,
+        'next_cursor': offset + limit if offset + limit < total else None,
+    }
@@ -1,117 +1,479 @@
 import csv
 import io
-import re
-from celery import shared_task
-from .models import UploadedCSV, DerivedCSV, CSVChanges
-from datetime import datetime
+import uuid
+from celery import chord, shared_task
+from .models import UploadedCSV, DerivedCSV, CSVChanges, ProcessingRun
+from datetime import datetime, timedelta
 from django.contrib.contenttypes.models import ContentType
-import copy
-import json
 from .utils import send_csv_email
+from .schema import infer_column_types, merge_column_types, normalize_frame, normalize_header, schema_of
+from .transforms import TransformPipeline, needs_lookback
+from .partitions import ByteRange, split_byte_ranges
+from .fingerprints import transformed_hash, appended_hash
+from .stats import merge_stats
+from .caching import invalidate
+from .instrumentation import instrumented, stage, timed_iter, record_dataset, count, record_failure
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
 import pandas as pd
-from io import StringIO
 
 
-@shared_task
+# Fields of a dataset that change as rows are appended, saved with each processed chunk
+CHECKPOINT_FIELDS = ['row_count', 'size_bytes', 'column_stats', 'column_sketches', 'data_path', 'updated_at']
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+@instrumented('process_csv')
 def process_csv(uploaded_csv_id):
     """
     Celery task to process the uploaded CSV:
     Normalize headers, infer schema using pandas with datetime detection, and save as a DerivedCSV.
+
+    The raw file is read in chunks of ``CSV_CHUNK_ROWS`` rows. A first pass infers and widens the
+    schema across all chunks, a second pass normalizes each chunk with that schema, derives it with
+    the ``CSV_DERIVED_TRANSFORMS`` pipeline and appends its rows to the row store.
+
+    Processing is checkpointed: each chunk of the second pass is committed together with the row
+    counts of both datasets, and a run restarted after its worker died resumes after the last
+    committed chunk, see resume_point. A run first claims the upload, so a duplicate delivery of
+    the task does nothing while another run is working on it or once it is processed. The task is
+    acknowledged late, so the broker delivers it again when its worker is lost.
+
+    Files of at least ``CSV_PARALLEL_MIN_BYTES`` are split into ``CSV_PARALLEL_PARTITIONS`` byte
+    ranges when that is more than 1, and both passes run as one subtask per range, see
+    process_csv_in_parallel.
+
+    A raw file identical to an already processed upload is not read at all: its schema and rows
+    are reused from that upload, and its derived rows from the identical derived body when there is one.
+
+    Each run is recorded as a ProcessingRun with the time spent reading, inferring, coercing,
+    transforming and storing the rows, see instrumentation.py.
     """
+    token = uuid.uuid4().hex
+    derived_csv = None
     try:
         uploaded_csv = UploadedCSV.objects.get(id=uploaded_csv_id)
-        uploaded_csv.status = 'processing'
-        uploaded_csv.save()
+        if not claim_upload(uploaded_csv_id, token):
+            return f"UploadedCSV {uploaded_csv_id} is processed or being processed by another run."
+        uploaded_csv.refresh_from_db()
+        record_dataset(uploaded_csv)
+        invalidate(uploaded_csv)  # Reprocessing, drop the responses cached for the previous rows
+
+        original = processed_duplicate(uploaded_csv)
+        if original is not None:
+            discard_partial(uploaded_csv)
+            uploaded_csv.schema = original.schema
+            uploaded_csv.share_rows(original)
+            uploaded_csv.save()
+
+            transform = TransformPipeline(uploaded_csv.schema)
+            derived_csv = DerivedCSV(parent=uploaded_csv, content_hash=transformed_hash(uploaded_csv.content_hash, transform))
+            identical = identical_derived(derived_csv.content_hash)
+            if identical is not None:
+                derived_csv.share_rows(identical)
+                derived_csv.save()
+            else:
+                # The pipeline changed since, derive the reused rows without parsing the file again
+                derived_csv.save()
+                for df in timed_iter('read_rows', uploaded_csv.rows.iter_frames()):
+                    with stage('transform'):
+                        df = transform(df)
+                    with stage('store'):
+                        derived_csv.rows.append_frame(df)
+                    update_claimed(uploaded_csv, token)
+                derived_csv.save()
+
+            update_claimed(uploaded_csv, token, status='processed', rows_done=uploaded_csv.row_count, rows_total=uploaded_csv.row_count)
+            count(row_count=uploaded_csv.row_count)
+            return
+
+        partitions = settings.CSV_PARALLEL_PARTITIONS
+        if partitions > 1 and uploaded_csv.raw_file.size >= settings.CSV_PARALLEL_MIN_BYTES and not needs_lookback():
+            discard_partial(uploaded_csv)
+            process_csv_in_parallel(uploaded_csv, partitions, token)
+            return
+
+        resumed = resume_point(uploaded_csv)
+        resumed_at_row = uploaded_csv.row_count if resumed is not None else 0
+        if resumed is not None:
+            column_types, derived_csv = resumed
+            transform = TransformPipeline(uploaded_csv.schema)
+            update_claimed(uploaded_csv, token, rows_done=resumed_at_row, checkpoint=dict(uploaded_csv.checkpoint, resumed_at_row=resumed_at_row))
+            chunks = ((df, None) for df in read_csv_chunks(uploaded_csv, skip_rows=resumed_at_row))
+        else:
+            discard_partial(uploaded_csv)
+
+            # Infer schema using pandas with datetime detection, chunk by chunk
+            column_types, chunk_count, rows_total = {}, 0, 0
+            for df in read_csv_chunks(uploaded_csv):
+                with stage('infer_schema'):
+                    chunk_column_types, coerced = infer_column_types(df)
+                    column_types = merge_column_types(column_types, chunk_column_types)
+                chunk_count += 1
+                rows_total += len(df)
+                update_claimed(uploaded_csv, token)
+            schema = schema_of(column_types)
+
+            # Save schema, rows are written chunk by chunk below
+            update_claimed(uploaded_csv, token, schema=schema)
+
+            # Create a DerivedCSV entry
+            transform = TransformPipeline(schema)
+            derived_csv = DerivedCSV.objects.create(
+                parent=uploaded_csv, content_hash=transformed_hash(uploaded_csv.content_hash, transform),
+            )
+            update_claimed(
+                uploaded_csv, token, rows_done=0, rows_total=rows_total,
+                checkpoint={'column_types': column_types, 'derived_csv_id': derived_csv.id},
+            )
+
+            # A single chunk was already coerced while inferring, larger files are read again
+            if chunk_count == 1:
+                chunks = [(df, coerced)]
+            else:
+                chunks = ((df, None) for df in read_csv_chunks(uploaded_csv))
+
+        for df, coerced in chunks:
+            commit_chunk(uploaded_csv, derived_csv, token, df, column_types, coerced, transform)
+
+        # Mark the uploaded CSV as processed
+        update_claimed(uploaded_csv, token, status='processed', checkpoint=None)
+        count(row_count=uploaded_csv.row_count - resumed_at_row, size_bytes=uploaded_csv.raw_file.size)
+
+    except UploadedCSV.DoesNotExist:
+        print(f"UploadedCSV with ID {uploaded_csv_id} does not exist.")
+    except ProcessingSuperseded as e:
+        # The rows of the chunk in progress were rolled back, the newer run carries on
+        print(f"Stopped processing CSV: {e}")
+    except Exception as e:
+        error_message = str(e)
+        fail_processing(uploaded_csv, token, error_message)
+        record_failure(error_message)
+        print(f"Error processing CSV: {error_message}")
 
-        raw_csv = json.loads(uploaded_csv.content)  # Load raw CSV string stored as JSON
 
-        # Load the raw CSV into pandas DataFrame
-        df = pd.read_csv(StringIO(raw_csv))
+class ProcessingSuperseded(Exception):
+    """
+    Raised in a run of process_csv whose claim on the upload was taken over by a newer run.
+    """
 
-        # Normalize column headers
-        df.columns = [re.sub(r'[^\w\s]', '', col).strip().replace(' ', '_').lower() for col in df.columns]
 
-        # Infer schema using pandas with datetime detection
-        schema = infer_schema_with_pandas(df)
+def claim_upload(uploaded_csv_id, token):
+    """
+    Claim the processing of an UploadedCSV for the run identified by token. Returns whether it was claimed.
 
-        # Normalize data based on inferred schema
-        for column, col_type in schema.items():
-            if col_type == "datetime":
-                df[column] = pd.to_datetime(df[column], format="%Y-%m-%d %H:%M:%S", errors="coerce")
-                df[column] = df[column].dt.strftime("%Y-%m-%d %H:%M:%S")  # Convert datetime to string
-            elif col_type == "date":
-                df[column] = pd.to_datetime(df[column], format="%Y-%m-%d", errors="coerce").dt.date
-                df[column] = df[column].astype(str)  # Convert date to string for JSON serialization
+    Unprocessed and failed uploads can be claimed, and uploads left processing by a run that made no
+    progress for ``CSV_PROCESSING_STALE_AFTER`` seconds, its worker being gone. Processed uploads and
+    uploads another run is working on cannot, e.g. by a duplicate delivery of the task.
+    """
+    now = timezone.now()
+    stale = Q(heartbeat_at__lt=now - timedelta(seconds=settings.CSV_PROCESSING_STALE_AFTER)) | Q(heartbeat_at__isnull=True)
+    return UploadedCSV.objects.filter(
+        Q(status__in=['unprocessed', 'failed_processing']) | Q(stale, status='processing'), id=uploaded_csv_id,
+    ).update(
+        status='processing', processing_token=token, processing_attempts=F('processing_attempts') + 1,
+        processing_started_at=now, heartbeat_at=now, failure_reason=None,
+    ) == 1
 
-        normalized_data = df.to_dict(orient="records")
 
-        # Save normalized data and schema
-        uploaded_csv.schema = schema
-        uploaded_csv.content = normalized_data
-        uploaded_csv.save()
+def update_claimed(uploaded_csv, token, **fields):
+    """
+    Update fields of an UploadedCSV, in the database and in memory, if the run identified by token
+    still holds its claim. Every update is a heartbeat of the run, see retry_failed_and_unprocessed_csvs.
+    Raises ProcessingSuperseded when another run took over the upload.
+    """
+    fields['heartbeat_at'] = timezone.now()
+    if fields.get('status') in ('processed', 'failed_processing'):
+        fields['processing_token'] = ''
+        fields['updated_at'] = fields['heartbeat_at']
+    if not UploadedCSV.objects.filter(id=uploaded_csv.id, processing_token=token).update(**fields):
+        raise ProcessingSuperseded(f"UploadedCSV {uploaded_csv.id} is processed by another run.")
+    for name, value in fields.items():
+        if not hasattr(value, 'resolve_expression'):  # Increments are left to the database
+            setattr(uploaded_csv, name, value)
+
+
+def commit_chunk(uploaded_csv, derived_csv, token, df, column_types, coerced, transform):
+    """
+    Normalize, derive and store one chunk of an upload in one transaction, together with the rows,
+    sizes and statistics of both datasets and the progress, so the saved row counts are a checkpoint.
+    """
+    with transaction.atomic():
+        # Normalize data based on inferred schema
+        with stage('coerce'):
+            df = normalize_frame(df, column_types, coerced)
+        with stage('store'):
+            uploaded_csv.rows.append_frame(df)
 
         # Process the data (e.g., divide integers/floats)
-        processed_data = []
-        for row in normalized_data:
-            processed_row = {}
-            for key, value in row.items():
-                if schema[key] == "integer" and pd.notna(value):
-                    processed_row[key] = int(value) // 2
-                elif schema[key] == "float" and pd.notna(value):
-                    processed_row[key] = float(value) / 2
-                else:
-                    processed_row[key] = value
-            processed_data.append(processed_row)
-
-        # Create a DerivedCSV entry
-        DerivedCSV.objects.create(parent=uploaded_csv, content=processed_data)
+        with stage('transform'):
+            derived_df = transform(df)
+        with stage('store'):
+            derived_csv.rows.append_frame(derived_df)
 
-        # Mark the uploaded CSV as processed
-        uploaded_csv.status = 'processed'
-        uploaded_csv.save()
+        with stage('save'):
+            update_claimed(uploaded_csv, token, rows_done=uploaded_csv.row_count)
+            uploaded_csv.save(update_fields=CHECKPOINT_FIELDS)
+            derived_csv.save(update_fields=CHECKPOINT_FIELDS)
 
-    except UploadedCSV.DoesNotExist:
-        print(f"UploadedCSV with ID {uploaded_csv_id} does not exist.")
-    except Exception as e:
-        error_message = str(e)
-        uploaded_csv.status = 'failed_processing'
-        uploaded_csv.failure_reason = error_message
-        uploaded_csv.save()
-        print(f"Error processing CSV: {error_message}")
 
-def infer_schema_with_pandas(df):
+def resume_point(uploaded_csv):
     """
-    Infer the schema of a pandas DataFrame, including datetime detection.
-    Returns a dictionary with column names as keys and data types as values.
+    Column types and DerivedCSV to resume processing an upload with, from the checkpoint of an
+    earlier run; the rows that run stored after its last committed chunk are deleted.
+    None when processing has to start over: there is no checkpoint, its DerivedCSV is gone, or the
+    transforms carry rows over from one chunk to the next (see needs_lookback).
+    """
+    checkpoint = uploaded_csv.checkpoint or {}
+    if 'column_types' not in checkpoint or needs_lookback():
+        return None
+    derived_csv = DerivedCSV.objects.filter(id=checkpoint['derived_csv_id'], parent=uploaded_csv).first()
+    if derived_csv is None:
+        return None
+
+    uploaded_csv.rows.truncate()
+    derived_csv.rows.truncate()
+    # Types come back from JSON as lists
+    column_types = {column: tuple(column_type) for column, column_type in checkpoint['column_types'].items()}
+    return column_types, derived_csv
+
+
+def discard_partial(uploaded_csv):
+    """
+    Drop what earlier runs wrote for an upload: its rows, and the DerivedCSV of its checkpoint.
+    """
+    derived_csv_id = (uploaded_csv.checkpoint or {}).get('derived_csv_id')
+    if derived_csv_id is not None:
+        DerivedCSV.objects.filter(id=derived_csv_id, parent=uploaded_csv).delete()
+    uploaded_csv.rows.clear()
+    uploaded_csv.checkpoint = None
+    uploaded_csv.save(update_fields=CHECKPOINT_FIELDS + ['checkpoint'])
+
+
+def fail_processing(uploaded_csv, token, error_message):
+    """
+    Mark an upload as failed by the run identified by token. The checkpoint is kept so a retry resumes
+    from it, until the upload is out of its ``CSV_PROCESSING_MAX_ATTEMPTS`` and the rows written so far are dropped.
+    Does nothing when another run took over the upload, the newer run reports its own outcome.
+    """
+    with transaction.atomic():
+        # Locked so no run claims the upload between the check and the discard
+        if not UploadedCSV.objects.select_for_update().filter(id=uploaded_csv.id, processing_token=token).exists():
+            return
+        if uploaded_csv.processing_attempts >= settings.CSV_PROCESSING_MAX_ATTEMPTS:
+            discard_partial(uploaded_csv)
+        update_claimed(uploaded_csv, token, status='failed_processing', failure_reason=error_message)
+
+
+def processed_duplicate(uploaded_csv):
+    """
+    The first processed UploadedCSV whose raw file has the same content hash as uploaded_csv, if any.
+    """
+    if not uploaded_csv.content_hash:
+        return None
+    return (
+        UploadedCSV.objects.filter(content_hash=uploaded_csv.content_hash, status='processed')
+        .exclude(id=uploaded_csv.id)
+        .order_by('id')
+        .first()
+    )
+
+
+def identical_derived(content_hash):
+    """
+    The first complete DerivedCSV with the given content hash, if any.
+    Derived CSVs of uploads still being processed may be partly written and are left out.
+    """
+    if not content_hash:
+        return None
+    return DerivedCSV.objects.filter(content_hash=content_hash, parent__status='processed').order_by('id').first()
+
+
+def process_csv_in_parallel(uploaded_csv, partitions, token):
+    """
+    Process an UploadedCSV as a map/reduce over byte ranges of its raw file, for the run of
+    process_csv identified by token.
+
+    A chord of infer_partition subtasks infers the column types and counts the rows of each range,
+    plan_partitions widens the types into the schema and gives each range its first row index,
+    then a chord of write_partition subtasks normalizes, derives and stores the ranges side by side
+    and finish_processing records the totals.
+
+    The ranges are written side by side without a checkpoint, a parallel run that stopped is
+    started over.
+    """
+    with uploaded_csv.raw_file.open('rb') as source:
+        byte_ranges = split_byte_ranges(source, partitions)
+
+    chord(
+        infer_partition.s(uploaded_csv.id, start, stop, token) for start, stop in byte_ranges
+    )(plan_partitions.s(uploaded_csv.id, byte_ranges, token).on_error(processing_failed.s(uploaded_csv.id, token=token)))
+
+
+@shared_task
+@instrumented('infer_partition')
+def infer_partition(uploaded_csv_id, start, stop, token):
+    """
+    Map step of the first pass: column types and row count of one byte range of the raw file.
+    """
+    uploaded_csv = UploadedCSV.objects.get(id=uploaded_csv_id)
+    record_dataset(uploaded_csv)
+    column_types, row_count = {}, 0
+    for df in read_csv_chunks(uploaded_csv, byte_range=(start, stop)):
+        with stage('infer_schema'):
+            chunk_column_types, _ = infer_column_types(df)
+            column_types = merge_column_types(column_types, chunk_column_types)
+        row_count += len(df)
+        update_claimed(uploaded_csv, token)
+    count(row_count=row_count, size_bytes=stop - start)
+    return {'column_types': column_types, 'row_count': row_count}
+
+
+@shared_task
+@instrumented('plan_partitions')
+def plan_partitions(results, uploaded_csv_id, byte_ranges, token):
     """
-    dtype_mapping = {
-        "int64": "integer",
-        "float64": "float",
-        "object": "string",
+    Reduce step of the first pass: widen the column types of all ranges into the schema and start
+    writing the ranges, each at the row index that follows the rows of the ranges before it.
+    """
+    column_types = {}
+    for result in results:
+        # Types come back from JSON as lists
+        chunk_column_types = {column: tuple(column_type) for column, column_type in result['column_types'].items()}
+        column_types = merge_column_types(column_types, chunk_column_types)
+
+    uploaded_csv = UploadedCSV.objects.get(id=uploaded_csv_id)
+    record_dataset(uploaded_csv)
+    update_claimed(uploaded_csv, token, schema=schema_of(column_types))
+    transform = TransformPipeline(uploaded_csv.schema)
+    derived_csv = DerivedCSV.objects.create(
+        parent=uploaded_csv, content_hash=transformed_hash(uploaded_csv.content_hash, transform),
+    )
+
+    row_offsets = [0]
+    for result in results:
+        row_offsets.append(row_offsets[-1] + result['row_count'])
+    # No column types in the checkpoint, a restarted run only drops the DerivedCSV
+    update_claimed(uploaded_csv, token, rows_done=0, rows_total=row_offsets[-1], checkpoint={'derived_csv_id': derived_csv.id})
+
+    try:
+        chord(
+            write_partition.s(uploaded_csv_id, derived_csv.id, start, stop, row_offset, column_types, token)
+            for (start, stop), row_offset in zip(byte_ranges, row_offsets)
+        )(finish_processing.s(uploaded_csv_id, derived_csv.id, row_offsets[-1], token).on_error(
+            processing_failed.s(uploaded_csv_id, derived_csv.id, token=token)
+        ))
+    except Exception:
+        # Eager tasks run the ranges right away and raise here instead of calling the error callback
+        derived_csv.delete()
+        raise
+
+
+@shared_task
+@instrumented('write_partition')
+def write_partition(uploaded_csv_id, derived_csv_id, start, stop, row_offset, column_types, token):
+    """
+    Map step of the second pass: normalize, derive and store the rows of one byte range.
+    Returns the column statistics and sketches of the range for both datasets.
+    """
+    uploaded_csv = UploadedCSV.objects.get(id=uploaded_csv_id)
+    derived_csv = DerivedCSV.objects.get(id=derived_csv_id)
+    record_dataset(uploaded_csv)
+    column_types = {column: tuple(column_type) for column, column_type in column_types.items()}
+    transform = TransformPipeline(uploaded_csv.schema)
+
+    # The rows of this range start at row_offset, the datasets are saved by finish_processing
+    uploaded_csv.row_count = derived_csv.row_count = row_offset
+    for df in read_csv_chunks(uploaded_csv, byte_range=(start, stop)):
+        with stage('coerce'):
+            df = normalize_frame(df, column_types)
+        with stage('store'):
+            uploaded_csv.rows.append_frame(df)
+        with stage('transform'):
+            derived_df = transform(df)
+        with stage('store'):
+            derived_csv.rows.append_frame(derived_df)
+        update_claimed(uploaded_csv, token, rows_done=F('rows_done') + len(df))
+    count(row_count=uploaded_csv.row_count - row_offset, size_bytes=stop - start)
+
+    # Arrow stores name their directory on the first write, every range gets the same one
+    UploadedCSV.objects.filter(id=uploaded_csv_id).update(data_path=uploaded_csv.data_path)
+    DerivedCSV.objects.filter(id=derived_csv_id).update(data_path=derived_csv.data_path)
+    return {
+        'uploaded': [uploaded_csv.column_stats or {}, uploaded_csv.column_sketches or {}],
+        'derived': [derived_csv.column_stats or {}, derived_csv.column_sketches or {}],
     }
 
-    schema = {}
-    for column in df.columns:
-        dtype = str(df[column].dtypes)
-
-        # Check if column is datetime-like
-        if dtype == "object":  # Likely a string column
-            try:
-                pd.to_datetime(df[column], format="%Y-%m-%d %H:%M:%S", errors="raise")
-                schema[column] = "datetime"
-                continue
-            except ValueError:
-                try:
-                    pd.to_datetime(df[column], format="%Y-%m-%d", errors="raise")
-                    schema[column] = "date"
-                    continue
-                except ValueError:
-                    pass  # If both fail, fallback to string
 
-        # Map the dtype using the standard mapping
-        schema[column] = dtype_mapping.get(dtype, "string")  # Default to "string"
+@shared_task
+@instrumented('finish_processing')
+def finish_processing(results, uploaded_csv_id, derived_csv_id, row_count, token):
+    """
+    Final step of parallel processing: record the row counts and the column statistics merged
+    from the ranges, and mark the UploadedCSV as processed.
+    """
+    datasets = {'derived': DerivedCSV.objects.get(id=derived_csv_id), 'uploaded': UploadedCSV.objects.get(id=uploaded_csv_id)}
+    record_dataset(datasets['uploaded'])
+    for key, dataset in datasets.items():
+        # The ranges were written side by side, the stores add up their sizes
+        dataset.row_count = row_count
+        dataset.size_bytes = dataset.rows.store.stored_size()
+        for result in results:
+            dataset.column_stats, dataset.column_sketches = merge_stats(
+                dataset.column_stats, dataset.column_sketches, *result[key],
+            )
+        dataset.save(update_fields=['row_count', 'size_bytes', 'column_stats', 'column_sketches', 'updated_at'])
+    update_claimed(datasets['uploaded'], token, status='processed', rows_done=row_count, checkpoint=None)
 
-    return schema
+
+@shared_task
+@instrumented('processing_failed')
+def processing_failed(request, exc, traceback, uploaded_csv_id, derived_csv_id=None, token=None):
+    """
+    Error callback of parallel processing: drop what was written and mark the UploadedCSV as failed.
+    Does nothing when the run identified by token was taken over by a newer run.
+    """
+    uploaded_csv = UploadedCSV.objects.get(id=uploaded_csv_id)
+    record_dataset(uploaded_csv)
+    if uploaded_csv.processing_token != token:
+        return
+    if derived_csv_id is not None:
+        DerivedCSV.objects.filter(id=derived_csv_id).delete()
+    discard_partial(uploaded_csv)
+    try:
+        update_claimed(uploaded_csv, token, status='failed_processing', failure_reason=str(exc))
+    except ProcessingSuperseded:
+        return
+    print(f"Error processing CSV: {exc}")
+
+
+def read_csv_chunks(uploaded_csv, chunk_rows=None, byte_range=None, skip_rows=0):
+    """
+    Yield the raw CSV of an UploadedCSV as pandas DataFrames of at most ``chunk_rows`` rows,
+    with normalized column headers.
+    With byte_range, only the rows in that (start, stop) range of the file are read.
+    With skip_rows, reading starts after that many rows, which are still scanned but not parsed.
+    """
+    chunk_rows = chunk_rows or settings.CSV_CHUNK_ROWS
+
+    # Nullable dtypes keep integer columns with missing values apart from float columns
+    with uploaded_csv.raw_file.open('rb') as source:
+        if byte_range is None:
+            # A callable keeps skipping cheap in memory, a range of rows would be held as a set
+            skip = (lambda row: 0 < row <= skip_rows) if skip_rows else None
+            reader = pd.read_csv(source, chunksize=chunk_rows, skiprows=skip, dtype_backend='numpy_nullable')
+        else:
+            names = list(pd.read_csv(source, nrows=0).columns)
+            rows = io.BufferedReader(ByteRange(source, *byte_range))
+            reader = pd.read_csv(rows, header=None, names=names, chunksize=chunk_rows, dtype_backend='numpy_nullable')
+
+        for df in timed_iter('read_csv', reader):
+            # Normalize column headers
+            with stage('normalize_headers'):
+                df.columns = [normalize_header(col) for col in df.columns]
+            yield df
 
 # This function is not used for now.
 def infer_schema(csv_content):
@@ -169,46 +531,171 @@ def infer_schema(csv_content):
 def test_celery_task(x, y):
     return x + y
 
-@shared_task
-def apply_csv_changes(changes_id):
+def changes_target(content_type_id, object_id):
     """
-    Background job to apply changes from CSVChanges to the associated UploadedCSV or DerivedCSV.
-    Creates a new DerivedCSV with the updated content.
+    The UploadedCSV or DerivedCSV changes are made to, as a queryset to update.
     """
-    try:
-        csv_changes = CSVChanges.objects.get(id=changes_id)
-        associated_csv = csv_changes.csv_entry
-        original_content = associated_csv.content
+    return ContentType.objects.get_for_id(content_type_id).model_class().objects.filter(pk=object_id)
 
-        updated_content = copy.deepcopy(original_content)
 
-        for row in csv_changes.data:
-            updated_content.append(row)
+def schedule_csv_changes(csv_changes):
+    """
+    Schedule the application of a new CSVChanges together with the other changes pending on its target.
 
-        DerivedCSV.objects.create(
-            parent=associated_csv if isinstance(associated_csv, UploadedCSV) else associated_csv.parent,
-            content=updated_content
-        )
+    The first change on a target within ``CSV_CHANGES_BATCH_WINDOW`` seconds schedules one
+    apply_pending_changes run at the end of the window, later changes join that run. A target
+    with ``CSV_CHANGES_BATCH_SIZE`` pending changes is applied right away. Changes whose run was lost
+    are applied by retry_failed_and_unprocessed_csvs.
+    """
+    pending = CSVChanges.objects.filter(
+        content_type_id=csv_changes.content_type_id, object_id=csv_changes.object_id, status='pending',
+    ).count()
+    if pending >= settings.CSV_CHANGES_BATCH_SIZE:
+        apply_pending_changes.delay(csv_changes.content_type_id, csv_changes.object_id)
+        return
+
+    # The window is claimed in the database, so web and worker processes all see it. A window older
+    # than its length can be claimed again, apply_pending_changes releases it when it starts
+    window = settings.CSV_CHANGES_BATCH_WINDOW
+    now = timezone.now()
+    open_window = Q(changes_scheduled_at__isnull=True) | Q(changes_scheduled_at__lt=now - timedelta(seconds=window))
+    if changes_target(csv_changes.content_type_id, csv_changes.object_id).filter(open_window).update(changes_scheduled_at=now):
+        apply_pending_changes.apply_async((csv_changes.content_type_id, csv_changes.object_id), countdown=window)
 
-        csv_changes.status = "processed"
-        csv_changes.save()
 
-        return f"CSVChanges {changes_id} applied successfully and new DerivedCSV created."
+@shared_task
+@instrumented('apply_pending_changes')
+def apply_pending_changes(content_type_id, object_id):
+    """
+    Background job to apply all pending CSVChanges of an UploadedCSV or DerivedCSV in one pass,
+    recorded as a ProcessingRun also when it runs for apply_csv_changes.
+    Creates a single new DerivedCSV with the rows of the changes appended in the order they were made,
+    and marks the changes processed in the same transaction.
+    When the same rows were already appended to the same CSV, the new DerivedCSV reads all its rows
+    from that identical result instead of storing them again.
+    """
+    # Changes made from now on are not read by this run, they schedule the next one
+    changes_target(content_type_id, object_id).update(changes_scheduled_at=None)
+    try:
+        with transaction.atomic():
+            changes = list(
+                CSVChanges.objects.select_for_update()
+                .filter(content_type_id=content_type_id, object_id=object_id, status='pending')
+                .order_by('id')
+            )
+            if not changes:
+                return "No pending CSVChanges."
+            associated_csv = changes[0].csv_entry
+            record_dataset(associated_csv)
+            new_rows = [row for csv_changes in changes for row in csv_changes.data]
+            derived_csv = DerivedCSV(
+                parent=associated_csv if isinstance(associated_csv, UploadedCSV) else associated_csv.parent,
+                content_hash=appended_hash(associated_csv.content_hash, new_rows),
+            )
+
+            identical = identical_derived(derived_csv.content_hash)
+            if identical is not None:
+                derived_csv.share_rows(identical)
+                derived_csv.save()
+            else:
+                # Store only the new rows, the existing ones are read from the associated CSV
+                derived_csv.extend(associated_csv)
+                derived_csv.save()
+                with stage('store'):
+                    derived_csv.rows.append(new_rows)
+                derived_csv.save()
+
+            CSVChanges.objects.filter(id__in=[csv_changes.id for csv_changes in changes]).update(status='processed')
+            count(row_count=len(new_rows), size_bytes=derived_csv.size_bytes)
+
+        if derived_csv.chain_depth > settings.CSV_MAX_CHAIN_DEPTH:
+            compact_derived_csv.delay(derived_csv.id)
+
+        return f"{len(changes)} CSVChanges applied in DerivedCSV {derived_csv.id}."
+    except Exception as e:
+        record_failure(e)
+        return f"Error applying CSVChanges of {content_type_id}/{object_id}: {e}"
+
+
+@shared_task
+def apply_csv_changes(changes_id):
+    """
+    Background job to apply changes from CSVChanges to the associated UploadedCSV or DerivedCSV.
+    Applies the change together with the other changes pending on the same CSV, see apply_pending_changes.
+    """
+    try:
+        csv_changes = CSVChanges.objects.get(id=changes_id)
+        if csv_changes.status == 'processed':
+            return f"CSVChanges {changes_id} was already applied."
+        return apply_pending_changes(csv_changes.content_type_id, csv_changes.object_id)
     except CSVChanges.DoesNotExist:
         return f"CSVChanges with ID {changes_id} does not exist."
     except Exception as e:
         return f"Error applying CSVChanges {changes_id}: {e}"
 
 
+@shared_task
+@instrumented('compact_derived_csv')
+def compact_derived_csv(derived_csv_id):
+    """
+    Background job to copy the rows a DerivedCSV reads from its base chain into the DerivedCSV itself,
+    so reads no longer walk the chain.
+    """
+    try:
+        with transaction.atomic():
+            derived_csv = DerivedCSV.objects.select_for_update().get(id=derived_csv_id)
+            record_dataset(derived_csv)
+            derived_csv.rows.materialize()
+            derived_csv.save()
+
+        return f"DerivedCSV {derived_csv_id} compacted."
+    except DerivedCSV.DoesNotExist:
+        return f"DerivedCSV with ID {derived_csv_id} does not exist."
+
+
+@shared_task
 def retry_failed_and_unprocessed_csvs():
     """
-    Celery task to retry processing CSVs with 'unprocessed' or 'failed_processing' status.
+    Periodic Celery task (``CELERY_BEAT_SCHEDULE``) to retry processing CSVs that did not finish:
+    failed ones, unprocessed ones whose task was lost, and ones stuck in processing because their
+    run made no progress for ``CSV_PROCESSING_STALE_AFTER`` seconds, its worker being gone.
+
+    process_csv resumes them from their last committed chunk. CSVs are retried until they used
+    ``CSV_PROCESSING_MAX_ATTEMPTS`` runs; stuck ones out of attempts are marked as failed.
+
+    Also applies CSVChanges still pending after ``CSV_CHANGES_BATCH_WINDOW`` seconds, whose
+    apply_pending_changes run was lost or failed, and deletes the ProcessingRuns older than
+    ``CSV_RUN_RETENTION_DAYS`` days.
     """
     try:
-        csvs_to_retry = UploadedCSV.objects.filter(status__in=['unprocessed', 'failed_processing'])
-        
-        for csv in csvs_to_retry:
-            print(f"Retrying processing for CSV: {csv.id} - {csv.name}")
-            process_csv.delay(csv.id)
+        stale = timezone.now() - timedelta(seconds=settings.CSV_PROCESSING_STALE_AFTER)
+        stuck = Q(status='processing') & (Q(heartbeat_at__lt=stale) | Q(heartbeat_at__isnull=True))
+        lost = Q(status='unprocessed', created_at__lt=stale)
+        max_attempts = settings.CSV_PROCESSING_MAX_ATTEMPTS
+
+        for upload in UploadedCSV.objects.filter(stuck, processing_attempts__gte=max_attempts):
+            discard_partial(upload)
+            upload.status = 'failed_processing'
+            upload.failure_reason = f"Processing stopped responding after {upload.processing_attempts} attempts."
+            upload.processing_token = ''
+            upload.save(update_fields=['status', 'failure_reason', 'processing_token', 'updated_at'])
+
+        csvs_to_retry = UploadedCSV.objects.filter(
+            stuck | lost | Q(status='failed_processing'), processing_attempts__lt=max_attempts,
+        ).only('id', 'name')
+        for upload in csvs_to_retry:
+            print(f"Retrying processing for CSV: {upload.id} - {upload.name}")
+            process_csv.delay(upload.id)
+
+        overdue = timezone.now() - timedelta(seconds=settings.CSV_CHANGES_BATCH_WINDOW)
+        targets = CSVChanges.objects.filter(status='pending', created_at__lt=overdue).values_list(
+            'content_type_id', 'object_id',
+        ).distinct().order_by()
+        for content_type_id, object_id in targets:
+            print(f"Applying pending CSVChanges of {content_type_id}/{object_id}")
+            apply_pending_changes.delay(content_type_id, object_id)
+
+        expired = timezone.now() - timedelta(days=settings.CSV_RUN_RETENTION_DAYS)
+        ProcessingRun.objects.filter(started_at__lt=expired).delete()
     except Exception as e:
         print(f"Error retrying failed and unprocessed CSVs: {e}")
\ No newline at end of file
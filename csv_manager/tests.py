@@ -1,3 +1,1260 @@
-from django.test import TestCase
+import glob
+import io
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+import zlib
+from unittest import mock, skipUnless
+from datetime import timedelta
+from xml.etree import ElementTree
+import numpy as np
+import pandas as pd
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import AsyncRequestFactory, TestCase, override_settings
+from django.utils import timezone
+from . import async_views, benchmarks, compression, instrumentation
+from .aggregation import bucket_start, lttb
+from .benchmarks import celery_mode
+from .caching import cached_export, cached_export_length, invalidate
+from .compression import check_codec, decode_block, encode_block
+from .exports import aiter_chunks, export_variant, pa
+from .fingerprints import appended_hash, transformed_hash
+from .models import UploadedCSV, DerivedCSV, CSVChanges, CSVRow, CompressedRows, ProcessingRun
+from .partitions import ByteRange, split_byte_ranges
+from .stats import chunk_stats, hll_estimate, hll_registers, update_stats
+from .storage import RowSet, RowStore
+from .table import ordered_page
+from .transforms import TransformError, TransformPipeline, needs_lookback
+from .zonemaps import block_bounds, may_match, predicate_bounds
+from .tasks import (
+    process_csv, fail_processing, apply_pending_changes, schedule_csv_changes, retry_failed_and_unprocessed_csvs,
+)
 
-# Create your tests here.
+
+SAMPLE_CSV = (
+    'Timestamp,Station,PM2.5,Count\n'
+    '2020-01-01 00:00:00,A,12.5,3\n'
+    '2020-01-01 01:00:00,B,7.25,8\n'
+    '2020-01-01 02:00:00,A,,5\n'
+    '2020-01-01 03:00:00,C,30.0,1\n'
+)
+
+
+class CSVTestCase(TestCase):
+    """
+    Base of the tests: Celery tasks run inline, media files go to a temporary directory and
+    the caches start out empty.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        media_root = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        cls.enterClassContext(override_settings(MEDIA_ROOT=media_root))
+        cls.enterClassContext(celery_mode('eager'))
+
+    def setUp(self):
+        for backend in caches.all():
+            backend.clear()
+
+    def upload(self, content=SAMPLE_CSV, name='sample.csv', process=True):
+        """
+        An UploadedCSV of the given CSV text, processed unless process is False.
+        """
+        uploaded_csv = UploadedCSV(name=name)
+        uploaded_csv.raw_file.save(name, ContentFile(content.encode()))
+        if process:
+            process_csv(uploaded_csv.id)
+            uploaded_csv.refresh_from_db()
+        return uploaded_csv
+
+
+class RawFileTests(CSVTestCase):
+    def test_raw_file_deleted_with_upload(self):
+        uploaded_csv = self.upload(process=False)
+        name = uploaded_csv.raw_file.name
+        with self.captureOnCommitCallbacks(execute=True):
+            uploaded_csv.delete()
+        self.assertFalse(default_storage.exists(name))
+
+    def test_raw_file_kept_while_shared(self):
+        original = self.upload(process=False)
+        name = original.raw_file.name
+        duplicate = UploadedCSV.objects.create(name='copy.csv', raw_file=name)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            original.delete()
+        self.assertTrue(default_storage.exists(name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            duplicate.delete()
+        self.assertFalse(default_storage.exists(name))
+
+
+@override_settings(CSV_ROW_BATCH_SIZE=3)
+class RowSetTests(CSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.uploaded_csv = self.upload()
+
+    def test_one_stored_row_per_csv_row(self):
+        stored = self.uploaded_csv.stored_rows.order_by('row_index')
+        self.assertEqual(list(stored.values_list('row_index', flat=True)), [0, 1, 2, 3])
+        self.assertEqual(stored[0].data, {'timestamp': '2020-01-01 00:00:00', 'station': 'A', 'pm25': 12.5, 'count': 3})
+
+    def test_indexing_and_slicing(self):
+        rows = self.uploaded_csv.rows
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows.columns, ['timestamp', 'station', 'pm25', 'count'])
+        self.assertEqual(rows[-1]['station'], 'C')
+        self.assertIsNone(rows[2]['pm25'])
+        self.assertEqual([row['station'] for row in rows[1:]], ['B', 'A', 'C'])
+        self.assertEqual([row['count'] for row in rows[::2]], [3, 5])
+        with self.assertRaises(IndexError):
+            rows[4]
+
+    def test_batches_and_lookups(self):
+        rows = self.uploaded_csv.rows
+        self.assertEqual([len(batch) for batch in rows.iter_batches()], [3, 1])
+        self.assertEqual([row['count'] for row in rows.iter_rows(1, 3)], [8, 5])
+        self.assertEqual([row['count'] for row in rows.rows_at([3, 0, 3])], [1, 3, 1])
+        self.assertEqual(rows.to_frame(['count']).to_dict('list'), {'count': [3, 8, 5, 1]})
+
+    def test_truncate_drops_rows_past_row_count(self):
+        self.uploaded_csv.rows.append([{'timestamp': '2020-01-01 04:00:00', 'station': 'D', 'pm25': 1.0, 'count': 2}])
+        self.assertEqual(self.uploaded_csv.stored_rows.count(), 5)
+
+        uploaded_csv = UploadedCSV.objects.get(id=self.uploaded_csv.id)  # The append was never saved
+        uploaded_csv.rows.truncate()
+        self.assertEqual(uploaded_csv.stored_rows.count(), 4)
+        self.assertEqual(len(uploaded_csv.rows), 4)
+
+
+class CopyOnWriteTests(CSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.uploaded_csv = self.upload()
+
+    def append(self, csv_entry, *stations):
+        """
+        The DerivedCSV made by applying a change of one row per station to csv_entry.
+        """
+        content_type = ContentType.objects.get_for_model(csv_entry)
+        CSVChanges.objects.create(
+            content_type=content_type, object_id=csv_entry.id,
+            data=[{'timestamp': '2020-01-01 04:00:00', 'station': station, 'pm25': 1.5, 'count': 2} for station in stations],
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_pending_changes(content_type.id, csv_entry.id)
+        return DerivedCSV.objects.filter(parent=self.uploaded_csv).latest('id')
+
+    def test_derived_stores_only_new_rows(self):
+        first = self.append(self.uploaded_csv, 'D')
+        second = self.append(first, 'E', 'F')
+
+        self.assertEqual((second.base, second.base_row_count, second.chain_depth), (first, 5, 2))
+        self.assertEqual(second.stored_rows.count(), 2)
+        self.assertEqual(len(second.rows.segments), 3)
+        self.assertEqual([row['station'] for row in second.rows], ['A', 'B', 'A', 'C', 'D', 'E', 'F'])
+        self.assertEqual([row['station'] for row in second.rows.rows_at([6, 0, 4])], ['F', 'A', 'D'])
+
+    @override_settings(CSV_MAX_CHAIN_DEPTH=1)
+    def test_deep_chain_compacted(self):
+        first = self.append(self.uploaded_csv, 'D')
+        self.assertEqual(first.chain_depth, 1)
+
+        second = self.append(first, 'E')
+        self.assertIsNone(second.base_object_id)
+        self.assertEqual((second.chain_depth, second.base_row_count), (0, 0))
+        self.assertEqual(second.stored_rows.count(), 6)
+        self.assertEqual([row['station'] for row in second.rows], ['A', 'B', 'A', 'C', 'D', 'E'])
+
+    def test_deleted_base_copied_into_dependents(self):
+        first = self.append(self.uploaded_csv, 'D')
+        second = self.append(first, 'E')
+
+        first.delete()
+        second.refresh_from_db()
+        self.assertIsNone(second.base_object_id)
+        self.assertEqual([row['station'] for row in second.rows], ['A', 'B', 'A', 'C', 'D', 'E'])
+
+
+class DownloadTests(CSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.uploaded_csv = self.upload()
+        self.url = f'/download_csv/{self.uploaded_csv.id}/'
+
+    def download(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def test_streams_header_and_rows(self):
+        response, body = self.download()
+        self.assertEqual(response.status_code, 200)
+        lines = body.decode().splitlines()
+        self.assertEqual(lines[0], 'timestamp,station,pm25,count')
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[1].split(',')[1:], ['A', '12.5', '3'])
+        self.assertEqual(lines[3].split(',')[1:], ['A', '', '5'])
+        self.assertEqual(lines[4].split(',')[1:], ['C', '30.0', '1'])
+
+    def test_invalidate_drops_every_export_format(self):
+        formats = ['csv', 'csv.gz', 'ndjson', 'xlsx'] + (['parquet'] if pa is not None else [])
+        variants = [export_variant(export_format, False) for export_format in formats]
+        variants.append(export_variant('ndjson', True))
+        requests = [(export_format, 'identity') for export_format in formats] + [('ndjson', 'gzip')]
+        for export_format, encoding in requests:
+            response = self.client.get(self.url, {'format': export_format}, headers={'Accept-Encoding': encoding})
+            b''.join(response.streaming_content)
+        for variant in variants:
+            self.assertIsNotNone(cached_export(self.uploaded_csv, variant), variant)
+
+        invalidate(self.uploaded_csv)
+        for variant in variants:
+            self.assertIsNone(cached_export(self.uploaded_csv, variant), variant)
+            self.assertIsNone(cached_export_length(self.uploaded_csv, variant), variant)
+
+    def test_range_of_uncached_export(self):
+        response, body = self.download(Range='bytes=0-9')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Length', response)
+
+        response, part = self.download(Range='bytes=5-14')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 5-14/{len(body)}')
+        self.assertEqual(part, body[5:15])
+
+
+@override_settings(CSV_ROW_BATCH_SIZE=2, CSV_FRAME_BATCH_SIZE=2)
+class ExportFormatTests(CSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.uploaded_csv = self.upload()
+
+    def export(self, status=200, **params):
+        response = self.client.get(f'/download_csv/{self.uploaded_csv.id}/', params)
+        self.assertEqual(response.status_code, status, response.content if not response.streaming else '')
+        if not response.streaming:
+            return response, response.content
+        chunks = list(response.streaming_content)
+        return response, b''.join(chunks)
+
+    def test_gzip_csv(self):
+        response, body = self.export(format='csv.gz')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="sample.csv.gz"')
+        _, plain = self.export()
+        self.assertEqual(zlib.decompress(body, zlib.MAX_WBITS | 16), plain)
+
+    def test_ndjson_keeps_stored_values(self):
+        response, body = self.export(format='ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual(rows, list(self.uploaded_csv.rows))
+        self.assertIsNone(rows[2]['pm25'])
+        self.assertIsInstance(rows[0]['count'], int)
+
+    @skipUnless(pa is not None, "Parquet exports need pyarrow")
+    def test_parquet_typed_from_schema(self):
+        import pyarrow.parquet as pq
+
+        response, body = self.export(format='parquet')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="sample.parquet"')
+        parquet = pq.ParquetFile(io.BytesIO(body))
+        self.assertEqual(parquet.metadata.num_row_groups, 2)  # One per batch of CSV_FRAME_BATCH_SIZE rows
+        table = parquet.read()
+        self.assertEqual(
+            [(field.name, str(field.type)) for field in table.schema],
+            [('timestamp', 'timestamp[us]'), ('station', 'string'), ('pm25', 'double'), ('count', 'int64')],
+        )
+        self.assertEqual(table.column('pm25').to_pylist(), [12.5, 7.25, None, 30.0])
+        self.assertEqual(str(table.column('timestamp')[1]), '2020-01-01 01:00:00')
+
+    def test_xlsx_typed_cells(self):
+        response, body = self.export(format='xlsx')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="sample.xlsx"')
+        with zipfile.ZipFile(io.BytesIO(body)) as package:
+            self.assertIn('[Content_Types].xml', package.namelist())
+            sheet = ElementTree.fromstring(package.read('xl/worksheets/sheet1.xml'))
+
+        namespace = {'x': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+        rows = sheet.findall('x:sheetData/x:row', namespace)
+        self.assertEqual(len(rows), 5)
+        self.assertEqual([cell.findtext('x:is/x:t', namespaces=namespace) for cell in rows[0]], ['timestamp', 'station', 'pm25', 'count'])
+        timestamp, station, pm25, count = rows[1]
+        self.assertEqual((timestamp.get('s'), float(timestamp.findtext('x:v', namespaces=namespace))), ('1', 43831.0))
+        self.assertEqual((station.get('t'), station.findtext('x:is/x:t', namespaces=namespace)), ('inlineStr', 'A'))
+        self.assertEqual((pm25.findtext('x:v', namespaces=namespace), count.findtext('x:v', namespaces=namespace)), ('12.5', '3'))
+        self.assertEqual(len(rows[3][2]), 0)  # Missing values are empty cells
+
+    def test_columns_and_row_range(self):
+        _, body = self.export(columns='count,station', start=1, stop=3)
+        self.assertEqual(body.decode().splitlines(), ['count,station', '8,B', '5,A'])
+        _, body = self.export(format='ndjson', columns='station', start=2, station='A')
+        self.assertEqual(body.decode().splitlines(), ['{"station":"A"}'])
+        _, body = self.export(format='csv.gz', columns='pm25', stop=100)
+        # A lone missing value is quoted, so the row is not read back as a blank line
+        self.assertEqual(zlib.decompress(body, zlib.MAX_WBITS | 16).decode().splitlines(), ['pm25', '12.5', '7.25', '""', '30.0'])
+
+    def test_exports_streamed_per_batch(self):
+        for export_format in ('csv', 'ndjson', 'xlsx'):
+            response = self.client.get(f'/download_csv/{self.uploaded_csv.id}/', {'format': export_format})
+            self.assertGreater(len([chunk for chunk in response.streaming_content if chunk]), 1, export_format)
+
+    def test_invalid_parameters_rejected(self):
+        for params in ({'format': 'pdf'}, {'columns': 'pm25,missing'}, {'start': 'one'}, {'start': 3, 'stop': 2}, {'start': -1}):
+            with self.subTest(params=params):
+                self.export(400, **params)
+        with mock.patch('csv_manager.exports.pa', None):
+            self.export(400, format='parquet')
+        with mock.patch('csv_manager.exports.XLSX_MAX_ROWS', 3):
+            self.export(400, format='xlsx')
+            self.export(format='xlsx', start=1)
+
+
+class OrderedPageTests(CSVTestCase):
+    def page(self, uploaded_csv, offset=0, limit=10, sort='station', descending=False, filters=()):
+        query = {'offset': offset, 'limit': limit, 'sort': sort, 'descending': descending, 'filters': list(filters)}
+        indices, total = ordered_page(uploaded_csv.rows, uploaded_csv.schema, query)
+        return list(indices), total
+
+    def test_reprocessing_with_same_row_count_misses_cache(self):
+        uploaded_csv = self.upload()
+        self.assertEqual(self.page(uploaded_csv), ([0, 2, 1, 3], 4))
+
+        reordered = SAMPLE_CSV.replace(',C,', ',0,')
+        uploaded_csv.raw_file.save('sample.csv', ContentFile(reordered.encode()))
+        UploadedCSV.objects.filter(id=uploaded_csv.id).update(status='failed_processing')
+        process_csv(uploaded_csv.id)
+        uploaded_csv.refresh_from_db()
+        self.assertEqual(uploaded_csv.row_count, 4)
+
+        self.assertEqual(self.page(uploaded_csv), ([3, 0, 2, 1], 4))
+
+    @override_settings(CSV_ORDER_CHUNK_ROWS=2)
+    def test_pages_load_only_their_chunks(self):
+        uploaded_csv = self.upload()
+        self.assertEqual(self.page(uploaded_csv, descending=True), ([3, 1, 0, 2], 4))  # Orders and caches
+
+        dataset_cache = caches[settings.CSV_CACHE_ALIAS]
+        with mock.patch.object(dataset_cache, 'get_many', wraps=dataset_cache.get_many) as get_many:
+            self.assertEqual(self.page(uploaded_csv, offset=1, limit=2, descending=True), ([1, 0], 4))
+            self.assertEqual(self.page(uploaded_csv, offset=3, limit=5, descending=True), ([2], 4))
+            self.assertEqual(self.page(uploaded_csv, offset=8, descending=True), ([], 4))
+        self.assertEqual([len(call.args[0]) for call in get_many.call_args_list], [2, 1, 0])
+
+    def test_filtered_page(self):
+        uploaded_csv = self.upload()
+        filters = [('pm25', 'gte', 10.0)]
+        self.assertEqual(self.page(uploaded_csv, sort=None, filters=filters), ([0, 3], 2))
+
+
+class ChartTests(CSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.uploaded_csv = self.upload()
+
+    def chart(self, status=200, **params):
+        response = self.client.get(f'/visualize_csv/{self.uploaded_csv.id}/data/', params)
+        self.assertEqual(response.status_code, status, response.content)
+        return response.json()
+
+    def test_lttb_keeps_ends_and_peaks(self):
+        x = np.arange(1000, dtype='float64')
+        y = np.zeros(1000)
+        y[500], y[750] = 100.0, -50.0
+        kept = lttb(x, y, 10)
+        self.assertLessEqual(len(kept), 10)
+        self.assertEqual((kept[0], kept[-1]), (0, 999))
+        self.assertIn(500, kept)
+        self.assertIn(750, kept)
+        self.assertEqual(list(lttb(x[:5], y[:5], 10)), [0, 1, 2, 3, 4])
+
+    def test_weeks_start_on_monday(self):
+        times = pd.Series(pd.to_datetime(['2024-01-03 12:00', '2024-01-07 23:59', '2024-01-08 00:00']))
+        self.assertEqual(bucket_start(times, 'week').dt.strftime('%Y-%m-%d').tolist(), ['2024-01-01', '2024-01-01', '2024-01-08'])
+
+    def test_timeseries_buckets(self):
+        hourly = self.chart(kind='timeseries', x='timestamp', column='pm25', bucket='hour')
+        self.assertEqual(hourly['labels'], ['2020-01-01 00:00:00', '2020-01-01 01:00:00', '2020-01-01 03:00:00'])
+        self.assertEqual(hourly['mean'], [12.5, 7.25, 30.0])
+
+        auto = self.chart(kind='timeseries', x='timestamp', column='pm25', bucket='auto')
+        self.assertEqual((auto['bucket'], auto['labels']), ('minute', hourly['labels']))  # Three hours fit in 1000 minutes
+
+        daily = self.chart(kind='timeseries', x='timestamp', column='count', bucket='day')
+        self.assertEqual((daily['count'], daily['min'], daily['max'], daily['mean']), ([4], [1], [8], [4.25]))
+
+    @override_settings(CSV_CHART_POINTS=3, CSV_CHART_TOP_K=1)
+    def test_downsampled_series_and_top_categories(self):
+        series = self.chart(kind='series', column='count')
+        self.assertEqual((series['labels'][0], series['labels'][-1], len(series['labels'])), (0, 3, 3))
+        self.assertEqual(series['rows'], 4)
+
+        categories = self.chart(kind='categories', column='station')
+        self.assertEqual(categories, {'labels': ['A', 'Others'], 'values': [2, 2], 'rows': 4})
+
+    def test_invalid_charts_rejected(self):
+        self.chart(status=400, kind='pie', column='pm25')
+        self.chart(status=400, kind='series', column='station')
+        self.chart(status=400, kind='timeseries', x='count', column='pm25')
+        self.chart(status=400, kind='timeseries', x='timestamp', column='pm25', bucket='fortnight')
+
+
+class TransformTests(CSVTestCase):
+    schema = {'level': 'float', 'count': 'integer', 'station': 'string'}
+
+    def frame(self, rows=10):
+        return pd.DataFrame({
+            'level': np.arange(rows, dtype='float64') ** 2,
+            'count': pd.array(range(rows), dtype='Int64'),
+            'station': ['A'] * rows,
+        })
+
+    def test_chunks_match_whole_frame_with_lookback(self):
+        steps = [{'transform': 'rolling_mean', 'window': 4}, {'transform': 'scale', 'factor': 3, 'columns': ['level']}]
+        df = self.frame()
+        whole = TransformPipeline(self.schema, steps)(df)
+
+        pipeline = TransformPipeline(self.schema, steps)
+        chunked = pd.concat([pipeline(df.iloc[start:start + 3]) for start in range(0, len(df), 3)])
+        pd.testing.assert_frame_equal(chunked, whole)
+        self.assertEqual(whole['level'].tolist()[:3], [0.0, 1.5, 5.0])
+        self.assertTrue(needs_lookback(steps))
+        self.assertFalse(needs_lookback([{'transform': 'halve'}]))
+
+    def test_integers_floored_and_other_columns_kept(self):
+        result = TransformPipeline(self.schema, [{'transform': 'halve'}])(self.frame(4))
+        self.assertEqual(result['count'].tolist(), [0, 0, 1, 1])
+        self.assertEqual(result['level'].tolist(), [0.0, 0.5, 2.0, 4.5])
+        self.assertEqual(result['station'].tolist(), ['A'] * 4)
+
+    def test_invalid_steps_rejected(self):
+        with self.assertRaises(TransformError):
+            TransformPipeline(self.schema, [{'transform': 'cube'}])
+        with self.assertRaises(TransformError):
+            TransformPipeline(self.schema, [{'transform': 'halve', 'columns': ['station']}])
+
+    @override_settings(CSV_CHUNK_ROWS=2, CSV_DERIVED_TRANSFORMS=[{'transform': 'rolling_mean', 'window': 2, 'columns': ['pm25']}])
+    def test_derived_csv_transformed_across_chunks(self):
+        uploaded_csv = self.upload()
+        derived_csv = DerivedCSV.objects.filter(parent=uploaded_csv).latest('id')
+        self.assertEqual([row['pm25'] for row in derived_csv.rows], [12.5, 9.875, 7.25, 30.0])
+        self.assertEqual([row['count'] for row in derived_csv.rows], [3, 8, 5, 1])
+
+
+class PartitionTests(CSVTestCase):
+    content = SAMPLE_CSV.replace('B,7.25', '"B\nnorth, ""old""",7.25') + ''.join(
+        f'2020-01-02 {hour:02d}:00:00,"D\n{hour}",{hour}.5,{hour}\n' for hour in range(12)
+    )
+
+    def test_ranges_split_on_row_boundaries(self):
+        source = io.BytesIO(self.content.encode())
+        header_end = self.content.index('\n') + 1
+        for parts in (1, 2, 3, 7, 50):
+            ranges = split_byte_ranges(source, parts)
+            self.assertLessEqual(len(ranges), parts)
+            self.assertEqual(ranges[0][0], header_end)
+            self.assertEqual(ranges[-1][1], len(self.content))
+            for (_, stop), (start, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(stop, start)
+            for start, stop in ranges:
+                rows = pd.read_csv(io.BufferedReader(ByteRange(source, start, stop)), header=None)
+                self.assertEqual(rows.shape[1], 4)
+                self.assertTrue(rows[0].str.startswith('2020-').all(), (parts, start, stop))
+
+    @override_settings(CSV_PARALLEL_PARTITIONS=3, CSV_PARALLEL_MIN_BYTES=0)
+    def test_parallel_run_matches_serial_run(self):
+        parallel = self.upload(self.content)
+        with override_settings(CSV_PARALLEL_PARTITIONS=1):
+            serial = self.upload(self.content)
+
+        self.assertEqual(parallel.status, 'processed')
+        self.assertEqual((parallel.schema, parallel.row_count), (serial.schema, serial.row_count))
+        self.assertEqual(list(parallel.rows), list(serial.rows))
+        self.assertEqual(parallel.column_stats.keys(), serial.column_stats.keys())
+        for column, stats in serial.column_stats.items():
+            for key, value in stats.items():
+                if isinstance(value, float):  # Merged partial moments differ in the last bits
+                    self.assertAlmostEqual(parallel.column_stats[column][key], value, msg=(column, key))
+                else:
+                    self.assertEqual(parallel.column_stats[column][key], value, (column, key))
+        parallel_derived, serial_derived = (DerivedCSV.objects.filter(parent=csv_entry).get() for csv_entry in (parallel, serial))
+        self.assertEqual(list(parallel_derived.rows), list(serial_derived.rows))
+        self.assertEqual(ProcessingRun.objects.filter(task='write_partition').count(), 3)
+
+    @override_settings(
+        CSV_PARALLEL_PARTITIONS=3, CSV_PARALLEL_MIN_BYTES=0, CSV_DERIVED_TRANSFORMS=[{'transform': 'rolling_mean'}],
+    )
+    def test_lookback_transforms_processed_serially(self):
+        uploaded_csv = self.upload(self.content)
+        self.assertEqual(uploaded_csv.status, 'processed')
+        self.assertFalse(ProcessingRun.objects.filter(task='write_partition').exists())
+
+
+class ColumnStatsTests(CSVTestCase):
+    schema = {'station': 'string', 'level': 'float', 'count': 'integer'}
+
+    def frame(self, rows):
+        return pd.DataFrame({
+            'station': [f'S{index % 37}' for index in range(rows)],
+            'level': [None if index % 5 == 0 else index * 0.75 for index in range(rows)],
+            'count': [(index * 7) % 101 for index in range(rows)],
+        })
+
+    def test_chunks_merge_into_whole_frame_stats(self):
+        df = self.frame(500)
+        column_stats = column_sketches = None
+        for start in range(0, len(df), 120):
+            column_stats, column_sketches = update_stats(column_stats, column_sketches, df[start:start + 120], self.schema)
+        whole_stats, whole_sketches = chunk_stats(df, self.schema)
+
+        self.assertEqual(column_sketches, whole_sketches)
+        for column, stats in whole_stats.items():
+            for key, value in stats.items():
+                if isinstance(value, float):
+                    self.assertAlmostEqual(column_stats[column][key], value, msg=(column, key))
+                else:
+                    self.assertEqual(column_stats[column][key], value, (column, key))
+
+        levels = df['level'].dropna()
+        self.assertEqual((column_stats['level']['count'], column_stats['level']['nulls']), (400, 100))
+        self.assertEqual((column_stats['level']['min'], column_stats['level']['max']), (levels.min(), levels.max()))
+        self.assertAlmostEqual(column_stats['level']['mean'], levels.mean())
+        self.assertAlmostEqual(column_stats['level']['variance'], levels.var())
+        self.assertEqual(column_stats['station']['distinct'], 37)
+        self.assertNotIn('mean', column_stats['station'])
+
+    def test_distinct_count_estimate(self):
+        self.assertEqual(hll_estimate(hll_registers(pd.Series([1, 2, 2, 3]))), 3)
+        self.assertEqual(hll_estimate(hll_registers(pd.Series([1.0, 2.0]))), 2)  # Same hashes as the integers
+        self.assertTrue(np.array_equal(hll_registers(pd.Series([1, 2])), hll_registers(pd.Series([1.0, 2.0]))))
+        estimate = hll_estimate(hll_registers(pd.Series(np.arange(100_000))))
+        self.assertLess(abs(estimate - 100_000), 5_000)
+
+    def test_stats_kept_up_to_date_by_appends(self):
+        uploaded_csv = self.upload()
+        self.assertEqual(uploaded_csv.column_stats['pm25']['count'], 3)
+        self.assertEqual(uploaded_csv.column_stats['pm25']['nulls'], 1)
+        self.assertEqual(uploaded_csv.column_stats['station']['distinct'], 3)
+
+        content_type = ContentType.objects.get_for_model(UploadedCSV)
+        CSVChanges.objects.create(
+            content_type=content_type, object_id=uploaded_csv.id,
+            data=[{'timestamp': '2020-01-01 04:00:00', 'station': 'D', 'pm25': 50.25, 'count': 2}],
+        )
+        with mock.patch.object(RowSet, 'iter_batches', side_effect=AssertionError('Rows rescanned')), \
+                self.captureOnCommitCallbacks(execute=True):
+            apply_pending_changes(content_type.id, uploaded_csv.id)
+        derived_csv = DerivedCSV.objects.filter(parent=uploaded_csv).latest('id')
+
+        full_stats, _ = chunk_stats(derived_csv.rows.to_frame(), uploaded_csv.schema)
+        for column, stats in full_stats.items():
+            for key, value in stats.items():
+                if isinstance(value, float):
+                    self.assertAlmostEqual(derived_csv.column_stats[column][key], value, msg=(column, key))
+                else:
+                    self.assertEqual(derived_csv.column_stats[column][key], value, (column, key))
+        self.assertEqual(derived_csv.column_stats['pm25']['max'], 50.25)
+        self.assertEqual(derived_csv.column_stats['station']['distinct'], 4)
+        self.assertEqual(derived_csv.column_stats['timestamp']['max'], '2020-01-01 04:00:00')
+
+    def test_listing_shows_stats(self):
+        self.upload()
+        response = self.client.get('/my_csvs/')
+        self.assertContains(response, '<td>pm25</td>')
+        self.assertContains(response, '<td>16.58</td>')  # Mean of 12.5, 7.25 and 30.0
+
+
+@override_settings(CSV_BLOCK_ROWS=4, CSV_CHUNK_ROWS=6)
+class ZoneMapTests(CSVTestCase):
+    content = 'Timestamp,Station,PM2.5\n' + ''.join(
+        f'2020-01-{day + 1:02d} {hour:02d}:00:00,S{hour},{"" if day == 3 else day * 10 + hour}\n'
+        for day in range(5) for hour in range(4)
+    )
+
+    def setUp(self):
+        super().setUp()
+        self.uploaded_csv = self.upload(self.content)
+        self.schema = self.uploaded_csv.schema
+        self.rows = self.uploaded_csv.rows
+
+    def test_block_bounds(self):
+        df = pd.DataFrame({'level': [5.0, None, 1.0, None, None], 'station': list('ABCDE')})
+        blocks = block_bounds(df, {'level': 'float', 'station': 'string'}, 2, 4)
+        self.assertEqual(blocks, [(2, 4, {'level': [5.0, 5.0]}), (4, 7, {'level': [1.0, 1.0]})])
+        self.assertEqual(block_bounds(df.iloc[3:], {'level': 'float'}, 0, 4), [(0, 2, {'level': None})])
+
+    def test_predicate_bounds(self):
+        schema = {'level': 'float', 'day': 'date', 'station': 'string'}
+        bounds = predicate_bounds([
+            ('level', 'gte', 2), ('level', 'lt', 8), ('level', 'between', [0, 6]),
+            ('day', 'eq', pd.Timestamp('2020-01-02 10:00')), ('station', 'eq', 'A'), ('level', 'notnull', None),
+        ], schema)
+        self.assertEqual(bounds, {'level': (2.0, 6.0), 'day': ('2020-01-02', '2020-01-02')})
+        self.assertTrue(may_match({'level': [5.0, 9.0]}, bounds))
+        self.assertFalse(may_match({'level': [6.5, 9.0]}, bounds))
+        self.assertFalse(may_match({'level': None}, bounds))
+        self.assertTrue(may_match({}, bounds))
+
+    def test_blocks_written_on_processing(self):
+        # Blocks are cut at multiples of CSV_BLOCK_ROWS within each chunk of CSV_CHUNK_ROWS rows
+        blocks = list(RowSet.blocks(self.uploaded_csv, 0, 20))
+        self.assertEqual(
+            [(start, stop) for start, stop, _ in blocks], [(0, 4), (4, 6), (6, 8), (8, 12), (12, 16), (16, 18), (18, 20)],
+        )
+        self.assertEqual(blocks[3][2]['timestamp'], ['2020-01-03 00:00:00', '2020-01-03 03:00:00'])
+        self.assertEqual(blocks[3][2]['pm25'], [20.0, 23.0])
+        self.assertIsNone(blocks[4][2]['pm25'])
+
+    def test_only_matching_blocks_read(self):
+        day = [('timestamp', 'between', [pd.Timestamp('2020-01-03 00:00'), pd.Timestamp('2020-01-03 23:00')])]
+        self.assertEqual(self.rows.candidate_ranges(0, 20, day), [(8, 12)])
+        self.assertEqual(self.rows.candidate_ranges(0, 20, [('pm25', 'gt', 35)]), [(16, 20)])
+        self.assertEqual(self.rows.candidate_ranges(0, 20, [('pm25', 'gt', 50)]), [])
+        self.assertEqual(self.rows.candidate_ranges(0, 20, [('station', 'eq', 'S1')]), [(0, 20)])
+        self.assertEqual(self.rows.candidate_ranges(0, 20, [('pm25', 'lte', 21)]), [(0, 12)])
+
+        store_class = type(self.rows.store)
+        with mock.patch.object(store_class, 'read_frame', autospec=True, side_effect=store_class.read_frame) as read_frame:
+            response = self.client.get(f'/query_csv/{self.uploaded_csv.id}/', {'q': json.dumps({
+                'select': ['pm25'], 'where': [{'column': 'timestamp', 'op': 'between', 'value': ['2020-01-03', '2020-01-03 23:59:59']}],
+            })})
+        self.assertEqual(response.json()['rows'], [[20], [21], [22], [23]])
+        self.assertEqual([call.args[2:] for call in read_frame.call_args_list], [(8, 12)])
+
+    def test_appended_rows_get_blocks(self):
+        content_type = ContentType.objects.get_for_model(UploadedCSV)
+        CSVChanges.objects.create(
+            content_type=content_type, object_id=self.uploaded_csv.id,
+            data=[{'timestamp': f'2020-01-06 0{hour}:00:00', 'station': 'S0', 'pm25': 100 + hour} for hour in range(3)],
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_pending_changes(content_type.id, self.uploaded_csv.id)
+        derived_csv = DerivedCSV.objects.filter(parent=self.uploaded_csv).latest('id')
+
+        self.assertEqual([(start, stop) for start, stop, _ in RowSet.blocks(derived_csv, 0, 23)], [(20, 23)])
+        rows = derived_csv.rows
+        self.assertEqual(rows.candidate_ranges(0, 23, [('pm25', 'gte', 100)]), [(20, 23)])
+        day = [('timestamp', 'between', [pd.Timestamp('2020-01-02'), pd.Timestamp('2020-01-02 23:00')])]
+        self.assertEqual(rows.candidate_ranges(0, 23, day), [(4, 8)])
+        self.assertEqual([row['pm25'] for row in rows.iter_rows(*rows.candidate_ranges(0, 23, day)[0])], [10, 11, 12, 13])
+
+
+class DeduplicationTests(CSVTestCase):
+    def post_upload(self, content=SAMPLE_CSV):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/upload_csv/', {'file': SimpleUploadedFile('sample.csv', content.encode(), 'text/csv')})
+        self.assertEqual(response.status_code, 302)
+        return UploadedCSV.objects.latest('id')
+
+    def test_identical_upload_reuses_file_and_rows(self):
+        original = self.post_upload()
+        duplicate = self.post_upload()
+
+        self.assertEqual(duplicate.status, 'processed')
+        self.assertEqual(duplicate.content_hash, original.content_hash)
+        self.assertEqual(duplicate.raw_file.name, original.raw_file.name)
+        self.assertEqual((duplicate.base, duplicate.stored_rows.count()), (original, 0))
+        self.assertEqual((duplicate.schema, list(duplicate.rows)), (original.schema, list(original.rows)))
+
+        original_derived, duplicate_derived = (DerivedCSV.objects.get(parent=csv_entry) for csv_entry in (original, duplicate))
+        self.assertEqual((duplicate_derived.base, duplicate_derived.stored_rows.count()), (original_derived, 0))
+        self.assertEqual(list(duplicate_derived.rows), list(original_derived.rows))
+
+    def test_other_upload_processed_on_its_own(self):
+        original = self.post_upload()
+        other = self.post_upload(SAMPLE_CSV.replace('12.5', '12.75'))
+        self.assertNotEqual(other.raw_file.name, original.raw_file.name)
+        self.assertIsNone(other.base_object_id)
+        self.assertEqual(other.stored_rows.count(), 4)
+
+    def test_same_changes_share_derived_rows(self):
+        uploaded_csv = self.post_upload()
+        content_type = ContentType.objects.get_for_model(UploadedCSV)
+        derived = []
+        for _ in range(2):
+            CSVChanges.objects.create(
+                content_type=content_type, object_id=uploaded_csv.id,
+                data=[{'timestamp': '2020-01-01 04:00:00', 'station': 'D', 'pm25': 1.5, 'count': 2}],
+            )
+            apply_pending_changes(content_type.id, uploaded_csv.id)
+            derived.append(DerivedCSV.objects.filter(parent=uploaded_csv).latest('id'))
+
+        first, second = derived
+        self.assertEqual(second.content_hash, first.content_hash)
+        self.assertEqual((second.base, second.stored_rows.count()), (first, 0))
+        self.assertEqual(list(second.rows), list(first.rows))
+
+    def test_fingerprints(self):
+        schema = {'pm25': 'float'}
+        halved = transformed_hash('abc', TransformPipeline(schema, [{'transform': 'halve'}]))
+        self.assertEqual(halved, transformed_hash('abc', TransformPipeline(schema, [{'transform': 'halve'}])))
+        self.assertNotEqual(halved, transformed_hash('abc', TransformPipeline(schema, [{'transform': 'scale', 'factor': 0.5}])))
+        self.assertNotEqual(halved, transformed_hash('abd', TransformPipeline(schema, [{'transform': 'halve'}])))
+        self.assertNotEqual(appended_hash('abc', [{'pm25': 1}]), appended_hash('abc', [{'pm25': 2}]))
+        self.assertEqual(appended_hash('', [{'pm25': 1}]), '')
+
+
+class BenchmarkTests(CSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def test_generated_datasets_repeatable(self):
+        for kind in ('tall', 'wide', 'strings', 'datetimes'):
+            path = benchmarks.dataset_path(kind, 50, self.directory)
+            with open(path) as file:
+                content = file.read()
+            benchmarks.generate_csv(kind, 50, os.path.join(self.directory, 'again.csv'))
+            with open(os.path.join(self.directory, 'again.csv')) as file:
+                self.assertEqual(file.read(), content, kind)
+            self.assertEqual(len(pd.read_csv(path)), 50)
+        self.assertEqual(pd.read_csv(benchmarks.dataset_path('wide', 5, self.directory)).shape, (5, 60))
+        with self.assertRaises(benchmarks.BenchmarkError):
+            benchmarks.generate_csv('empty', 5, os.path.join(self.directory, 'empty.csv'))
+
+    def test_recorder_summary_and_comparison(self):
+        recorder = benchmarks.Recorder()
+        for latency in (0.1, 0.2, 0.3, 0.4, 0.5):
+            with mock.patch('time.perf_counter', side_effect=[0, latency]), recorder.measure('read', rows=1000):
+                pass
+        summary = recorder.summary()['read']
+        self.assertEqual((summary['runs'], summary['p50'], summary['failed']), (5, 0.3, 0))
+        self.assertAlmostEqual(summary['p99'], 0.496)
+        self.assertAlmostEqual(summary['rows_per_second'], 1000 / 0.3)
+        self.assertIsNone(summary['bytes_per_second'])
+
+        results = {'results': {'a': {'p50': 0.13}, 'b': {'p50': 0.1}, 'c': {'p50': 0.1}}}
+        baseline = {'results': {'a': {'p50': 0.1}, 'b': {'p50': 0.1}}}
+        compared = {key: regressed for key, _, _, _, regressed in benchmarks.compare(results, baseline, 0.2)}
+        self.assertEqual(compared, {'a': True, 'b': False})
+
+    def test_dataset_scenarios_recorded(self):
+        path = benchmarks.dataset_path('tall', 200, self.directory)
+        with self.captureOnCommitCallbacks(execute=True):
+            results = benchmarks.bench_dataset(path, 'eager', 2, benchmarks.SCENARIOS, warmup=0)
+        self.assertEqual(set(results), set(benchmarks.SCENARIOS))
+        self.assertEqual(results['process_csv']['runs'], 2)
+        self.assertEqual(results['process_csv']['rows_per_second'], 200 / results['process_csv']['p50'])
+        self.assertFalse(UploadedCSV.objects.exists())
+
+    def test_command_fails_on_regression(self):
+        results = {'environment': {}, 'parameters': {}, 'results': {'eager/tall/upload': {
+            'runs': 1, 'p50': 0.5, 'p95': 0.5, 'p99': 0.5, 'mean': 0.5, 'rows_per_second': 2.0,
+            'bytes_per_second': None, 'peak_memory_bytes': 0, 'failed': 0,
+        }}}
+        output, baseline = (os.path.join(self.directory, name) for name in ('results.json', 'baseline.json'))
+        benchmarks.save_results(dict(results, results={'eager/tall/upload': {'p50': 0.25}}), baseline)
+
+        with mock.patch.object(benchmarks, 'run_benchmarks', return_value=results) as run_benchmarks:
+            call_command('benchmark_csv', datasets='tall', modes='eager', rows=10, output=output, stdout=io.StringIO(), stderr=io.StringIO())
+            with self.assertRaises(CommandError):
+                call_command('benchmark_csv', output=output, baseline=baseline, stdout=io.StringIO(), stderr=io.StringIO())
+            call_command('benchmark_csv', output=output, baseline=baseline, threshold=1.5, stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(run_benchmarks.call_args_list[0].args[1:3], (['tall'], ['eager']))
+        self.assertEqual(benchmarks.load_results(output), results)
+        with self.assertRaises(CommandError):
+            call_command('benchmark_csv', datasets='tall,huge', output=output)
+
+
+class PendingChangesTests(CSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.uploaded_csv = self.upload()
+        self.content_type = ContentType.objects.get_for_model(UploadedCSV)
+
+    def add_change(self, station):
+        return CSVChanges.objects.create(
+            content_type=self.content_type, object_id=self.uploaded_csv.id,
+            data=[{'timestamp': '2020-01-01 04:00:00', 'station': station, 'pm25': 1.5, 'count': 2}],
+        )
+
+    def test_window_shared_between_processes(self):
+        with mock.patch.object(apply_pending_changes, 'apply_async') as apply_async:
+            schedule_csv_changes(self.add_change('D'))
+            for backend in caches.all():
+                backend.clear()  # The next change comes from another process, with caches of its own
+            schedule_csv_changes(self.add_change('E'))
+            self.assertEqual(apply_async.call_count, 1)
+
+            # The worker releases the window when its run starts, the next change schedules a new run
+            apply_pending_changes(self.content_type.id, self.uploaded_csv.id)
+            schedule_csv_changes(self.add_change('F'))
+            self.assertEqual(apply_async.call_count, 2)
+
+    def test_expired_window_claimed_again(self):
+        UploadedCSV.objects.filter(id=self.uploaded_csv.id).update(changes_scheduled_at=timezone.now() - timedelta(minutes=5))
+        with mock.patch.object(apply_pending_changes, 'apply_async') as apply_async:
+            schedule_csv_changes(self.add_change('D'))
+        apply_async.assert_called_once()
+
+    def test_reaper_applies_overdue_changes(self):
+        overdue = self.add_change('D')
+        CSVChanges.objects.filter(id=overdue.id).update(created_at=timezone.now() - timedelta(minutes=5))
+        self.add_change('E')  # Applied in the same run
+
+        with self.captureOnCommitCallbacks(execute=True):
+            retry_failed_and_unprocessed_csvs()
+
+        self.assertEqual(set(CSVChanges.objects.values_list('status', flat=True)), {'processed'})
+        derived_csv = DerivedCSV.objects.filter(parent=self.uploaded_csv).latest('id')
+        self.assertEqual([row['station'] for row in derived_csv.rows[4:]], ['D', 'E'])
+
+    def test_reaper_leaves_changes_within_window(self):
+        self.add_change('D')
+        retry_failed_and_unprocessed_csvs()
+        self.assertEqual(CSVChanges.objects.get().status, 'pending')
+
+
+class ListingQueriesTests(CSVTestCase):
+    """
+    The listings load a page with a fixed number of queries, whatever the number of datasets on it.
+    """
+
+    def add_datasets(self, count):
+        content_types = ContentType.objects.get_for_models(UploadedCSV, DerivedCSV)
+        for _ in range(count):
+            uploaded_csv = UploadedCSV.objects.create(name='sample.csv', status='processed', row_count=4)
+            derived_csv = DerivedCSV.objects.create(parent=uploaded_csv, row_count=5)
+            for csv_entry in (uploaded_csv, derived_csv):
+                CSVChanges.objects.create(
+                    content_type=content_types[type(csv_entry)], object_id=csv_entry.id,
+                    data=[{'station': 'D'}], status='processed',
+                )
+
+    def assert_queries(self, url, expected):
+        for total in (5, 10):  # N, then 2N datasets
+            self.add_datasets(total - UploadedCSV.objects.count())
+            with self.assertNumQueries(expected):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+    def test_my_csvs(self):
+        self.assert_queries('/my_csvs/', 2)
+
+    def test_my_changes(self):
+        self.assert_queries('/my_changes/', 3)
+
+
+class AppendTests(CSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.uploaded_csv = self.upload()
+
+    def append(self, body, content_type):
+        response = self.client.post(f'/append_csv/{self.uploaded_csv.id}/', body, content_type=content_type)
+        self.assertEqual(response.status_code, 200, response.content)
+        return [row for change in CSVChanges.objects.order_by('id') for row in change.data]
+
+    def test_ndjson_whole_numbers_stored_as_floats(self):
+        rows = self.append(
+            '{"timestamp": "2020-01-01 04:00:00", "station": "D", "pm25": 3, "count": 2}\n'
+            '{"timestamp": "2020-01-01 05:00:00", "station": "E", "pm25": 4, "count": 7}\n',
+            'application/x-ndjson',
+        )
+        self.assertEqual([row['pm25'] for row in rows], [3.0, 4.0])
+        self.assertIsInstance(rows[0]['pm25'], float)
+        self.assertIsInstance(rows[0]['count'], int)
+
+    def test_csv_whole_numbers_stored_as_floats(self):
+        rows = self.append('Timestamp,Station,PM2.5,Count\n2020-01-01 04:00:00,D,3,2\n', 'text/csv')
+        self.assertIsInstance(rows[0]['pm25'], float)
+        self.assertEqual(rows[0]['pm25'], 3.0)
+
+
+class SchemaInferenceTests(CSVTestCase):
+    def test_whole_floats_stay_floats(self):
+        uploaded_csv = self.upload('Level,Count\n1.0,1\n2.0,\n')
+        self.assertEqual(uploaded_csv.schema, {'level': 'float', 'count': 'integer'})
+
+        derived_csv = DerivedCSV.objects.filter(parent=uploaded_csv).latest('id')
+        self.assertEqual([row['level'] for row in derived_csv.rows[0:2]], [0.5, 1.0])
+        self.assertEqual([row['count'] for row in derived_csv.rows[0:2]], [0, None])
+
+
+class FailProcessingTests(CSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.uploaded_csv = self.upload()
+        UploadedCSV.objects.filter(id=self.uploaded_csv.id).update(
+            status='processing', processing_token='old', processing_attempts=settings.CSV_PROCESSING_MAX_ATTEMPTS,
+        )
+        self.uploaded_csv.refresh_from_db()
+
+    def test_stale_run_leaves_newer_claim_alone(self):
+        UploadedCSV.objects.filter(id=self.uploaded_csv.id).update(processing_token='new')
+        fail_processing(self.uploaded_csv, 'old', 'Worker lost')
+
+        uploaded_csv = UploadedCSV.objects.get(id=self.uploaded_csv.id)
+        self.assertEqual((uploaded_csv.status, uploaded_csv.processing_token), ('processing', 'new'))
+        self.assertIsNone(uploaded_csv.failure_reason)
+        self.assertEqual(len(uploaded_csv.rows), 4)
+
+    def test_last_attempt_discards_rows(self):
+        fail_processing(self.uploaded_csv, 'old', 'Worker lost')
+
+        uploaded_csv = UploadedCSV.objects.get(id=self.uploaded_csv.id)
+        self.assertEqual((uploaded_csv.status, uploaded_csv.failure_reason), ('failed_processing', 'Worker lost'))
+        self.assertEqual(len(uploaded_csv.rows), 0)
+
+
+class ProcessingRunTests(CSVTestCase):
+    def test_reaper_purges_expired_runs(self):
+        self.upload()
+        expired = ProcessingRun.objects.latest('id')
+        ProcessingRun.objects.filter(id=expired.id).update(
+            started_at=timezone.now() - timedelta(days=settings.CSV_RUN_RETENTION_DAYS + 1),
+        )
+        kept = set(ProcessingRun.objects.exclude(id=expired.id).values_list('id', flat=True))
+
+        retry_failed_and_unprocessed_csvs()
+        self.assertEqual(set(ProcessingRun.objects.values_list('id', flat=True)), kept)
+
+    def test_peak_memory_reset_only_in_exclusive_processes(self):
+        with mock.patch.object(instrumentation, 'reset_peak_memory') as reset_peak_memory:
+            self.upload()
+            reset_peak_memory.assert_not_called()
+
+            with mock.patch.object(instrumentation, '_exclusive_process', True):
+                self.upload()
+            reset_peak_memory.assert_called()
+
+
+class OrderedJSONFieldTests(CSVTestCase):
+    """
+    Keys come back in the order they were written, the column order of rows and schemas.
+    """
+
+    def test_row_keys_keep_their_order(self):
+        uploaded_csv = self.upload()
+        row = {'zeta': 1, 'alpha': 'a', 'mid': None, 'beta': 2.5}
+        uploaded_csv.rows.append([row])
+
+        stored = CSVRow.objects.filter(object_id=uploaded_csv.id).order_by('-row_index').first()
+        self.assertEqual(list(stored.data), list(row))
+        self.assertEqual(stored.data, row)
+        self.assertEqual(list(uploaded_csv.rows[4]), list(row))
+
+    def test_schema_keys_keep_their_order(self):
+        uploaded_csv = self.upload()
+        self.assertEqual(list(uploaded_csv.schema), ['timestamp', 'station', 'pm25', 'count'])
+
+        uploaded_csv.schema = {'z': 'string', 'a': 'integer', 'm': 'float'}
+        uploaded_csv.save(update_fields=['schema'])
+        self.assertEqual(list(UploadedCSV.objects.get(id=uploaded_csv.id).schema), ['z', 'a', 'm'])
+        self.assertEqual(
+            list(UploadedCSV.objects.filter(id=uploaded_csv.id).values_list('schema', flat=True).get()),
+            ['z', 'a', 'm'],
+        )
+
+
+class ColumnReadTests(CSVTestCase):
+    def test_column_reads_keep_json_types(self):
+        uploaded_csv = self.upload()
+        df = uploaded_csv.rows.to_frame(['pm25', 'count', 'station'])
+        self.assertEqual(df['pm25'].tolist()[:2], [12.5, 7.25])
+        self.assertTrue(df['pm25'].isna().tolist()[2])
+        self.assertEqual(df['count'].tolist(), [3, 8, 5, 1])
+        self.assertEqual(df['station'].tolist(), ['A', 'B', 'A', 'C'])
+
+
+@skipUnless(pa is not None, "The 'arrow' storage backend needs pyarrow")
+@override_settings(CSV_STORAGE_BACKEND='arrow')
+class ArrowStoreTests(CSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.uploaded_csv = self.upload()
+
+    def test_rows_stored_as_typed_arrow_files(self):
+        self.assertEqual(self.uploaded_csv.storage, 'arrow')
+        self.assertEqual(self.uploaded_csv.stored_rows.count(), 0)
+        store = self.uploaded_csv.rows.store
+        self.assertEqual(self.uploaded_csv.size_bytes, store.stored_size())
+        self.assertEqual([str(field.type) for field in store.table.schema], ['string', 'string', 'double', 'int64'])
+
+        rows = self.uploaded_csv.rows
+        self.assertEqual(rows[0], {'timestamp': '2020-01-01 00:00:00', 'station': 'A', 'pm25': 12.5, 'count': 3})
+        self.assertIsNone(rows[2]['pm25'])
+        self.assertEqual([row['count'] for row in rows.rows_at([3, 1])], [1, 8])
+        self.assertEqual(list(rows.to_frame(['station']).columns), ['station'])
+
+    def test_appended_batches_read_across_files(self):
+        content_type = ContentType.objects.get_for_model(UploadedCSV)
+        for station in ('D', 'E'):
+            CSVChanges.objects.create(
+                content_type=content_type, object_id=self.uploaded_csv.id,
+                data=[{'timestamp': '2020-01-01 04:00:00', 'station': station, 'pm25': 1.5, 'count': 2}],
+            )
+        apply_pending_changes(content_type.id, self.uploaded_csv.id)
+        derived_csv = DerivedCSV.objects.filter(parent=self.uploaded_csv).latest('id')
+        self.assertEqual([row['station'] for row in derived_csv.rows[3:5]], ['C', 'D'])
+
+        derived_csv.rows.materialize()  # Copies the base rows in front, as another file
+        derived_csv.save()
+        rows = derived_csv.rows
+        self.assertEqual(len(glob.glob(os.path.join(rows.store.directory, 'part-*.arrow'))), 2)
+        self.assertEqual([row['station'] for row in rows], ['A', 'B', 'A', 'C', 'D', 'E'])
+        self.assertEqual([row['station'] for row in rows[3:5]], ['C', 'D'])
+
+    def test_truncate_and_delete_remove_files(self):
+        self.uploaded_csv.rows.append([{'timestamp': '2020-01-01 04:00:00', 'station': 'D', 'pm25': 1.0, 'count': 2}])
+        uploaded_csv = UploadedCSV.objects.get(id=self.uploaded_csv.id)  # The append was never saved
+        uploaded_csv.rows.truncate()
+        self.assertEqual(len(glob.glob(os.path.join(uploaded_csv.rows.store.directory, 'part-*'))), 1)
+        self.assertEqual(len(uploaded_csv.rows), 4)
+
+        directory = uploaded_csv.rows.store.directory
+        with self.captureOnCommitCallbacks(execute=True):
+            uploaded_csv.delete()
+        self.assertFalse(os.path.exists(directory))
+
+
+@override_settings(CSV_STORAGE_BACKEND='compressed', CSV_BLOCK_ROWS=3, CSV_COMPRESSION_CODEC='gzip')
+class CompressedStoreTests(CSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.uploaded_csv = self.upload()
+
+    def test_codecs_round_trip(self):
+        columns = ['timestamp', 'station', 'pm25', 'count']
+        values = [[f'2020-01-01 {index % 24:02d}:00:00', f'S{index % 7}', (index * 37 % 101) / 4, index] for index in range(200)]
+        values[3][2] = None
+        codecs = ['gzip', 'none'] + (['zstd'] if compression.zstandard is not None else [])
+        for codec in codecs:
+            keyed, plain = (encode_block(columns, values, codec, key_dictionary) for key_dictionary in (True, False))
+            self.assertEqual(decode_block(keyed, codec), (columns, values), codec)
+            self.assertEqual(decode_block(plain, codec), (None, [dict(zip(columns, row)) for row in values]), codec)
+            if codec != 'none':
+                self.assertLess(len(keyed), len(encode_block(columns, values, 'none', True)) / 3, codec)
+        # The column names are stored once instead of in every row
+        self.assertLess(len(encode_block(columns, values, 'none', True)), len(encode_block(columns, values, 'none', False)) / 1.5)
+
+    def test_unusable_codecs_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            check_codec('brotli')
+        with mock.patch.object(compression, 'zstandard', None), self.assertRaises(ImproperlyConfigured):
+            check_codec('zstd')
+        with override_settings(CSV_COMPRESSION_CODEC='brotli'), self.assertRaises(ImproperlyConfigured):
+            self.uploaded_csv.rows.append([{'timestamp': '2020-01-01 04:00:00', 'station': 'D', 'pm25': 1.0, 'count': 2}])
+
+    def test_rows_stored_as_compressed_blocks(self):
+        self.assertEqual(self.uploaded_csv.storage, 'compressed')
+        self.assertEqual(self.uploaded_csv.stored_rows.count(), 0)
+        blocks = self.uploaded_csv.compressed_rows.order_by('start')
+        self.assertEqual(list(blocks.values_list('start', 'stop', 'codec')), [(0, 3, 'gzip'), (3, 4, 'gzip')])
+        self.assertEqual(self.uploaded_csv.size_bytes, self.uploaded_csv.rows.store.stored_size())
+
+        with override_settings(CSV_STORAGE_BACKEND='rows'):
+            expected = self.upload()
+        rows = self.uploaded_csv.rows
+        self.assertEqual(list(rows), list(expected.rows))
+        self.assertEqual([row['count'] for row in rows.rows_at([3, 0, 1])], [1, 3, 8])
+        self.assertEqual(rows[1:3], expected.rows[1:3])
+        pd.testing.assert_frame_equal(rows.to_frame(['station', 'pm25']), expected.rows.to_frame(['station', 'pm25']))
+        for url in ('/download_csv/{}/', '/view_csv/{}/rows/?sort=pm25&order=desc'):
+            self.assertEqual(self.client.get(url.format(self.uploaded_csv.id)).getvalue(), self.client.get(url.format(expected.id)).getvalue())
+
+    def test_blocks_of_other_codecs_stay_readable(self):
+        with override_settings(CSV_COMPRESSION_CODEC='none', CSV_COMPRESSION_KEY_DICTIONARY=False):
+            self.uploaded_csv.rows.append([
+                {'timestamp': f'2020-01-01 0{hour}:00:00', 'station': 'D', 'pm25': 1.0, 'count': hour} for hour in (4, 5, 6)
+            ])
+        self.uploaded_csv.save()
+        blocks = self.uploaded_csv.compressed_rows.order_by('start')
+        self.assertEqual(list(blocks.values_list('start', 'stop', 'codec')), [(0, 3, 'gzip'), (3, 4, 'gzip'), (4, 6, 'none'), (6, 7, 'none')])
+
+        rows = UploadedCSV.objects.get(id=self.uploaded_csv.id).rows
+        self.assertEqual([row['count'] for row in rows], [3, 8, 5, 1, 4, 5, 6])
+        self.assertEqual([row['count'] for row in rows.rows_at([5, 2])], [5, 5])
+
+    def test_truncate_reencodes_partial_block(self):
+        self.uploaded_csv.rows.append([
+            {'timestamp': f'2020-01-01 0{hour}:00:00', 'station': 'D', 'pm25': 1.0, 'count': hour} for hour in (4, 5, 6)
+        ])
+        uploaded_csv = UploadedCSV.objects.get(id=self.uploaded_csv.id)  # The append was never saved
+        uploaded_csv.rows.truncate()
+        self.assertEqual(list(uploaded_csv.compressed_rows.order_by('start').values_list('start', 'stop')), [(0, 3), (3, 4)])
+        self.assertEqual([row['count'] for row in uploaded_csv.rows], [3, 8, 5, 1])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            uploaded_csv.delete()
+        self.assertFalse(CompressedRows.objects.exists())
+
+
+@skipUnless(connection.vendor == 'postgresql', "COPY and server-side cursors are PostgreSQL features")
+@override_settings(CSV_STORAGE_BACKEND='rows', CSV_ROW_BATCH_SIZE=3)
+class PostgreSQLRowStoreTests(CSVTestCase):
+    def test_rows_loaded_with_copy(self):
+        with mock.patch.object(RowStore, '_copy', autospec=True, side_effect=RowStore._copy) as copy, \
+                mock.patch.object(CSVRow.objects, 'bulk_create') as bulk_create:
+            uploaded_csv = self.upload()
+        self.assertTrue(copy.called)
+        bulk_create.assert_not_called()
+
+        self.assertEqual(uploaded_csv.row_count, 4)
+        self.assertEqual(uploaded_csv.size_bytes, uploaded_csv.rows.store.stored_size())
+        self.assertEqual(
+            [row['station'] for row in uploaded_csv.rows.iter_rows()], ['A', 'B', 'A', 'C'],
+        )
+
+    def test_iter_batches_streams_through_named_cursor(self):
+        uploaded_csv = self.upload()
+        batches = uploaded_csv.rows.iter_batches(batch_size=2)
+        first = next(batches)
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM pg_cursors")
+            names = [name for name, in cursor.fetchall()]
+        self.assertTrue(any(name.startswith('_django_curs_') for name in names), names)
+
+        rows = first + [row for batch in batches for row in batch]
+        self.assertEqual([row['station'] for row in rows], ['A', 'B', 'A', 'C'])
+        self.assertEqual(list(rows[0]), ['timestamp', 'station', 'pm25', 'count'])
+
+
+class QueryTests(CSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.uploaded_csv = self.upload()
+
+    def query(self, spec, status=200):
+        response = self.client.get(f'/query_csv/{self.uploaded_csv.id}/', {'q': json.dumps(spec)})
+        self.assertEqual(response.status_code, status, response.content)
+        return response.json()
+
+    def test_where_and_order(self):
+        result = self.query({
+            'select': ['station', 'pm25'], 'where': [{'column': 'pm25', 'op': 'gte', 'value': 10}],
+            'order_by': [{'column': 'pm25', 'desc': True}],
+        })
+        self.assertEqual(result['columns'], ['station', 'pm25'])
+        self.assertEqual(result['rows'], [['C', 30.0], ['A', 12.5]])
+
+    def test_grouped_aggregates(self):
+        result = self.query({
+            'group_by': ['station'],
+            'aggregates': [{'op': 'sum', 'column': 'count'}, {'op': 'mean', 'column': 'pm25'}, {'op': 'count'}],
+        })
+        self.assertEqual(result['columns'], ['station', 'sum_count', 'mean_pm25', 'count'])
+        self.assertEqual(result['rows'], [['A', 8, 12.5, 2], ['B', 8, 7.25, 1], ['C', 1, 30.0, 1]])
+        self.assertIsInstance(result['rows'][0][1], int)
+
+    def test_group_without_aggregates_returns_distinct_groups(self):
+        result = self.query({'group_by': ['station']})
+        self.assertEqual(result['rows'], [['A'], ['B'], ['C']])
+
+    def test_malformed_specs_rejected(self):
+        specs = [
+            {'order_by': [['pm25']]},
+            {'order_by': [{'column': ['pm25']}]},
+            {'group_by': [['station']], 'aggregates': [{'op': 'count'}]},
+            {'group_by': [{'column': 'timestamp', 'bucket': ['day']}]},
+            {'where': [{'column': ['pm25'], 'op': 'gte', 'value': 1}]},
+            {'where': [{'column': 5, 'op': 'eq', 'value': 1}]},
+            {'where': [{'column': 'pm25', 'op': ['eq'], 'value': 1}]},
+            {'select': [{'column': 'pm25'}]},
+            {'aggregates': [{'op': 'count', 'as': ['n']}]},
+            {'limit': True},
+            {'limit': 0},
+        ]
+        for spec in specs:
+            with self.subTest(spec=spec):
+                self.assertEqual(self.query(spec, status=400)['status'], 'error')
+
+
+class AsyncViewTests(CSVTestCase):
+    def setUp(self):
+        super().setUp()
+        self.uploaded_csv = self.upload()
+        self.factory = AsyncRequestFactory()
+
+    async def test_download_streams_asynchronously(self):
+        request = self.factory.get(f'/download_csv/{self.uploaded_csv.id}/')
+        response = await async_views.download_csv(request, self.uploaded_csv.id)
+        self.assertTrue(response.is_async)
+        body = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(body.decode().splitlines()[0], 'timestamp,station,pm25,count')
+        self.assertEqual(len(body.decode().splitlines()), 5)
+
+    async def test_rows_page(self):
+        request = self.factory.get(f'/view_csv/{self.uploaded_csv.id}/rows/', {'sort': 'pm25', 'order': 'desc', 'limit': 2})
+        response = await async_views.view_csv_rows(request, self.uploaded_csv.id)
+        self.assertEqual(response.status_code, 200)
+        page = json.loads(response.content)
+        station = page['columns'].index('station')
+        self.assertEqual([row[station] for row in page['rows']], ['C', 'A'])
+
+    async def test_missing_dataset(self):
+        response = await async_views.download_csv(self.factory.get('/download_csv/0/'), 0)
+        self.assertEqual(response.status_code, 404)
+
+    async def test_json_reads_match_sync_views(self):
+        csv_id = self.uploaded_csv.id
+        derived_csv = await DerivedCSV.objects.filter(parent_id=csv_id).alatest('id')
+        reads = [
+            ('visualize_csv_data', f'/visualize_csv/{csv_id}/data/', {'kind': 'series', 'column': 'pm25'}, csv_id, {}),
+            ('visualize_csv_data', f'/visualize_csv/{derived_csv.id}/data/', {'column': 'count', 'is_derived': '1'}, derived_csv.id, {}),
+            ('query_csv', f'/query_csv/{csv_id}/', {'q': json.dumps({'group_by': ['station']})}, csv_id, {}),
+            ('view_csv_rows', f'/view_csv/{derived_csv.id}/derived/rows/', {'limit': 2}, derived_csv.id, {'is_derived': True}),
+        ]
+        for name, path, params, view_id, kwargs in reads:
+            with self.subTest(path=path):
+                response = await getattr(async_views, name)(self.factory.get(path, params), view_id, **kwargs)
+                expected = await sync_to_async(self.client.get)(path, params)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(json.loads(response.content), expected.json())
+
+    async def test_pages_rendered(self):
+        csv_id = self.uploaded_csv.id
+        response = await async_views.view_csv(self.factory.get(f'/view_csv/{csv_id}/'), csv_id)
+        self.assertContains(response, 'pm25')
+        response = await async_views.visualize_csv(self.factory.get(f'/visualize_csv/{csv_id}/'), csv_id)
+        self.assertContains(response, 'csv-column-stats')
+
+    async def test_unchanged_chart_data_not_modified(self):
+        csv_id = self.uploaded_csv.id
+        path, params = f'/visualize_csv/{csv_id}/data/', {'column': 'pm25'}
+        response = await async_views.visualize_csv_data(self.factory.get(path, params), csv_id)
+        request = self.factory.get(path, params, headers={'If-None-Match': response['ETag']})
+        response = await async_views.visualize_csv_data(request, csv_id)
+        self.assertEqual(response.status_code, 304)
+
+    async def test_invalid_requests_rejected(self):
+        csv_id = self.uploaded_csv.id
+        request = self.factory.get(f'/visualize_csv/{csv_id}/data/', {'kind': 'pie', 'column': 'pm25'})
+        self.assertEqual((await async_views.visualize_csv_data(request, csv_id)).status_code, 400)
+        request = self.factory.get(f'/query_csv/{csv_id}/', {'q': json.dumps({'select': ['missing']})})
+        self.assertEqual((await async_views.query_csv(request, csv_id)).status_code, 400)
+        request = self.factory.get(f'/download_csv/{csv_id}/', {'format': 'pdf'})
+        self.assertEqual((await async_views.download_csv(request, csv_id)).status_code, 400)
+
+    async def test_stream_closed_when_iteration_stops(self):
+        closed = []
+
+        def chunks():
+            try:
+                yield b'a'
+                yield b'b'
+            finally:
+                closed.append(True)
+
+        stream = aiter_chunks(chunks())
+        self.assertEqual(await anext(stream), b'a')
+        await stream.aclose()
+        self.assertEqual(closed, [True])
@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+
+NUMERIC_TYPES = ('integer', 'float')
+TRANSFORMS = {}  # Transform name to (function, lookback)
+
+
+class TransformError(ValueError):
+    """
+    Raised for transform pipeline steps that are unknown or badly configured.
+    """
+
+
+def register_transform(name, lookback=None):
+    """
+    Register a column transform under a name usable in CSV_DERIVED_TRANSFORMS.
+
+    The decorated function takes a numeric pandas Series and the step parameters and returns
+    the transformed Series, working on the whole column at once. Transforms that look at
+    previous rows declare lookback, a function of the step parameters giving how many rows
+    of the previous chunk they need to produce the same result as over the whole file.
+    """
+    def decorator(function):
+        TRANSFORMS[name] = (function, lookback)
+        return function
+    return decorator
+
+
+@register_transform('halve')
+def halve(series):
+    """
+    Divide values by 2, the default derivation.
+    """
+    return series / 2
+
+
+@register_transform('scale')
+def scale(series, factor=1, offset=0):
+    """
+    Multiply values by factor and add offset.
+    """
+    return series * factor + offset
+
+
+@register_transform('clip')
+def clip(series, lower=None, upper=None):
+    """
+    Limit values to [lower, upper].
+    """
+    return series.clip(lower=lower, upper=upper)
+
+
+@register_transform('fill_na')
+def fill_na(series, value=0):
+    """
+    Replace missing values with value.
+    """
+    return series.fillna(value)
+
+
+@register_transform('rolling_mean', lookback=lambda window=3, **params: window - 1)
+def rolling_mean(series, window=3, min_periods=1):
+    """
+    Mean of each value and the window - 1 values before it.
+    """
+    return series.rolling(window, min_periods=min_periods).mean()
+
+
+def needs_lookback(steps=None):
+    """
+    Whether a transform pipeline reads rows of previous chunks, so that chunks of a file
+    cannot be transformed independently of each other.
+    """
+    steps = settings.CSV_DERIVED_TRANSFORMS if steps is None else steps
+    return any(TRANSFORMS.get(step.get('transform'), (None, None))[1] for step in steps)
+
+
+def cast_to_type(series, col_type):
+    """
+    Bring a transformed column back to its schema type, integers are floored like the original
+    integer halving.
+    """
+    if col_type == 'integer':
+        return np.floor(series).astype('Int64')
+    return series.astype('float64')
+
+
+class TransformPipeline:
+    """
+    Applies a list of transform steps to the numeric columns of a dataset, chunk by chunk.
+
+    Each step is a dict with the transform name under 'transform', optionally the 'columns' it
+    applies to (all integer and float columns by default) and the transform parameters.
+    Chunks must be given in file order, the pipeline keeps the rows that lookback transforms
+    need from the previous chunk.
+    """
+
+    def __init__(self, schema, steps=None):
+        self.schema = schema
+        self.steps = []
+        for step in settings.CSV_DERIVED_TRANSFORMS if steps is None else steps:
+            params = dict(step)
+            name = params.pop('transform', None)
+            if name not in TRANSFORMS:
+                raise TransformError(f"Unknown transform '{name}'.")
+            columns = params.pop('columns', None)
+            if columns is None:
+                columns = [column for column, col_type in schema.items() if col_type in NUMERIC_TYPES]
+            elif any(schema.get(column) not in NUMERIC_TYPES for column in columns):
+                raise TransformError(f"Transform '{name}' only applies to integer and float columns.")
+            self.steps.append((name, columns, params))
+        self.tails = [None] * len(self.steps)
+
+    def __call__(self, df):
+        """
+        Transform one normalized chunk, returning a new DataFrame.
+        """
+        df = df.copy()
+        for position, (name, columns, params) in enumerate(self.steps):
+            function, lookback = TRANSFORMS[name]
+            if not columns:
+                continue
+            values = df[columns]
+
+            context = lookback(**params) if lookback else 0
+            if context:
+                if self.tails[position] is not None:
+                    values = pd.concat([self.tails[position], values])
+                self.tails[position] = values.iloc[-context:]
+
+            for column in columns:
+                transformed = function(values[column].astype('float64'), **params)
+                df[column] = cast_to_type(transformed.iloc[len(values) - len(df):], self.schema[column])
+
+        return df
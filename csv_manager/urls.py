@@ -1,17 +1,31 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import views, async_views
+
+# Dataset reads are served by their async variants under ASGI, see CSV_ASYNC_VIEWS
+reads = async_views if settings.CSV_ASYNC_VIEWS else views
 
 urlpatterns = [
     path('', views.home, name='home'),
     path('my_csvs/', views.my_csvs, name='my_csvs'),
+    path('my_csvs/progress/', views.processing_progress, name='processing_progress'),
     path('upload_csv/', views.upload_csv, name='upload_csv'),
-    path('download_csv/<int:csv_id>/', views.download_csv, name='download_csv'),
-    path('download_csv/<int:csv_id>/derived/', views.download_csv, {'is_derived': True}, name='download_derived_csv'),
+    path('download_csv/<int:csv_id>/', reads.download_csv, name='download_csv'),
+    path('download_csv/<int:csv_id>/derived/', reads.download_csv, {'is_derived': True}, name='download_derived_csv'),
     path('delete_csv/<int:csv_id>/', views.delete_csv, name='delete_csv'),
     path('delete_csv/<int:csv_id>/derived/', views.delete_csv, {'is_derived': True}, name='delete_derived_csv'),
-    path('view_csv/<int:csv_id>/', views.view_csv, name='view_csv'),
-    path('view_csv/<int:csv_id>/derived/', views.view_csv, {'is_derived': True}, name='view_csv_derived'),
+    path('view_csv/<int:csv_id>/', reads.view_csv, name='view_csv'),
+    path('view_csv/<int:csv_id>/derived/', reads.view_csv, {'is_derived': True}, name='view_csv_derived'),
+    path('view_csv/<int:csv_id>/rows/', reads.view_csv_rows, name='view_csv_rows'),
+    path('view_csv/<int:csv_id>/derived/rows/', reads.view_csv_rows, {'is_derived': True}, name='view_csv_derived_rows'),
     path('add_data_csv/<int:csv_id>/', views.add_data_to_csv, name='add_data_csv'),
-    path('visualize_csv/<int:csv_id>/', views.visualize_csv, name='visualize_csv'),
+    path('append_csv/<int:csv_id>/', views.append_csv_rows, name='append_csv'),
+    path('append_csv/<int:csv_id>/derived/', views.append_csv_rows, {'is_derived': True}, name='append_derived_csv'),
+    path('visualize_csv/<int:csv_id>/', reads.visualize_csv, name='visualize_csv'),
+    path('visualize_csv/<int:csv_id>/data/', reads.visualize_csv_data, name='visualize_csv_data'),
+    path('query_csv/<int:csv_id>/', reads.query_csv, name='query_csv'),
+    path('query_csv/<int:csv_id>/derived/', reads.query_csv, {'is_derived': True}, name='query_derived_csv'),
     path('my_changes/', views.my_changes, name='my_changes'),
+    path('cache_stats/', views.csv_cache_stats, name='cache_stats'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
\ No newline at end of file
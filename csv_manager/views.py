@@ -1,12 +1,31 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
+from django.conf import settings
+from django.db import transaction
+from django.views.decorators.csrf import csrf_exempt
+from django.utils.cache import patch_vary_headers
 from .models import UploadedCSV, DerivedCSV, CSVChanges
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.contenttypes.prefetch import GenericPrefetch
+from django.db.models import Prefetch
 from django.contrib import messages
 from mimetypes import guess_type
 from datetime import datetime
-from .tasks import process_csv, apply_csv_changes
-import csv
+from .tasks import process_csv, schedule_csv_changes
+from .aggregation import chart_data, AggregationError
+from .schema import BOOLEAN_VALUES
+from .appends import append_format, append_rows, AppendError
+from .table import parse_filters, parse_table_query, table_page, TableQueryError
+from .query import load_spec, parse_query, query_hash, run_query, result_csv, QueryError
+from .exports import (
+    CONTENT_ENCODED_FORMATS, EXPORT_FORMATS, EXPORT_PARAMS, ExportError, export_variant, iter_export, gzip_chunks,
+    parse_export_query, slice_chunks, parse_range,
+)
+from .fingerprints import file_hash
+from .instrumentation import timed_view
+from .metrics import render_metrics
+from .caching import cached_page, cached_export, cached_export_length, cache_export, cache_stats, conditional_response, is_cacheable
+import hashlib
 import json
 import io
 
@@ -17,12 +36,55 @@ def home(request):
     """
     return render(request, 'csv_manager/home.html', {'is_home': True})
 
+def keyset_page(queryset, request):
+    """
+    One page of a queryset ordered by descending id, starting below the id given as ?before=.
+    Returns the objects of the page and the before value of the next page, or None on the last page.
+    """
+    page_size = settings.CSV_LIST_PAGE_SIZE
+    before = request.GET.get('before', '')
+    if before.isdigit():
+        queryset = queryset.filter(id__lt=int(before))
+
+    objects = list(queryset.order_by('-id')[:page_size + 1])
+    next_before = objects[page_size - 1].id if len(objects) > page_size else None
+    return objects[:page_size], next_before
+
+
+# Fields UploadedCSV.progress reads besides the status
+PROGRESS_FIELDS = ['rows_done', 'rows_total', 'processing_started_at', 'checkpoint']
+
 def my_csvs(request):
     """
-    Display all uploaded CSVs with their upload times.
+    Display the uploaded CSVs with their upload times, column statistics and derived CSVs, newest first,
+    a page at a time. Only the listed fields are loaded, with the derived CSVs of the whole page in one query.
+    """
+    derived_csvs = DerivedCSV.objects.only('id', 'parent', 'created_at', 'row_count', 'size_bytes').order_by('id')
+    csvs = UploadedCSV.objects.only(
+        'id', 'name', 'status', 'failure_reason', 'created_at', 'row_count', 'size_bytes', 'column_stats',
+        *PROGRESS_FIELDS,
+    ).prefetch_related(Prefetch('derived_csvs', queryset=derived_csvs))
+
+    csvs, next_before = keyset_page(csvs, request)
+    return render(request, 'csv_manager/my_csvs.html', {
+        'csvs': csvs,
+        'next_before': next_before,
+        'is_first_page': 'before' not in request.GET,
+        'poll_interval': settings.CSV_PROGRESS_POLL_INTERVAL,
+    })
+
+def processing_progress(request):
+    """
+    Processing progress of the UploadedCSVs listed in ?ids=1,2,3 as JSON, polled by the my_csvs page
+    so the listing itself is only reloaded once processing is over.
     """
-    csvs = UploadedCSV.objects.all()
-    return render(request, 'csv_manager/my_csvs.html', {'csvs': csvs})
+    try:
+        ids = [int(value) for value in request.GET.get('ids', '').split(',') if value]
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'ids must be comma-separated integers.'}, status=400)
+
+    uploads = UploadedCSV.objects.filter(id__in=ids[:settings.CSV_LIST_PAGE_SIZE]).only('id', 'status', 'failure_reason', *PROGRESS_FIELDS)
+    return JsonResponse({'status': 'success', 'uploads': [upload.progress() for upload in uploads]})
 
 def upload_csv(request):
     """
@@ -36,10 +98,15 @@ def upload_csv(request):
             messages.error(request, "Invalid file type. Please upload a valid CSV file.", extra_tags='warning')
             return redirect('home')
 
-        decoded_file = file.read().decode('utf-8')
-
-        # Save the parsed data to the database
-        uploaded_csv = UploadedCSV.objects.create(name=name, content=json.dumps(decoded_file))
+        # Spool the upload to storage chunk by chunk, it is parsed in the background.
+        # An identical file already in storage is shared rather than stored again.
+        uploaded_csv = UploadedCSV(name=name, content_hash=file_hash(file))
+        duplicate = UploadedCSV.objects.filter(content_hash=uploaded_csv.content_hash).exclude(raw_file='').order_by('id').first()
+        if duplicate is not None:
+            uploaded_csv.raw_file.name = duplicate.raw_file.name
+            uploaded_csv.save()
+        else:
+            uploaded_csv.raw_file.save(name, file)
 
         messages.success(
             request, 
@@ -53,32 +120,114 @@ def upload_csv(request):
 
     return render(request, 'csv_manager/home.html')
 
+@timed_view
 def download_csv(request, csv_id, is_derived=False):
     """
-    Download an UploadedCSV or DerivedCSV as a CSV file.
+    Download an UploadedCSV or DerivedCSV as a CSV file, or with ?format= as gzip compressed CSV
+    (csv.gz), NDJSON, Parquet typed by the schema or XLSX, see exports.py.
+    The file is streamed batch by batch from the row store, CSV and NDJSON gzip compressed when the client
+    accepts it and CSV_DOWNLOAD_GZIP is on. Single byte ranges are supported to resume downloads.
+    Downloads of processed datasets carry an ETag and are served from the dataset cache once streamed.
+    Column filters as in view_csv_rows, e.g. ?timestamp__gte=2020-01-01&timestamp__lt=2020-01-02,
+    export only the matching rows, read from the row blocks that can hold them. ?columns=a,b exports
+    only those columns and ?start=&stop= only the rows with a row index in [start, stop).
     """
     try:
         if is_derived:
-            csv_entry = DerivedCSV.objects.get(id=csv_id)
-            file_name = f"{csv_entry.parent.name.split('.')[0]}-derived-{csv_id}.csv"
+            csv_entry = DerivedCSV.objects.select_related('parent').get(id=csv_id)
         else:
             csv_entry = UploadedCSV.objects.get(id=csv_id)
-            file_name = csv_entry.name
+    except (UploadedCSV.DoesNotExist, DerivedCSV.DoesNotExist):
+        return HttpResponse("CSV not found.", status=404)
 
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = f'attachment; filename="{file_name}"'
+    try:
+        chunks, status, headers = csv_download(request, csv_entry, is_derived)
+    except (TableQueryError, ExportError) as e:
+        return HttpResponse(str(e), status=400)
+    if chunks is None:
+        return HttpResponse(status=status, headers=headers)
 
-        writer = csv.writer(response)
-        content = csv_entry.content
-        if content:
-            keys = content[0].keys()
-            writer.writerow(keys)
-            for row in content:
-                writer.writerow(row.values())
+    response = StreamingHttpResponse(chunks, status=status, headers=headers)
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
 
-        return response
-    except (UploadedCSV.DoesNotExist, DerivedCSV.DoesNotExist):
-        return HttpResponse("CSV not found.", status=404)
+def csv_download(request, csv_entry, is_derived):
+    """
+    The byte chunks, status and headers of the download of a dataset, for download_csv and its async variant.
+    Chunks are None when the requested range cannot be satisfied.
+    Raises TableQueryError for filters that do not fit the schema, ExportError for other bad parameters.
+    """
+    if is_derived:
+        file_name = f"{csv_entry.parent.name.split('.')[0]}-derived-{csv_entry.id}.csv"
+        schema = csv_entry.parent.schema or {}
+    else:
+        file_name = csv_entry.name
+        schema = csv_entry.schema or {}
+    rows = csv_entry.rows
+    export = parse_export_query(request.GET, schema, len(rows))
+    filters = parse_filters({key: value for key, value in request.GET.items() if key not in EXPORT_PARAMS}, schema)
+
+    content_type, extension = EXPORT_FORMATS[export['format']]
+    if export['format'] != 'csv':
+        file_name = f"{file_name.rsplit('.', 1)[0]}.{extension}"
+    status = 200
+    headers = {
+        'Content-Type': content_type,
+        'Content-Disposition': f'attachment; filename="{file_name}"',
+        'Accept-Ranges': 'bytes',
+    }
+
+    range_header = request.headers.get('Range')
+    accepts_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    use_gzip = (not range_header and settings.CSV_DOWNLOAD_GZIP and accepts_gzip
+                and export['format'] in CONTENT_ENCODED_FORMATS)
+    variant = export_variant(export['format'], use_gzip)
+    selected = bool(filters or export['columns'] or export['start'] or export['stop'] < len(rows))
+
+    if is_cacheable(csv_entry):
+        if selected:
+            selection = [filters, export['columns'], export['start'], export['stop']]
+            variant = f"{variant}-{hashlib.sha1(json.dumps(selection, default=str).encode()).hexdigest()}"
+        validators, not_modified = conditional_response(request, csv_entry, variant)
+        headers.update(validators)
+        if not_modified is not None:
+            return None, not_modified.status_code, headers
+
+    # Processed datasets do not change, their full export bodies are cached once streamed in full,
+    # and the length of every export, for byte ranges
+    body = None if selected else cached_export(csv_entry, variant)
+    if body is not None:
+        chunks = [body]
+    else:
+        chunks = iter_export(rows, schema, filters, export['columns'], export['start'], export['stop'], export['format'])
+        if use_gzip:
+            chunks = gzip_chunks(chunks)
+        chunks = cache_export(chunks, csv_entry, variant, keep_body=not selected)
+
+    if range_header:
+        # Datasets do not change once written, and exports are written the same every time,
+        # so byte offsets are stable across requests
+        length = len(body) if body is not None else cached_export_length(csv_entry, variant)
+        if length is None:
+            # Not streamed in full yet: answer with the whole export, which measures it for the next ranges
+            return chunks, status, headers
+        try:
+            byte_range = parse_range(range_header, length)
+        except ValueError:
+            byte_range = (0, length)
+        if byte_range is None:
+            return None, 416, {'Content-Range': f'bytes */{length}'}
+
+        start, stop = byte_range
+        if (start, stop) != (0, length):
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+            chunks = slice_chunks(chunks, start, stop)
+        headers['Content-Length'] = str(stop - start)
+    elif use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+
+    return chunks, status, headers
 
 def delete_csv(request, csv_id, is_derived=False):
     """
@@ -97,16 +246,47 @@ def delete_csv(request, csv_id, is_derived=False):
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
 
+@timed_view
 def view_csv(request, csv_id, is_derived=False):
     """
     Render the contents of an UploadedCSV or DerivedCSV in a table.
+    Rows are fetched page by page from view_csv_rows as the table scrolls.
+    """
+    if is_derived:
+        csv_entry = get_object_or_404(DerivedCSV.objects.select_related('parent'), id=csv_id)
+        schema = csv_entry.parent.schema
+    else:
+        csv_entry = get_object_or_404(UploadedCSV, id=csv_id)
+        schema = csv_entry.schema
+
+    content = cached_page('csv_manager/view_csv_content.html', csv_entry, {
+        'csv_entry': csv_entry,
+        'schema': schema or {},
+        'columns': list(schema or {}),
+        'is_derived': is_derived,
+    })
+    return render(request, 'csv_manager/view_csv.html', {'content': content})
+
+@timed_view
+def view_csv_rows(request, csv_id, is_derived=False):
+    """
+    Return one page of an UploadedCSV or DerivedCSV as JSON.
+    Takes offset/limit (or cursor), sort/order and per-column filters typed by the schema,
+    e.g. ?sort=pm25&order=desc&timestamp__gte=2020-01-01&limit=100.
     """
     if is_derived:
         csv_entry = get_object_or_404(DerivedCSV, id=csv_id)
+        schema = csv_entry.parent.schema
     else:
         csv_entry = get_object_or_404(UploadedCSV, id=csv_id)
+        schema = csv_entry.schema
 
-    return render(request, 'csv_manager/view_csv.html', {'csv_entry': csv_entry})
+    try:
+        query = parse_table_query(request.GET, schema or {})
+    except TableQueryError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    return JsonResponse(table_page(csv_entry.rows, schema or {}, query))
 
 def add_data_to_csv(request, csv_id):
     """
@@ -121,15 +301,15 @@ def add_data_to_csv(request, csv_id):
         schema = csv_entry.schema
 
     if request.method == "POST":
-        field_names = list(schema.keys())
-        adjusted_field_names = [f"{field}[]" for field in field_names]
-        num_rows = len(request.POST.getlist(adjusted_field_names[0]))  # Use adjusted field names
+        # Each field is posted as a list with one value per row, read once rather than per row
+        columns = {key: request.POST.getlist(f"{key}[]") for key in schema}
+        num_rows = len(next(iter(columns.values()), []))
         new_rows = []
 
         for i in range(num_rows):
             new_row = {}
             for key, data_type in schema.items():
-                value = request.POST.getlist(f"{key}[]")[i]  # Use adjusted field names
+                value = columns[key][i]
                 try:
                     if data_type == "integer":
                         value = int(value)
@@ -142,6 +322,10 @@ def add_data_to_csv(request, csv_id):
                         value = datetime.strptime(value, "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d %H:%M:%S")
                     elif data_type == "date":
                         value = datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+                    elif data_type == "boolean":
+                        if value.strip().lower() not in BOOLEAN_VALUES:
+                            raise ValueError("expected true or false")
+                        value = BOOLEAN_VALUES[value.strip().lower()]
                     else:
                         value = str(value)
                     new_row[key] = value
@@ -157,47 +341,191 @@ def add_data_to_csv(request, csv_id):
             data=new_rows
         )
 
-        apply_csv_changes.delay(csv_changes.id)
+        schedule_csv_changes(csv_changes)
         messages.success(request, f"Successfully added {len(new_rows)} rows!")
         return redirect("my_csvs")
 
     return render(request, "csv_manager/add_data_csv.html", {"csv_entry": csv_entry, "schema": schema, "is_derived": is_derived})
 
+@csrf_exempt
+def append_csv_rows(request, csv_id, is_derived=False):
+    """
+    Bulk append API: append the rows of a CSV (text/csv, with a header) or NDJSON
+    (application/x-ndjson, one object per line) request body to an UploadedCSV or a DerivedCSV.
+
+    The body is read as a stream and validated against the schema in batches, see appends.py. Each
+    batch of valid rows is recorded as one CSVChanges, applied in the background like added data;
+    rows with invalid values are skipped and reported with their row number and column.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'POST the rows as text/csv or application/x-ndjson.'}, status=405)
+
+    if is_derived:
+        csv_entry = get_object_or_404(DerivedCSV.objects.select_related('parent'), id=csv_id)
+        schema = csv_entry.parent.schema
+    else:
+        csv_entry = get_object_or_404(UploadedCSV, id=csv_id)
+        schema = csv_entry.schema
+    if not schema:
+        return JsonResponse({'status': 'error', 'message': 'The CSV has no schema yet.'}, status=409)
+
+    try:
+        fmt = append_format(request.content_type)
+    except AppendError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=415)
+
+    try:
+        with transaction.atomic():
+            report = append_rows(request, fmt, csv_entry, schema)
+    except AppendError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    if report['changes']:
+        # The other batches are pending on the same CSV, so they join the run this schedules
+        schedule_csv_changes(report['changes'][-1])
+
+    if report['rows_rejected'] == 0:
+        status = 'success'
+    else:
+        status = 'partial' if report['rows_appended'] else 'error'
+    return JsonResponse({
+        'status': status,
+        'rows_appended': report['rows_appended'],
+        'rows_rejected': report['rows_rejected'],
+        'changes': [change.id for change in report['changes']],
+        'errors': report['errors'],
+        'errors_truncated': report['error_count'] > len(report['errors']),
+    }, status=400 if status == 'error' else 200)
+
+@timed_view
 def visualize_csv(request, csv_id):
     """
     View to visualize either an UploadedCSV or a DerivedCSV.
+    Chart data is aggregated over the whole dataset by visualize_csv_data, axis ranges come from
+    the column statistics kept with the dataset.
     """
     is_derived = request.GET.get('is_derived', '0') == '1'
     if is_derived:
-        csv_entry = get_object_or_404(DerivedCSV, id=csv_id)
-        content = csv_entry.content
+        csv_entry = get_object_or_404(DerivedCSV.objects.select_related('parent').defer('column_sketches'), id=csv_id)
         schema = csv_entry.parent.schema
     else:
-        csv_entry = get_object_or_404(UploadedCSV, id=csv_id)
-        content = csv_entry.content
+        csv_entry = get_object_or_404(UploadedCSV.objects.defer('column_sketches'), id=csv_id)
         schema = csv_entry.schema
 
-    # Slice content to last 400 records for better view
-    content = content[-400:] if len(content) > 400 else content
-
     allowed_columns = {col: col_type for col, col_type in schema.items() if col_type != 'string'}
 
-    return render(request, 'csv_manager/visualize_csv.html', {
+    content = cached_page('csv_manager/visualize_csv_content.html', csv_entry, {
         'csv_entry': csv_entry,
-        'content': content,
         'schema': schema,
         'allowed_columns': allowed_columns,
+        'column_stats': csv_entry.column_stats or {},
         'is_derived': is_derived
     })
+    return render(request, 'csv_manager/visualize_csv.html', {'content': content})
+
+@timed_view
+def visualize_csv_data(request, csv_id):
+    """
+    Return the aggregated data of one chart of an UploadedCSV or DerivedCSV as JSON.
+    Takes kind (series, categories, timeseries or scatter), column, x and bucket.
+    Charts of processed datasets carry an ETag, so browsers revalidate them instead of downloading them again.
+    """
+    is_derived = request.GET.get('is_derived', '0') == '1'
+    if is_derived:
+        csv_entry = get_object_or_404(DerivedCSV.objects.select_related('parent').defer('column_sketches'), id=csv_id)
+        schema = csv_entry.parent.schema
+    else:
+        csv_entry = get_object_or_404(UploadedCSV.objects.defer('column_sketches'), id=csv_id)
+        schema = csv_entry.schema
+
+    headers = {}
+    if is_cacheable(csv_entry):
+        headers, not_modified = conditional_response(request, csv_entry)
+        if not_modified is not None:
+            return HttpResponse(status=not_modified.status_code, headers=headers)
+
+    try:
+        data = chart_data(
+            csv_entry.rows,
+            schema or {},
+            kind=request.GET.get('kind', 'series'),
+            column=request.GET.get('column'),
+            x_column=request.GET.get('x') or None,
+            bucket=request.GET.get('bucket', 'auto'),
+        )
+    except AggregationError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    return JsonResponse(data, headers=headers)
+
+@csrf_exempt
+@timed_view
+def query_csv(request, csv_id, is_derived=False):
+    """
+    Query API: run a declarative query (projection, typed predicates, group-by with aggregates,
+    order and limit, see query.py) over all rows of an UploadedCSV or DerivedCSV.
+    The spec is sent as JSON, in the q parameter of a GET or as the body of a POST.
+    Returns the columns and rows of the result as JSON, or as CSV with ?format=csv.
+    Results over processed datasets are memoized per dataset version and query, and carry an ETag.
+    """
+    if is_derived:
+        csv_entry = get_object_or_404(DerivedCSV.objects.select_related('parent').defer('column_sketches'), id=csv_id)
+        schema = csv_entry.parent.schema
+    else:
+        csv_entry = get_object_or_404(UploadedCSV.objects.defer('column_sketches'), id=csv_id)
+        schema = csv_entry.schema
+
+    try:
+        query = parse_query(load_spec(request.body if request.method == 'POST' else request.GET.get('q')), schema)
+    except QueryError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    fmt = 'csv' if request.GET.get('format') == 'csv' else 'json'
+    headers = {}
+    if is_cacheable(csv_entry):
+        headers, not_modified = conditional_response(request, csv_entry, variant=f'{query_hash(query)}-{fmt}')
+        if not_modified is not None:
+            return HttpResponse(status=not_modified.status_code, headers=headers)
+
+    return query_response(run_query(csv_entry.rows, schema, query), fmt, headers)
+
+def query_response(result, fmt, headers):
+    """
+    The response of query_csv: the result as JSON, or its rows as CSV with a header row.
+    """
+    if fmt == 'csv':
+        return HttpResponse(result_csv(result), content_type='text/csv', headers=headers)
+    return JsonResponse(result, headers=headers)
 
 def my_changes(request):
     """
     View to display all changes recorded in the CSVChanges table.
     """
-    changes = CSVChanges.objects.all().order_by('-id')
+    changes = CSVChanges.objects.select_related('content_type').prefetch_related(GenericPrefetch('csv_entry', [
+        UploadedCSV.objects.only('id', 'name'),
+        DerivedCSV.objects.select_related('parent').only('id', 'parent__name'),
+    ]))
+    changes, next_before = keyset_page(changes, request)
 
     # Add a derived flag to each change
     for change in changes:
         change.is_derived = change.content_type.model == 'derivedcsv'
 
-    return render(request, 'csv_manager/my_changes.html', {'changes': changes})
\ No newline at end of file
+    return render(request, 'csv_manager/my_changes.html', {
+        'changes': changes,
+        'next_before': next_before,
+        'is_first_page': 'before' not in request.GET,
+    })
+
+def csv_cache_stats(request):
+    """
+    Return the hits, misses, hit ratio and mean latency of the dataset cache as JSON,
+    for rendered pages, CSV exports and chart aggregates.
+    """
+    return JsonResponse(cache_stats())
+
+def metrics(request):
+    """
+    Return the task and view metrics in the Prometheus text format, for scraping.
+    """
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
\ No newline at end of file
@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+from .schema import DATETIME_OUTPUT_FORMAT, DATE_OUTPUT_FORMAT
+from .stats import RANGE_TYPES
+
+
+# Operators whose matches lie within a [low, high] range of the column, see predicate_bounds
+RANGE_OPERATORS = ('eq', 'gt', 'gte', 'lt', 'lte', 'between', 'in')
+
+
+def stored_value(value, col_type):
+    """
+    A typed filter value as the rows store it, so it compares with the bounds of blocks:
+    datetimes and dates as ISO strings, which order as text, and numbers as floats.
+    """
+    if col_type == 'datetime':
+        return value.strftime(DATETIME_OUTPUT_FORMAT)
+    if col_type == 'date':
+        # Truncating to the day keeps the bound inclusive of every date a datetime can match
+        return value.strftime(DATE_OUTPUT_FORMAT)
+    return float(value)
+
+
+def block_bounds(df, schema, first_row, block_rows):
+    """
+    Zone maps of rows appended at row index first_row, as (start, stop, bounds) per block.
+    Blocks are cut at multiples of block_rows, so the first and last block of an append can be
+    partial. bounds holds [min, max] of each datetime, date, integer and float column over the
+    block, or None when the block has no values in the column.
+    """
+    if df.empty:
+        return []
+    columns = {column: col_type for column, col_type in schema.items() if col_type in RANGE_TYPES and column in df}
+    blocks = (first_row + np.arange(len(df))) // block_rows
+
+    values = {}
+    for column, col_type in columns.items():
+        series = df[column].reset_index(drop=True)
+        values[column] = series.astype('string') if col_type in ('datetime', 'date') else pd.to_numeric(series, errors='coerce')
+    grouped = pd.DataFrame(values, index=range(len(df))).groupby(blocks)
+    mins, maxes = grouped.min(), grouped.max()
+
+    result = []
+    for block in np.unique(blocks):
+        start = max(int(block) * block_rows, first_row)
+        stop = min((int(block) + 1) * block_rows, first_row + len(df))
+        bounds = {}
+        for column in columns:
+            low, high = mins.at[block, column], maxes.at[block, column]
+            bounds[column] = None if pd.isna(low) else [plain(low), plain(high)]
+        result.append((start, stop, bounds))
+    return result
+
+
+def plain(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def predicate_bounds(predicates, schema):
+    """
+    The [low, high] range, in stored values, that matches of (column, operator, value) predicates
+    must fall in per column, either end None when open. Only range operators narrow it; the bounds
+    are inclusive even for strict comparisons, which can only make blocks be read needlessly.
+    """
+    bounds = {}
+    for column, operator, value in predicates:
+        col_type = schema.get(column)
+        if col_type not in RANGE_TYPES or operator not in RANGE_OPERATORS:
+            continue
+        if operator in ('between', 'in'):
+            if not value:
+                continue
+            values = [stored_value(item, col_type) for item in value]
+            low, high = min(values), max(values)
+        else:
+            value = stored_value(value, col_type)
+            low = value if operator in ('eq', 'gt', 'gte') else None
+            high = value if operator in ('eq', 'lt', 'lte') else None
+
+        current_low, current_high = bounds.get(column, (None, None))
+        bounds[column] = (
+            low if current_low is None else current_low if low is None else max(low, current_low),
+            high if current_high is None else current_high if high is None else min(high, current_high),
+        )
+    return bounds
+
+
+def may_match(block, bounds):
+    """
+    Whether a block with the given zone map can hold rows within the predicate bounds.
+    Columns the block has no bounds for are assumed to match; missing values never do.
+    """
+    for column, (low, high) in bounds.items():
+        if column not in block:
+            continue
+        if block[column] is None:
+            return False
+        block_low, block_high = block[column]
+        if (low is not None and block_high < low) or (high is not None and block_low > high):
+            return False
+    return True
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -81,6 +83,27 @@ DATABASES = {
     }
 }
 
+# PostgreSQL when POSTGRES_DB is set, as docker-compose.yml does. SQLite has a single writer, so concurrent
+# process_csv and apply_csv_changes tasks wait on its lock; on PostgreSQL they write at the same time, rows are
+# loaded with COPY and streamed to downloads through server-side cursors (csv_manager/storage.py).
+# Every process keeps a pool of open connections (needs psycopg[pool]), which replaces CONN_MAX_AGE
+if os.environ.get('POSTGRES_DB'):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ['POSTGRES_DB'],
+        'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+        'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        'OPTIONS': {
+            'pool': {
+                'min_size': 2,
+                'max_size': int(os.environ.get('POSTGRES_POOL_SIZE', 10)),
+                'timeout': 30,
+            },
+        },
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -130,6 +153,97 @@ CELERY_RESULT_BACKEND = 'redis://redis:6379/0'  # Redis as the result backend
 CELERY_ACCEPT_CONTENT = ['json']  # Accept content in JSON format
 CELERY_TASK_SERIALIZER = 'json'  # Serialize tasks in JSON format
 CELERY_RESULT_EXTENDED = True  # Enable extended task results (optional)
+# Run by `celery -A django_csv_app beat`: retries uploads that failed or whose processing stopped
+CELERY_BEAT_SCHEDULE = {
+    'retry-failed-and-unprocessed-csvs': {
+        'task': 'csv_manager.tasks.retry_failed_and_unprocessed_csvs',
+        'schedule': 60.0,
+    },
+}
 
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+# Uploaded files
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# CSV processing
+CSV_CHUNK_ROWS = 50000  # Rows parsed per chunk while processing an upload
+CSV_ROW_BATCH_SIZE = 2000  # Rows per bulk insert and per read batch of the row store
+CSV_MAX_CHAIN_DEPTH = 16  # Derived CSVs stacked deeper than this on their bases are compacted in the background
+CSV_DOWNLOAD_GZIP = True  # Gzip CSV downloads for clients that accept it
+CSV_FRAME_BATCH_SIZE = 50000  # Rows per batch when reading columns into pandas
+CSV_BLOCK_ROWS = 2000  # Rows per zone map block, range reads skip blocks whose min/max rule out a match
+CSV_ORDER_CHUNK_ROWS = 100000  # Row indices per cached chunk of a sorted or filtered table, a page loads one or two
+CSV_CHART_POINTS = 1000  # Point budget of a chart in visualize_csv
+CSV_CHART_TOP_K = 10  # Categories shown before the rest is grouped as 'Others'
+CSV_QUERY_MAX_ROWS = 10000  # Most rows a query_csv result can return, see csv_manager/query.py
+CSV_SCHEMA_SAMPLE_ROWS = 1000  # Rows sampled (head, tail and random) to propose column types
+CSV_DATETIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%d/%m/%Y %H:%M:%S', '%m/%d/%Y %H:%M:%S', '%d.%m.%Y %H:%M:%S']
+CSV_DATE_FORMATS = ['%Y-%m-%d', '%d/%m/%Y', '%m/%d/%Y', '%d.%m.%Y']
+# Column transforms applied to numeric columns of derived CSVs, see csv_manager/transforms.py.
+# Steps run in order, e.g. {'transform': 'clip', 'columns': ['pm25'], 'lower': 0, 'upper': 500}
+CSV_DERIVED_TRANSFORMS = [{'transform': 'halve'}]
+# Where new datasets keep their rows: 'rows' (CSVRow table), 'arrow' (memory-mapped Arrow IPC files
+# under MEDIA_ROOT, needs pyarrow) or 'compressed' (compressed JSON blocks of CSV_BLOCK_ROWS rows in the
+# database). Existing datasets keep the backend they were written with.
+CSV_STORAGE_BACKEND = 'rows'
+CSV_ARROW_COMPRESSION = None  # None keeps Arrow files zero-copy readable, 'lz4' or 'zstd' trade that for size
+CSV_COMPRESSION_CODEC = 'gzip'  # Codec of new 'compressed' blocks: 'gzip', 'zstd' (needs zstandard) or 'none'
+CSV_COMPRESSION_KEY_DICTIONARY = True  # Store column names once per block instead of in every row
+# Uploads of at least CSV_PARALLEL_MIN_BYTES are processed as one Celery subtask per byte range when
+# CSV_PARALLEL_PARTITIONS > 1. Concurrent writes need PostgreSQL or the 'arrow' storage backend,
+# SQLite serializes them. Pipelines with lookback transforms (rolling_mean) always run serially.
+CSV_PARALLEL_PARTITIONS = 1
+CSV_PARALLEL_MIN_BYTES = 64 * 1024 * 1024
+# Processing commits a checkpoint with every chunk. An upload whose run made no progress for
+# CSV_PROCESSING_STALE_AFTER seconds is taken over and resumed, see retry_failed_and_unprocessed_csvs;
+# it must be well above the time one chunk of CSV_CHUNK_ROWS rows takes
+CSV_PROCESSING_STALE_AFTER = 10 * 60
+CSV_PROCESSING_MAX_ATTEMPTS = 3
+CSV_PROGRESS_POLL_INTERVAL = 2  # Seconds between progress requests of the my_csvs page
+# Rows added to the same CSV within CSV_CHANGES_BATCH_WINDOW seconds are applied together as one DerivedCSV,
+# or as soon as CSV_CHANGES_BATCH_SIZE changes are pending
+CSV_CHANGES_BATCH_WINDOW = 2
+CSV_CHANGES_BATCH_SIZE = 100
+CSV_APPEND_BATCH_ROWS = 10000  # Rows validated and recorded as one CSVChanges per batch by bulk appends
+CSV_LIST_PAGE_SIZE = 50  # CSVs or changes per page of the my_csvs and my_changes listings
+# Serve the dataset read views (view, rows, download, visualize) from csv_manager/async_views.py.
+# Turn on when the app runs under an ASGI server (django_csv_app/asgi.py), so slow reads do not hold a worker
+CSV_ASYNC_VIEWS = False
+
+# Responses built from processed datasets (page content, CSV exports, chart aggregates) are cached in the
+# CSV_CACHE_ALIAS cache, keyed on the dataset version, see csv_manager/caching.py. The local memory cache is
+# per process and evicts the least recently used entries beyond MAX_ENTRIES; to share the cache between
+# workers use e.g. django.core.cache.backends.redis.RedisCache with 'LOCATION': 'redis://redis:6379/1',
+# or django.core.cache.backends.filebased.FileBasedCache with a directory as LOCATION
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'datasets': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'csv-datasets',
+        'TIMEOUT': 24 * 60 * 60,
+        'OPTIONS': {'MAX_ENTRIES': 256},
+    },
+}
+CSV_CACHE_ALIAS = 'datasets'
+CSV_CACHE_MAX_EXPORT_BYTES = 8 * 1024 * 1024  # Larger CSV exports are streamed from the row store every time
+# ProcessingRuns older than this many days are deleted by retry_failed_and_unprocessed_csvs, /metrics/ covers the rest
+CSV_RUN_RETENTION_DAYS = 14
+
+# Every background task run is logged as one JSON line by the csv_manager.runs logger, and recorded as a
+# ProcessingRun; /metrics/ serves them as Prometheus histograms, see csv_manager/instrumentation.py.
+# The test runner keeps it quiet, tests read the ProcessingRuns instead
+TESTING = sys.argv[1:2] == ['test']
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'csv_manager.runs': {'handlers': ['console'], 'level': 'WARNING' if TESTING else 'INFO', 'propagate': False},
+    },
+}